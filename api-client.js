@@ -5,6 +5,17 @@
 
 const API_BASE_URL = "http://localhost:5001/api";
 
+// Site whose database the API calls use (null = the server's default site)
+let currentSite = null;
+
+function setSite(site) {
+  /**
+   * Route subsequent API calls to a manufacturing site
+   * @param {string|null} site - Site name from SiteAPI.getAll(), or null for the default
+   */
+  currentSite = site;
+}
+
 // ===================================
 // Helper Functions
 // ===================================
@@ -18,13 +29,13 @@ async function apiRequest(endpoint, options = {}) {
    */
   const url = `${API_BASE_URL}${endpoint}`;
 
-  const defaultOptions = {
-    headers: {
-      "Content-Type": "application/json",
-    },
+  const headers = {
+    "Content-Type": "application/json",
+    ...(currentSite ? { "X-QMS-Site": currentSite } : {}),
+    ...(options.headers || {}),
   };
 
-  const config = { ...defaultOptions, ...options };
+  const config = { ...options, headers };
 
   try {
     const response = await fetch(url, config);
@@ -43,6 +54,20 @@ async function apiRequest(endpoint, options = {}) {
   }
 }
 
+async function apiBatch(requests, options = {}) {
+  /**
+   * Send several API calls in one round trip (POST /batch)
+   * @param {object[]} requests - { id, method, path, body } with paths like '/api/capa/stats'
+   * @param {object} options - { snapshot: true } reads all GETs from one consistent snapshot
+   * @returns {Promise} Array of { id, status, body, duration_ms } in request order
+   */
+  const data = await apiRequest("/batch", {
+    method: "POST",
+    body: JSON.stringify({ requests, snapshot: !!options.snapshot }),
+  });
+  return data.responses;
+}
+
 // ===================================
 // User API
 // ===================================
@@ -69,7 +94,9 @@ const UserAPI = {
 
 const DeviationAPI = {
   /**
-   * Get all deviations with optional filters
+   * Get deviations with optional filters
+   * Supports fields, sort, limit/offset, status, category, department,
+   * product_batch, rpn_min/rpn_max and detected_/created_ from/to dates
    */
   getAll: async (filters = {}) => {
     const params = new URLSearchParams(filters);
@@ -113,6 +140,22 @@ const DeviationAPI = {
     });
   },
 
+  /**
+   * Move several deviations to a new status in one transaction
+   * Fails (409) without changing anything if any transition is not allowed
+   */
+  transition: async (deviationIds, toStatus, updatedBy = 1, comment = null) => {
+    return await apiRequest("/deviations/transition", {
+      method: "POST",
+      body: JSON.stringify({
+        ids: deviationIds,
+        to_status: toStatus,
+        updated_by: updatedBy,
+        comment,
+      }),
+    });
+  },
+
   /**
    * Get deviation statistics
    */
@@ -127,10 +170,14 @@ const DeviationAPI = {
 
 const CAPAAPI = {
   /**
-   * Get all CAPA records
+   * Get CAPA records with optional filters
+   * Supports fields, sort, limit/offset, status, type, responsible_person,
+   * deviation_id and target_/completed_/created_ from/to dates
    */
-  getAll: async () => {
-    return await apiRequest("/capa");
+  getAll: async (filters = {}) => {
+    const params = new URLSearchParams(filters);
+    const query = params.toString() ? `?${params.toString()}` : "";
+    return await apiRequest(`/capa${query}`);
   },
 
   /**
@@ -160,6 +207,22 @@ const CAPAAPI = {
     });
   },
 
+  /**
+   * Move several CAPA records to a new status in one transaction
+   * Fails (409) without changing anything if any transition is not allowed
+   */
+  transition: async (capaIds, toStatus, updatedBy = 1, comment = null) => {
+    return await apiRequest("/capa/transition", {
+      method: "POST",
+      body: JSON.stringify({
+        ids: capaIds,
+        to_status: toStatus,
+        updated_by: updatedBy,
+        comment,
+      }),
+    });
+  },
+
   /**
    * Get CAPA records for a specific deviation
    */
@@ -231,6 +294,18 @@ const DashboardAPI = {
   getRecentActivity: async () => {
     return await apiRequest("/dashboard/recent-activity");
   },
+
+  /**
+   * Get several dashboard widgets in one request
+   * @param {string[]} widgets - Widget names (e.g. ['kpis', 'trends'])
+   * @param {object} filters - Optional status/category filters for the deviations widget
+   */
+  getSummary: async (widgets = [], filters = {}) => {
+    const params = new URLSearchParams(filters);
+    if (widgets.length) params.set("widgets", widgets.join(","));
+    const query = params.toString() ? `?${params.toString()}` : "";
+    return await apiRequest(`/dashboard/summary${query}`);
+  },
 };
 
 // ===================================
@@ -269,6 +344,171 @@ const BatchAPI = {
   },
 };
 
+// ===================================
+// Analytics API
+// ===================================
+
+const AnalyticsAPI = {
+  /**
+   * Get the risk heatmap, risk matrix and RPN histogram for a slice
+   * Supports category, department, from/to (YYYY-MM), x/y axes and bucket
+   */
+  getRisk: async (filters = {}) => {
+    const params = new URLSearchParams(filters);
+    const query = params.toString() ? `?${params.toString()}` : "";
+    return await apiRequest(`/analytics/risk${query}`);
+  },
+
+  /**
+   * Get cycle times, time in state, bottlenecks and aging of deviations and CAPA
+   * Supports period (as in reports) or from/to (YYYY-MM-DD), and entity
+   */
+  getLifecycle: async (filters = {}) => {
+    const params = new URLSearchParams(filters);
+    const query = params.toString() ? `?${params.toString()}` : "";
+    return await apiRequest(`/analytics/lifecycle${query}`);
+  },
+};
+
+// ===================================
+// Document API
+// ===================================
+
+const DocumentAPI = {
+  /**
+   * Get documents, optionally filtered by status and document_type
+   */
+  getAll: async (filters = {}) => {
+    const params = new URLSearchParams(filters);
+    const query = params.toString() ? `?${params.toString()}` : "";
+    return await apiRequest(`/documents${query}`);
+  },
+
+  /**
+   * Get a document with its revision history
+   */
+  getById: async (documentId) => {
+    return await apiRequest(`/documents/${documentId}`);
+  },
+
+  /**
+   * Create a document record
+   */
+  create: async (documentData) => {
+    return await apiRequest("/documents", {
+      method: "POST",
+      body: JSON.stringify(documentData),
+    });
+  },
+
+  /**
+   * Upload a file (File or Blob) as a new revision of a document
+   * The body is sent as-is so the server can store it while it streams in
+   */
+  uploadRevision: async (documentId, version, file, uploadedBy = 1) => {
+    const params = new URLSearchParams({
+      version,
+      uploaded_by: uploadedBy,
+    });
+    if (file.name) params.set("file_name", file.name);
+    return await apiRequest(`/documents/${documentId}/revisions?${params}`, {
+      method: "POST",
+      headers: { "Content-Type": file.type || "application/octet-stream" },
+      body: file,
+    });
+  },
+
+  /**
+   * URL of a revision's content (latest if no version), for links and viewers
+   */
+  contentUrl: (documentId, version = null) => {
+    const params = new URLSearchParams();
+    if (version) params.set("version", version);
+    if (currentSite) params.set("site", currentSite);
+    const query = params.toString() ? `?${params.toString()}` : "";
+    return `${API_BASE_URL}/documents/${documentId}/content${query}`;
+  },
+};
+
+// ===================================
+// Site API
+// ===================================
+
+const SiteAPI = {
+  /**
+   * Get the sites served by the API and the default site
+   */
+  getAll: async () => {
+    return await apiRequest("/sites");
+  },
+};
+
+// ===================================
+// Global (Cross-Site) API
+// ===================================
+
+const GlobalAPI = {
+  /**
+   * Each call returns { merged, by_site, errors, timings_ms } across all sites,
+   * or only the given site names
+   */
+  getDeviationStats: async (sites = []) => {
+    return await apiRequest(`/global/deviations/stats${globalQuery(sites)}`);
+  },
+
+  getCAPAStats: async (sites = []) => {
+    return await apiRequest(`/global/capa/stats${globalQuery(sites)}`);
+  },
+
+  getKPIs: async (sites = []) => {
+    return await apiRequest(`/global/dashboard/kpis${globalQuery(sites)}`);
+  },
+
+  getTrends: async (sites = []) => {
+    return await apiRequest(`/global/dashboard/trends${globalQuery(sites)}`);
+  },
+};
+
+function globalQuery(sites) {
+  return sites.length ? `?sites=${encodeURIComponent(sites.join(","))}` : "";
+}
+
+// ===================================
+// Change Feed API
+// ===================================
+
+const ChangesAPI = {
+  /**
+   * Get upserts and tombstones since a sequence number
+   * A response with reset=true means the caller must reload full datasets
+   * and continue from latest_seq
+   * @param {number} since - Last latest_seq the caller has applied
+   * @param {string[]} entities - Optional entity types (e.g. ['deviations'])
+   * @param {number} wait - Seconds to hold the request until a change arrives
+   *   (long-poll; honoured by the asyncio server, backend/aio_server.py)
+   */
+  since: async (since = 0, entities = [], wait = 0) => {
+    const params = new URLSearchParams({ since });
+    if (entities.length) params.set("entities", entities.join(","));
+    if (wait) params.set("wait", wait);
+    return await apiRequest(`/changes?${params.toString()}`);
+  },
+
+  /**
+   * Get notified of changes over server-sent events (asyncio server only)
+   * onChange receives { site, latest_seq, entities }; fetch the rows with
+   * ChangesAPI.since(previous latest_seq). Returns the EventSource to close.
+   */
+  subscribe: (onChange, entities = []) => {
+    const params = new URLSearchParams();
+    if (entities.length) params.set("entities", entities.join(","));
+    if (currentSite) params.set("site", currentSite);
+    const source = new EventSource(`${API_BASE_URL}/events?${params.toString()}`);
+    source.addEventListener("change", (event) => onChange(JSON.parse(event.data)));
+    return source;
+  },
+};
+
 // ===================================
 // Export API modules
 // ===================================
@@ -0,0 +1,169 @@
+"""
+Admission control and load shedding for the API server
+Requests are admitted per endpoint class, each with its own concurrency
+limit, bounded wait queue and queueing deadline
+"""
+import os
+import math
+import threading
+import time
+from collections import deque
+
+# Set to 0 to admit every request without limits
+ADMISSION_ENABLED = os.environ.get('QMS_ADMISSION_ENABLED', '1') != '0'
+
+# Recent queue waits kept per class for percentile metrics
+QUEUE_SAMPLES = 1024
+
+# name: (concurrency limit, queue size, max queue wait seconds, Retry-After seconds, sheddable)
+DEFAULT_CLASSES = {
+    # Health checks, single-record reads and metrics; never shed
+    'critical': (8, 32, 2.0, 1, False),
+    # Writes and small reads
+    'standard': (8, 64, 5.0, 2, False),
+    # Aggregations and full list endpoints
+    'heavy': (4, 16, 3.0, 5, False),
+    # Exports, history scans and reports; rejected rather than queued
+    'low': (2, 0, 0.0, 30, True),
+}
+
+
+class Overloaded(Exception):
+    """Raised when a request is not admitted"""
+
+    def __init__(self, class_name, reason, retry_after):
+        super().__init__(f'{class_name} capacity exhausted ({reason})')
+        self.class_name = class_name
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class EndpointClass:
+    """Concurrency slots, wait queue and counters for one class of endpoints"""
+
+    def __init__(self, name, limit, queue_size, max_wait, retry_after, sheddable):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.sheddable = sheddable
+        self.slots = threading.Semaphore(limit)
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = {'shed': 0, 'queue_full': 0, 'deadline': 0}
+        self.queued = 0
+        self.total_queue_ms = 0.0
+        self.max_queue_ms = 0.0
+        self.samples = deque(maxlen=QUEUE_SAMPLES)
+
+
+class Ticket:
+    """An admitted request; release() frees its slot exactly once"""
+
+    def __init__(self, controller, endpoint_class, queue_ms):
+        self._controller = controller
+        self.endpoint_class = endpoint_class
+        self.queue_ms = queue_ms
+        self._released = False
+
+    def release(self):
+        self._controller._release(self)
+
+
+class AdmissionController:
+    """
+    Per-class admission with bounded queues
+
+    A request takes a free slot in its class immediately if there is one,
+    otherwise it waits in the class queue until a slot frees up or its
+    deadline passes. Full queues and expired deadlines are rejected. Each
+    class has its own slots, so saturated heavy endpoints cannot take
+    capacity reserved for critical ones. Sheddable classes never queue and
+    are also rejected while requests of any other class are waiting.
+    """
+
+    def __init__(self, classes=None, enabled=ADMISSION_ENABLED):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.classes = {
+            name: EndpointClass(name, *settings)
+            for name, settings in (classes or DEFAULT_CLASSES).items()
+        }
+
+    def _reject(self, endpoint_class, reason):
+        endpoint_class.rejected[reason] += 1
+        return Overloaded(endpoint_class.name, reason, endpoint_class.retry_after)
+
+    def acquire(self, class_name):
+        """Admit a request of class_name, or raise Overloaded"""
+        endpoint_class = self.classes[class_name]
+        if not self.enabled:
+            return None
+        started = time.perf_counter()
+        with self._lock:
+            if endpoint_class.sheddable and any(
+                c.waiting for c in self.classes.values() if c is not endpoint_class
+            ):
+                raise self._reject(endpoint_class, 'shed')
+            admitted = endpoint_class.slots.acquire(blocking=False)
+            if not admitted:
+                if endpoint_class.waiting >= endpoint_class.queue_size:
+                    raise self._reject(endpoint_class, 'queue_full')
+                endpoint_class.waiting += 1
+
+        if not admitted:
+            admitted = endpoint_class.slots.acquire(timeout=endpoint_class.max_wait)
+            with self._lock:
+                endpoint_class.waiting -= 1
+                if not admitted:
+                    raise self._reject(endpoint_class, 'deadline')
+
+        queue_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            endpoint_class.in_flight += 1
+            endpoint_class.admitted += 1
+            if queue_ms >= 1:
+                endpoint_class.queued += 1
+            endpoint_class.total_queue_ms += queue_ms
+            endpoint_class.max_queue_ms = max(endpoint_class.max_queue_ms, queue_ms)
+            endpoint_class.samples.append(queue_ms)
+        return Ticket(self, endpoint_class, queue_ms)
+
+    def _release(self, ticket):
+        with self._lock:
+            if ticket._released:
+                return
+            ticket._released = True
+            ticket.endpoint_class.in_flight -= 1
+        ticket.endpoint_class.slots.release()
+
+    def activity(self):
+        """(requests in progress or waiting, requests admitted so far) over all classes"""
+        with self._lock:
+            classes = self.classes.values()
+            return (sum(c.in_flight + c.waiting for c in classes), sum(c.admitted for c in classes))
+
+    def metrics(self):
+        """Per-class limits, occupancy, rejections and queue-time statistics"""
+        with self._lock:
+            result = {}
+            for name, c in self.classes.items():
+                samples = sorted(c.samples)
+                p95 = samples[math.ceil(len(samples) * 0.95) - 1] if samples else 0.0
+                result[name] = {
+                    'limit': c.limit,
+                    'queue_size': c.queue_size,
+                    'max_wait_seconds': c.max_wait,
+                    'sheddable': c.sheddable,
+                    'in_flight': c.in_flight,
+                    'waiting': c.waiting,
+                    'admitted': c.admitted,
+                    'queued': c.queued,
+                    'rejected': dict(c.rejected),
+                    'avg_queue_ms': round(c.total_queue_ms / c.admitted, 2) if c.admitted else 0.0,
+                    'p95_queue_ms': round(p95, 2),
+                    'max_queue_ms': round(c.max_queue_ms, 2)
+                }
+            return {'enabled': self.enabled, 'classes': result}
@@ -0,0 +1,582 @@
+"""
+asyncio HTTP server for the QMS API
+Connections, request bodies, streamed responses, long-polls and server-sent
+events are handled by coroutines, so an idle client costs a few kilobytes
+instead of a thread. Flask handlers still run unchanged through WSGI, on a
+bounded thread pool, and return exactly the responses api.py does.
+"""
+import os
+import sys
+import json
+import asyncio
+import tempfile
+import threading
+import contextvars
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from urllib.parse import unquote, urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+import changefeed
+from database import (CHANGE_FEED_TABLES, DEFAULT_SITE, DISCONNECT_CHECK_INTERVAL, UnknownSite,
+                      get_read_connection, site_db_path, use_site)
+from api import app, start_services
+
+# Threads running Flask handlers (and so all database work)
+WORKERS = int(os.environ.get('QMS_AIO_WORKERS', 32))
+
+# Seconds an idle keep-alive connection stays open
+KEEPALIVE_TIMEOUT = float(os.environ.get('QMS_AIO_KEEPALIVE', 75))
+
+# Seconds between change-log polls while clients wait for changes
+CHANGE_POLL_INTERVAL = float(os.environ.get('QMS_AIO_POLL_INTERVAL', 0.5))
+
+# Longest ?wait= accepted by /api/changes and the SSE heartbeat interval
+MAX_LONG_POLL_SECONDS = 60
+SSE_HEARTBEAT_SECONDS = 15
+
+# Request heads larger than this are rejected; bodies larger are spooled to disk
+MAX_HEADER_BYTES = 64 * 1024
+BODY_SPOOL_BYTES = 1024 * 1024
+READ_PIECE = 64 * 1024
+
+# Request bodies larger than this are answered with 413 (document revisions are the largest)
+MAX_BODY_BYTES = int(os.environ.get('QMS_AIO_MAX_BODY_BYTES', 512 * 1024 * 1024))
+
+SERVER_NAME = 'QMS-aio'
+NO_BODY_STATUSES = (204, 304)
+
+executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='qms-aio')
+stats = {'connections': 0, 'requests': 0, 'long_polls_waiting': 0, 'event_streams': 0}
+
+
+class HttpError(Exception):
+    """Malformed request; answered with status and the connection closed"""
+
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+
+class ChangeWatcher:
+    """
+    Wakes coroutines waiting for change-log entries
+
+    One poller task per site reads the newest sequence number per entity type
+    while anyone is waiting, so a thousand waiting clients cost one query per
+    CHANGE_POLL_INTERVAL rather than a thread each.
+    """
+
+    def __init__(self, interval=CHANGE_POLL_INTERVAL):
+        self.interval = interval
+        self._sites = {}
+
+    def _state(self, site):
+        if site not in self._sites:
+            self._sites[site] = {'seqs': {}, 'newest': 0, 'changed': asyncio.Event(), 'waiters': 0,
+                                 'task': None}
+        return self._sites[site]
+
+    @staticmethod
+    def _read_seqs(site):
+        with use_site(site), get_read_connection() as conn:
+            return changefeed.latest_seq_by_entity(conn), changefeed.latest_seq(conn)
+
+    async def _refresh(self, site, state):
+        seqs, newest = await asyncio.get_running_loop().run_in_executor(
+            executor, contextvars.Context().run, self._read_seqs, site
+        )
+        if seqs != state['seqs'] or newest != state['newest']:
+            state['seqs'] = seqs
+            state['newest'] = newest
+            state['changed'].set()
+            state['changed'] = asyncio.Event()
+
+    async def _poll(self, site, state):
+        try:
+            while state['waiters']:
+                await asyncio.sleep(self.interval)
+                try:
+                    await self._refresh(site, state)
+                except Exception as e:
+                    print(f"Change poll for site {site} failed: {e}")
+        finally:
+            state['task'] = None
+
+    def latest(self, site):
+        """Newest sequence number per entity type as of the last poll"""
+        return dict(self._state(site)['seqs'])
+
+    def newest(self, site):
+        """Newest sequence number of the whole log as of the last poll"""
+        return self._state(site)['newest']
+
+    async def wait(self, site, since, entity_types, timeout):
+        """
+        Wait until an entity type in entity_types has a change after since, or
+        since turns out to be ahead of the whole log; returns the newest seq
+        """
+        state = self._state(site)
+        state['waiters'] += 1
+        try:
+            if state['task'] is None:
+                # The cached numbers are stale while nobody was polling
+                await self._refresh(site, state)
+                state['task'] = asyncio.create_task(self._poll(site, state))
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            while True:
+                newest = max(state['seqs'].get(t, 0) for t in entity_types)
+                remaining = deadline - loop.time()
+                if newest > since or since > state['newest'] or remaining <= 0:
+                    return newest
+                try:
+                    await asyncio.wait_for(state['changed'].wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            state['waiters'] -= 1
+
+
+watcher = ChangeWatcher()
+
+
+# ===================================
+# Request Parsing
+# ===================================
+
+async def read_head(reader):
+    """Read a request line and headers; None when the client closed the connection"""
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if e.partial.strip():
+            raise HttpError(400, 'Incomplete request')
+        return None
+    except asyncio.LimitOverrunError:
+        raise HttpError(431, 'Request Header Fields Too Large')
+
+    lines = head.decode('latin-1').split('\r\n')
+    parts = lines[0].split(' ')
+    if len(parts) != 3 or not parts[2].startswith('HTTP/1.'):
+        raise HttpError(400, 'Bad request line')
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep or not name.strip():
+            raise HttpError(400, 'Bad header')
+        headers.append((name.strip(), value.strip()))
+    return parts[0], parts[1], parts[2], headers
+
+
+def body_length(header):
+    """Declared length of the request body; None when it is sent chunked"""
+    if 'chunked' in header('transfer-encoding', '').lower():
+        return None
+    try:
+        length = int(header('content-length', 0))
+    except ValueError:
+        raise HttpError(400, 'Bad Content-Length')
+    if length < 0:
+        raise HttpError(400, 'Bad Content-Length')
+    if length > MAX_BODY_BYTES:
+        raise HttpError(413, 'Payload Too Large')
+    return length
+
+
+async def _copy(reader, spool, size):
+    if spool.tell() + size > MAX_BODY_BYTES:
+        raise HttpError(413, 'Payload Too Large')
+    while size:
+        data = await reader.read(min(size, READ_PIECE))
+        if not data:
+            raise HttpError(400, 'Incomplete body')
+        spool.write(data)
+        size -= len(data)
+
+
+async def read_body(reader, length):
+    """
+    Read the body into a spooled file as it arrives; returns (file, length)
+    length is body_length()'s; a chunked body is limited to MAX_BODY_BYTES as it arrives.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_BYTES)
+    try:
+        if length is None:
+            while True:
+                try:
+                    size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                except ValueError:
+                    raise HttpError(400, 'Bad chunk size')
+                if size < 0:
+                    raise HttpError(400, 'Bad chunk size')
+                if size == 0:
+                    while await reader.readuntil(b'\r\n') != b'\r\n':
+                        pass
+                    break
+                await _copy(reader, spool, size)
+                await reader.readexactly(2)
+        else:
+            await _copy(reader, spool, length)
+    except BaseException:
+        spool.close()
+        raise
+    length = spool.tell()
+    spool.seek(0)
+    return spool, length
+
+
+def build_environ(method, target, version, headers, body, length, writer, is_disconnected):
+    if target.startswith(('http://', 'https://')):
+        split = urlsplit(target)
+        target = split.path + (f'?{split.query}' if split.query else '')
+    path, _, query = target.partition('?')
+    host, port = writer.get_extra_info('sockname')[:2]
+    peer = writer.get_extra_info('peername') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote(path, encoding='latin-1'),
+        'QUERY_STRING': query,
+        'SERVER_NAME': host,
+        'SERVER_PORT': str(port),
+        'SERVER_PROTOCOL': version,
+        'REMOTE_ADDR': peer[0],
+        'REMOTE_PORT': str(peer[1]),
+        'CONTENT_TYPE': '',
+        'CONTENT_LENGTH': str(length) if length else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'qms.is_disconnected': is_disconnected,
+    }
+    for name, value in headers:
+        key = name.upper().replace('-', '_')
+        # The body has already been de-chunked and its length is in CONTENT_LENGTH
+        if key == 'TRANSFER_ENCODING':
+            continue
+        if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            if key == 'CONTENT_TYPE':
+                environ[key] = value
+            continue
+        key = f'HTTP_{key}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+# ===================================
+# Responses
+# ===================================
+
+def response_head(status, headers, keep_alive):
+    lines = [f'HTTP/1.1 {status}', f'Server: {SERVER_NAME}',
+             f"Date: {format_datetime(datetime.now(timezone.utc), usegmt=True)}"]
+    lines.extend(f'{name}: {value}' for name, value in headers)
+    lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+async def send_json(writer, status, payload, keep_alive=False):
+    body = json.dumps(payload).encode()
+    writer.write(response_head(status, [('Content-Type', 'application/json'),
+                                        ('Content-Length', str(len(body))),
+                                        ('Access-Control-Allow-Origin', '*')], keep_alive) + body)
+    await writer.drain()
+
+
+async def run_wsgi(environ, writer, keep_alive):
+    """
+    Call the Flask app on the executor and stream its body to the client
+    Each chunk is produced on the pool and written here, so a slow client
+    holds no thread between chunks. Returns whether the connection stays open.
+    """
+    loop = asyncio.get_running_loop()
+    # A fresh context per request: handlers set the site and query deadline in it
+    context = contextvars.Context()
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and started.get('sent'):
+            raise exc_info[1].with_traceback(exc_info[2])
+        started['status'] = status
+        started['headers'] = headers
+        return lambda data: started.setdefault('written', []).append(data)
+
+    def call_app():
+        result = app(environ, start_response)
+        iterator = iter(result)
+        return result, iterator, next(iterator, None)
+
+    try:
+        result, iterator, chunk = await loop.run_in_executor(executor, context.run, call_app)
+    except Exception as e:
+        print(f"Unhandled error serving {environ['PATH_INFO']}: {e!r}")
+        await send_json(writer, '500 Internal Server Error', {'error': 'Internal server error'})
+        return False
+    try:
+        status = started['status']
+        code = int(status.split(' ', 1)[0])
+        headers = list(started['headers'])
+        names = {name.lower() for name, _ in headers}
+        head_only = environ['REQUEST_METHOD'] == 'HEAD' or code in NO_BODY_STATUSES or code < 200
+        length = next((int(v) for n, v in headers if n.lower() == 'content-length'), None)
+        chunked = False
+        if length is None and not head_only:
+            if environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+                chunked = True
+                headers.append(('Transfer-Encoding', 'chunked'))
+            else:
+                keep_alive = False
+        if 'connection' in names:
+            headers = [(n, v) for n, v in headers if n.lower() != 'connection']
+        writer.write(response_head(status, headers, keep_alive))
+        started['sent'] = True
+
+        pending = started.get('written', [])
+        sent = 0
+        try:
+            while not head_only:
+                data = b''.join(pending) + (chunk or b'')
+                pending = []
+                if data:
+                    writer.write(b'%x\r\n%s\r\n' % (len(data), data) if chunked else data)
+                    sent += len(data)
+                    await writer.drain()
+                if chunk is None or (length is not None and sent >= length):
+                    break
+                chunk = await loop.run_in_executor(executor, context.run, next, iterator, None)
+        except ConnectionError:
+            raise
+        except Exception as e:
+            # Headers are out, so no error response is possible: close without the
+            # terminating chunk and the client sees a truncated body, not a complete one
+            print(f"Error streaming {environ['PATH_INFO']} after {sent} bytes: {e!r}")
+            return False
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+        await writer.drain()
+    finally:
+        # Runs response close callbacks (e.g. releasing the admission slot) in the request's context
+        if hasattr(result, 'close'):
+            await loop.run_in_executor(executor, context.run, result.close)
+    return keep_alive
+
+
+# ===================================
+# Coroutine Routes
+# ===================================
+
+def request_site(query, header):
+    site = (query.get('site') or [None])[0] or header('x-qms-site') or DEFAULT_SITE
+    site_db_path(site)
+    return site
+
+
+def entity_types(query):
+    requested = (query.get('entities') or [''])[0]
+    types = [t.strip() for t in requested.split(',') if t.strip()] or CHANGE_FEED_TABLES
+    if any(t not in CHANGE_FEED_TABLES for t in types):
+        raise ValueError(f"Unknown entity types: {', '.join(types)}")
+    return types
+
+
+async def wait_for_changes(query, header):
+    """
+    Long-poll: hold /api/changes?since=&wait=<seconds> until a matching change
+    exists (or the wait ends), then let the normal handler answer; returns
+    False when the change log could not be read
+    """
+    try:
+        since = int((query.get('since') or ['0'])[0])
+        wait = min(float(query['wait'][0]), MAX_LONG_POLL_SECONDS)
+        site = request_site(query, header)
+        types = entity_types(query)
+    except (ValueError, UnknownSite):
+        # Left to the handler, which reports the error exactly as without ?wait=
+        return True
+    if since < 1 or wait <= 0:
+        return True
+    stats['long_polls_waiting'] += 1
+    try:
+        await watcher.wait(site, since, types, wait)
+    except Exception as e:
+        print(f"Long-poll for site {site} failed: {e!r}")
+        return False
+    finally:
+        stats['long_polls_waiting'] -= 1
+    return True
+
+
+async def serve_events(writer, query, header):
+    """
+    Server-sent events: GET /api/events?entities=&site=
+    Sends a 'change' event with the newest sequence number whenever matching
+    entities change; clients then fetch /api/changes?since=<previous id>
+    """
+    try:
+        site = request_site(query, header)
+        types = entity_types(query)
+        since = header('last-event-id') or (query.get('since') or [None])[0]
+        since = int(since) if since else None
+    except UnknownSite as e:
+        await send_json(writer, '404 Not Found', {'error': str(e)})
+        return
+    except ValueError as e:
+        await send_json(writer, '400 Bad Request', {'error': str(e)})
+        return
+
+    stats['event_streams'] += 1
+    try:
+        try:
+            # Reads the log before the stream starts, so a failure can still get a status
+            newest = await watcher.wait(site, since or 0, types, 0)
+        except Exception as e:
+            print(f"Event stream for site {site} failed: {e!r}")
+            await send_json(writer, '503 Service Unavailable', {'error': 'Change feed unavailable'})
+            return
+        if since is None:
+            since = newest
+        writer.write(response_head('200 OK', [('Content-Type', 'text/event-stream'),
+                                              ('Cache-Control', 'no-cache'),
+                                              ('Access-Control-Allow-Origin', '*')], False))
+        writer.write(f'retry: 3000\nid: {since}\n\n'.encode())
+        await writer.drain()
+        while not writer.is_closing():
+            try:
+                newest = await watcher.wait(site, since, types, SSE_HEARTBEAT_SECONDS)
+            except Exception as e:
+                # The client reconnects after the retry delay with Last-Event-ID
+                print(f"Event stream for site {site} failed: {e!r}")
+                return
+            seqs = watcher.latest(site)
+            # A cursor ahead of the whole log (restored database) sends every type to resync
+            ahead = since > watcher.newest(site)
+            if newest > since or ahead:
+                payload = {'site': site, 'latest_seq': newest,
+                           'entities': [t for t in types if seqs.get(t, 0) > since or ahead]}
+                writer.write(f'id: {newest}\nevent: change\ndata: {json.dumps(payload)}\n\n'.encode())
+                since = newest
+            else:
+                writer.write(b': keep-alive\n\n')
+            await writer.drain()
+    finally:
+        stats['event_streams'] -= 1
+
+
+async def serve_metrics(writer, keep_alive):
+    await send_json(writer, '200 OK', dict(stats, workers=WORKERS), keep_alive)
+
+
+# ===================================
+# Connections
+# ===================================
+
+async def handle_request(reader, writer, method, target, version, headers):
+    """Serve one request; returns whether the connection stays open"""
+    stats['requests'] += 1
+    lowered = {}
+    for name, value in headers:
+        lowered[name.lower()] = value
+    header = lambda name, default=None: lowered.get(name, default)
+    connection = header('connection', '').lower()
+    keep_alive = version == 'HTTP/1.1' and connection != 'close' or connection == 'keep-alive'
+
+    path, _, query_string = target.partition('?')
+    query = parse_qs(query_string)
+    if method == 'GET' and path == '/api/events':
+        await serve_events(writer, query, header)
+        return False
+    if method == 'GET' and path == '/api/metrics/aio':
+        await serve_metrics(writer, keep_alive)
+        return keep_alive
+    if method == 'GET' and path == '/api/changes' and 'wait' in query:
+        if not await wait_for_changes(query, header):
+            await send_json(writer, '503 Service Unavailable', {'error': 'Change feed unavailable'})
+            return False
+
+    # Checked before 100 Continue so an oversized upload is refused before it is sent
+    length = body_length(header)
+    if header('expect', '').lower() == '100-continue':
+        writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+    body, length = await read_body(reader, length)
+    # Stream state belongs to the loop: it is watched here and handlers on the
+    # pool only read the event
+    loop = asyncio.get_running_loop()
+    disconnected = threading.Event()
+    watch = {}
+
+    def check_connection():
+        # End of input alone is not a disconnect: a client may half-close once its
+        # request is sent and still read the response
+        if reader.exception() is not None or writer.is_closing():
+            disconnected.set()
+        else:
+            watch['handle'] = loop.call_later(DISCONNECT_CHECK_INTERVAL, check_connection)
+
+    check_connection()
+    try:
+        environ = build_environ(method, target, version, headers, body, length, writer, disconnected.is_set)
+        return await run_wsgi(environ, writer, keep_alive)
+    finally:
+        if 'handle' in watch:
+            watch['handle'].cancel()
+        body.close()
+
+
+async def handle_connection(reader, writer):
+    stats['connections'] += 1
+    try:
+        while True:
+            try:
+                request = await asyncio.wait_for(read_head(reader), KEEPALIVE_TIMEOUT)
+            except asyncio.TimeoutError:
+                break
+            except HttpError as e:
+                await send_json(writer, f'{e.status} {e.reason}', {'error': e.reason})
+                break
+            if request is None or not await handle_request(reader, writer, *request):
+                break
+    except HttpError as e:
+        await send_json(writer, f'{e.status} {e.reason}', {'error': e.reason})
+    except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        pass
+    finally:
+        stats['connections'] -= 1
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+async def serve(host, port):
+    server = await asyncio.start_server(handle_connection, host, port, limit=MAX_HEADER_BYTES,
+                                        backlog=1024)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve the QMS API on asyncio')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5001)
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("Pharmaceutical QMS API Server (asyncio)")
+    print("=" * 60)
+    print(f"Server starting on http://localhost:{args.port} with {WORKERS} worker threads")
+    print("=" * 60)
+    start_services()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,300 @@
+"""
+Risk and lifecycle analytics over precomputed tables
+Heatmaps and RPN distributions are read from risk_cube, which triggers on
+deviations keep up to date, so no query here scans the deviations table.
+Cycle times, bottlenecks and aging are computed over status_history intervals.
+"""
+from datetime import date, datetime, timedelta
+from queries import QueryError, _as_int
+
+# Risk factors usable as heatmap axes, each scored 1..RISK_SCALE
+RISK_AXES = ('severity', 'occurrence', 'detection')
+RISK_SCALE = 10
+
+# Lower RPN bound of each risk level, matching /api/deviations/stats
+RISK_LEVELS = (('Critical', 200), ('High', 100), ('Medium', 40), ('Low', 0))
+
+DEFAULT_BUCKET = 50
+MAX_RPN = RISK_SCALE ** 3
+
+
+def _as_month(value):
+    """Accept YYYY-MM or a YYYY-MM-DD date and return YYYY-MM"""
+    month = str(value)[:7]
+    if len(month) != 7 or month[4] != '-' or not (month[:4] + month[5:]).isdigit():
+        raise QueryError(f'Expected a YYYY-MM month, got {value!r}')
+    return month
+
+
+def risk_slice(args):
+    """Compile the slice arguments into a WHERE clause over risk_cube"""
+    clauses = []
+    params = []
+    for arg in ('category', 'department'):
+        values = args.getlist(arg) if hasattr(args, 'getlist') else ([args[arg]] if arg in args else [])
+        values = [v for v in values if v != '']
+        if values:
+            clauses.append(f"{arg} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+    if args.get('from'):
+        clauses.append('month >= ?')
+        params.append(_as_month(args['from']))
+    if args.get('to'):
+        clauses.append('month <= ?')
+        params.append(_as_month(args['to']))
+    for axis in RISK_AXES:
+        if args.get(f'min_{axis}'):
+            clauses.append(f'{axis} >= ?')
+            params.append(_as_int(args[f'min_{axis}']))
+    return (f"WHERE {' AND '.join(clauses)}" if clauses else ''), params
+
+
+def query_risk_analytics(conn, args):
+    """
+    Heatmap, full risk matrix, RPN histogram, risk levels and monthly totals
+    for one slice (?category=, ?department=, ?from=, ?to=, repeatable filters)
+
+    ?x= and ?y= choose the heatmap axes (default severity x occurrence) and
+    ?bucket= the RPN histogram width.
+    """
+    x = args.get('x', 'severity')
+    y = args.get('y', 'occurrence')
+    if x not in RISK_AXES or y not in RISK_AXES or x == y:
+        raise QueryError(f"x and y must be two different axes of {', '.join(RISK_AXES)}")
+    bucket = _as_int(args.get('bucket', DEFAULT_BUCKET))
+    if not 1 <= bucket <= MAX_RPN:
+        raise QueryError(f'bucket must be between 1 and {MAX_RPN}')
+
+    where, params = risk_slice(args)
+    cursor = conn.cursor()
+
+    cells = [[0] * RISK_SCALE for _ in range(RISK_SCALE)]
+    cursor.execute(f'''
+        SELECT {y}, {x}, SUM(deviation_count) FROM risk_cube {where} GROUP BY {y}, {x}
+    ''', params)
+    for y_value, x_value, count in cursor.fetchall():
+        if 1 <= x_value <= RISK_SCALE and 1 <= y_value <= RISK_SCALE:
+            cells[y_value - 1][x_value - 1] = count
+
+    cursor.execute(f'''
+        SELECT severity, occurrence, detection, SUM(deviation_count) AS count
+        FROM risk_cube {where}
+        GROUP BY severity, occurrence, detection
+        ORDER BY severity, occurrence, detection
+    ''', params)
+    matrix = [dict(zip(('severity', 'occurrence', 'detection', 'count'), row))
+              for row in cursor.fetchall()]
+
+    cursor.execute(f'''
+        SELECT rpn, SUM(deviation_count) FROM risk_cube {where} GROUP BY rpn
+    ''', params)
+    by_rpn = cursor.fetchall()
+    histogram = {}
+    levels = {name: 0 for name, _ in RISK_LEVELS}
+    total = 0
+    for rpn, count in by_rpn:
+        start = (max(rpn, 1) - 1) // bucket * bucket + 1
+        histogram[start] = histogram.get(start, 0) + count
+        levels[next(name for name, floor in RISK_LEVELS if rpn >= floor)] += count
+        total += count
+
+    cursor.execute(f'''
+        SELECT month, SUM(deviation_count), SUM(rpn * deviation_count)
+        FROM risk_cube {where}
+        GROUP BY month ORDER BY month
+    ''', params)
+    by_month = [{'month': month, 'count': count, 'average_rpn': round(rpn_sum / count, 1)}
+                for month, count, rpn_sum in cursor.fetchall()]
+
+    return {
+        'total': total,
+        'heatmap': {'x': x, 'y': y, 'scale': RISK_SCALE, 'cells': cells},
+        'matrix': matrix,
+        'rpn_histogram': [{'from': start, 'to': start + bucket - 1, 'count': histogram[start]}
+                          for start in sorted(histogram)],
+        'risk_levels': levels,
+        'by_month': by_month
+    }
+
+
+# ===================================
+# Lifecycle Analytics
+# ===================================
+
+# Statuses that end a lifecycle; leaving one of them reopens the record
+TERMINAL_STATUSES = {
+    'deviation': ('Closed',),
+    'capa': ('Effective', 'Closed')
+}
+
+# Open-item age buckets: (label, upper bound in days, inclusive)
+AGING_BUCKETS = (('0-7 days', 7), ('8-30 days', 30), ('31-60 days', 60), ('61-90 days', 90),
+                 ('over 90 days', None))
+
+# Oldest open records listed per entity type
+OLDEST_OPEN = 10
+
+
+def _cycle_start(terminal):
+    """
+    Correlated lookup of when the cycle of status_history row h began: its
+    record's latest creation or reopening at or before h (an index range scan)
+    """
+    placeholders = ', '.join('?' * len(terminal))
+    return f'''(
+        SELECT MAX(s.changed_at) FROM status_history s
+        WHERE s.entity_type = h.entity_type AND s.entity_id = h.entity_id
+          AND s.changed_at <= h.changed_at
+          AND (s.from_status IS NULL OR s.from_status IN ({placeholders}))
+          AND s.to_status NOT IN ({placeholders})
+    )''', list(terminal) * 2
+
+
+def _days(value):
+    return round(value, 1) if value is not None else None
+
+
+def lifecycle_metrics(conn, entity, start, cutoff):
+    """
+    Cycle times, time in state, bottlenecks and aging for one entity type
+
+    Closures, visits and time are counted when they fall in [start, cutoff);
+    aging describes the records still open at the cutoff. Each status_history
+    row is one interval (changed_at to left_at), so every query is a range
+    scan over its indexes; percentiles, ranks and shares use window functions.
+    """
+    terminal = list(TERMINAL_STATUSES[entity])
+    placeholders = ', '.join('?' * len(terminal))
+    cycle_start, cycle_params = _cycle_start(terminal)
+
+    # Time to closure: entry into a terminal status, from the start of its cycle.
+    # One row for the whole period (month NULL), then one per closing month.
+    percentiles = '''
+        COUNT(*), AVG(days), MIN(CASE WHEN n >= 0.5 * total THEN days END),
+        MIN(CASE WHEN n >= 0.9 * total THEN days END), MAX(days)
+    '''
+    cycle_time = {}
+    by_month = []
+    for month, count, average, median, p90, longest in conn.execute(f'''
+        WITH closures AS MATERIALIZED (
+            SELECT substr(h.changed_at, 1, 7) AS month,
+                   julianday(h.changed_at) - julianday({cycle_start}) AS days
+            FROM status_history h
+            WHERE h.entity_type = ? AND h.to_status IN ({placeholders})
+              AND h.changed_at >= ? AND h.changed_at < ?
+              AND (h.from_status IS NULL OR h.from_status NOT IN ({placeholders}))
+        ), ranked AS (
+            SELECT month, days,
+                   ROW_NUMBER() OVER (ORDER BY days) AS n, COUNT(*) OVER () AS total,
+                   ROW_NUMBER() OVER (PARTITION BY month ORDER BY days) AS month_n,
+                   COUNT(*) OVER (PARTITION BY month) AS month_total
+            FROM closures WHERE days IS NOT NULL
+        )
+        SELECT NULL, {percentiles} FROM ranked
+        UNION ALL
+        SELECT month, {percentiles.replace('n >=', 'month_n >=').replace('* total', '* month_total')}
+        FROM ranked GROUP BY month
+        ORDER BY 1
+    ''', cycle_params + [entity] + terminal + [start, cutoff] + terminal):
+        summary = {'count': count, 'average_days': _days(average), 'median_days': _days(median),
+                   'p90_days': _days(p90), 'max_days': _days(longest)}
+        if month is None:
+            cycle_time = summary
+        else:
+            by_month.append(dict(summary, month=month))
+
+    # Time spent in each open status within the period, ranked by total days
+    states = []
+    for status, visits, completed, dwell, total_days, current, rank, share in conn.execute(f'''
+        WITH spans AS (
+            SELECT to_status,
+                   left_at IS NOT NULL AND left_at >= ? AND left_at < ? AS completed,
+                   julianday(left_at) - julianday(changed_at) AS dwell,
+                   julianday(MIN(COALESCE(left_at, ?), ?)) - julianday(MAX(changed_at, ?)) AS in_period,
+                   left_at IS NULL OR left_at >= ? AS current
+            FROM status_history
+            WHERE entity_type = ? AND to_status NOT IN ({placeholders}) AND changed_at < ?
+              AND (left_at IS NULL OR left_at > ?)
+        )
+        SELECT to_status, COUNT(*), SUM(completed), AVG(CASE WHEN completed THEN dwell END),
+               SUM(in_period), SUM(current),
+               RANK() OVER (ORDER BY SUM(in_period) DESC),
+               SUM(in_period) / SUM(SUM(in_period)) OVER ()
+        FROM spans
+        GROUP BY to_status
+        ORDER BY SUM(in_period) DESC
+    ''', [start, cutoff, cutoff, cutoff, start, cutoff, entity] + terminal + [cutoff, start]):
+        states.append({
+            'status': status,
+            'visits': visits,
+            'completed_visits': completed,
+            'average_days': _days(dwell),
+            'total_days': _days(total_days),
+            'share': round(share, 3) if share is not None else None,
+            'open_now': current,
+            'rank': rank
+        })
+
+    # Records open at the cutoff by age since their cycle started: one row per
+    # (age bucket, status), then the OLDEST_OPEN oldest records (bucket NULL)
+    buckets = ' '.join(f'WHEN days <= {bound} THEN {index}'
+                       for index, (_, bound) in enumerate(AGING_BUCKETS) if bound is not None)
+    counts = [0] * len(AGING_BUCKETS)
+    by_status = {}
+    oldest = []
+    for bucket, status, bucket_count, entity_id, days, in_status in conn.execute(f'''
+        WITH open_items AS MATERIALIZED (
+            SELECT h.entity_id, h.to_status,
+                   julianday(?) - julianday({cycle_start}) AS days,
+                   julianday(?) - julianday(h.changed_at) AS in_status
+            FROM status_history h
+            WHERE h.entity_type = ? AND h.to_status NOT IN ({placeholders}) AND h.changed_at < ?
+              AND (h.left_at IS NULL OR h.left_at >= ?)
+        ), ranked AS (
+            SELECT *, ROW_NUMBER() OVER (ORDER BY days DESC) AS age_rank FROM open_items
+        )
+        SELECT CASE {buckets} ELSE {len(AGING_BUCKETS) - 1} END AS bucket, to_status, COUNT(*),
+               NULL, NULL, NULL
+        FROM open_items
+        GROUP BY bucket, to_status
+        UNION ALL
+        SELECT NULL, to_status, NULL, entity_id, days, in_status
+        FROM ranked WHERE age_rank <= {OLDEST_OPEN}
+    ''', [cutoff] + cycle_params + [cutoff, entity] + terminal + [cutoff, cutoff]):
+        if bucket is None:
+            oldest.append({'id': entity_id, 'status': status, 'age_days': _days(days),
+                           'in_status_days': _days(in_status)})
+            continue
+        counts[bucket] += bucket_count
+        row = by_status.setdefault(status, {label: 0 for label, _ in AGING_BUCKETS})
+        row[AGING_BUCKETS[bucket][0]] += bucket_count
+    oldest.sort(key=lambda item: -item['age_days'])
+
+    return {
+        'cycle_time': dict(cycle_time, by_month=by_month),
+        'states': states,
+        'bottleneck': states[0]['status'] if states else None,
+        'aging': {
+            'open': sum(counts),
+            'buckets': [{'label': label, 'count': n} for (label, _), n in zip(AGING_BUCKETS, counts)],
+            'by_status': by_status,
+            'oldest': oldest
+        }
+    }
+
+
+def build_lifecycle(conn, params):
+    """
+    Lifecycle analytics of deviations and CAPA for a report period
+    params are normalized report parameters; the period ends with end_date
+    (or now, if that is earlier) and starts at start_date, if any
+    """
+    # CURRENT_TIMESTAMP has whole seconds; round up so changes made this second count
+    cutoff = (datetime.utcnow() + timedelta(seconds=1)).strftime('%Y-%m-%d %H:%M:%S')
+    if params.get('end_date'):
+        cutoff = min(cutoff, (date.fromisoformat(params['end_date']) + timedelta(days=1)).isoformat())
+    start = params.get('start_date') or '0001-01-01'
+    return {
+        'period': {'from': params.get('start_date'), 'to': params.get('end_date'), 'cutoff': cutoff},
+        **{entity: lifecycle_metrics(conn, entity, start, cutoff) for entity in TERMINAL_STATUSES}
+    }
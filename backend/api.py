@@ -2,11 +2,57 @@
 Flask REST API Server for Pharmaceutical QMS
 Provides endpoints for all database operations
 """
-from flask import Flask, request, jsonify
+import time
+_import_started = time.perf_counter()
+
+from flask import Flask, request, jsonify, Response, g
+from werkzeug.test import EnvironBuilder
 from flask_cors import CORS
 from datetime import datetime, date
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import os
 import json
-from database import get_db_connection
+import sqlite3
+import importlib
+import threading
+import contextvars
+from database import (get_read_connection, run_write, init_database, DEFAULT_QUERY_TIMEOUT,
+                      QueryTimeout, QueryCancelled, set_query_deadline, clear_query_deadline,
+                      socket_disconnected, DEFAULT_SITE, UnknownSite, SiteLocal, list_sites,
+                      current_site, set_site, reset_site, use_site, read_snapshot, in_read_snapshot,
+                      STATUS_HISTORY_TABLES, hold_server_lock)
+import changefeed
+import partitions
+from singleflight import SingleFlight
+from live_monitoring import LiveMonitoringBuffer
+from capa_scheduler import CapaScheduler
+from queries import DEVIATION_QUERY, CAPA_QUERY, QueryError
+from analytics import query_risk_analytics
+from workflow import build_update, bulk_transition, WorkflowError
+from admission import AdmissionController, Overloaded
+
+
+
+class LazyModule:
+    """Module imported on first attribute access, keeping rarely used subsystems off the startup path"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            # import_module holds the import lock, so concurrent first uses are safe
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+archive = LazyModule('archive')
+backup = LazyModule('backup')
+document_store = LazyModule('document_store')
+maintenance = LazyModule('maintenance')
+report_cache = LazyModule('report_cache')
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for frontend access
@@ -20,6 +66,17 @@ def dict_from_row(row):
     return dict(zip(row.keys(), row)) if row else None
 
 
+def content_disposition(disposition, file_name):
+    """
+    Content-Disposition header value for a stored file name
+    Control characters are dropped; the quoted filename is an ASCII fallback and
+    filename* (RFC 6266) carries the exact name
+    """
+    name = ''.join(ch for ch in file_name if ch.isprintable()) or 'download'
+    fallback = ''.join(ch if ch.isascii() and ch not in '"\\' else '_' for ch in name)
+    return f"{disposition}; filename=\"{fallback}\"; filename*=UTF-8''{quote(name, safe='')}"
+
+
 def serialize_datetime(obj):
     """JSON serializer for datetime objects"""
     if isinstance(obj, (datetime, date)):
@@ -27,6 +84,236 @@ def serialize_datetime(obj):
     raise TypeError(f"Type {type(obj)} not serializable")
 
 
+# Coalesces identical concurrent read queries into one execution; a leader's own
+# timeout or disconnect is not passed on to the requests that shared its query
+read_coalescer = SingleFlight(private_errors=(QueryTimeout,))
+
+
+def coalesce_key(name, args=None, exclude=()):
+    """Build a single-flight key from a query name and normalized request args"""
+    if not args:
+        return name
+    # The site is part of every key already (see coalesced_read)
+    exclude = tuple(exclude) + ('site',)
+    parts = sorted(f'{k}={v}' for k in args if k not in exclude for v in args.getlist(k))
+    return f"{name}?{'&'.join(parts)}" if parts else name
+
+
+def coalesced_read(key, query_func, *args):
+    """
+    Run query_func on a current-site read connection, sharing identical in-flight calls
+    Inside a read snapshot the query runs on its own, so it sees the snapshot's state
+    """
+    def run():
+        with get_read_connection() as conn:
+            return query_func(conn, *args)
+    if in_read_snapshot():
+        return run()
+    return read_coalescer.do(f'{current_site()}:{key}', run)
+
+
+def transition_request(entity):
+    """
+    Apply a bulk status transition from a {ids, to_status, updated_by, comment} body
+    All records move in one write transaction, or none do (409)
+    """
+    data = request.json or {}
+    ids = data.get('ids')
+    if not isinstance(ids, list) or not data.get('to_status'):
+        return None, (jsonify({'error': 'ids (list) and to_status are required'}), 400)
+    try:
+        ids = [int(i) for i in ids]
+    except (TypeError, ValueError):
+        return None, (jsonify({'error': 'ids must be integers'}), 400)
+
+    try:
+        changed = run_write(bulk_transition, entity, ids, data['to_status'],
+                            data.get('updated_by', 1), data.get('comment'))
+    except WorkflowError as e:
+        status = 409 if e.details else 400
+        return None, (jsonify({'error': str(e), 'rejected': e.details}), status)
+    return changed, None
+
+
+# ===================================
+# Sites
+# ===================================
+
+@app.before_request
+def select_site():
+    """Route this request to the site named by ?site= or the X-QMS-Site header"""
+    site = request.args.get('site') or request.headers.get('X-QMS-Site') or DEFAULT_SITE
+    try:
+        g.site_token = set_site(site)
+    except UnknownSite as e:
+        return jsonify({'error': str(e), 'sites': list_sites()}), 404
+    return None
+
+
+@app.teardown_request
+def reset_request_site(exc):
+    token = g.pop('site_token', None)
+    if token is not None:
+        reset_site(token)
+
+
+@app.route('/api/sites', methods=['GET'])
+def get_sites():
+    """List the sites served by this API"""
+    return jsonify({'default': DEFAULT_SITE, 'sites': list_sites()})
+
+
+# ===================================
+# Admission Control
+# ===================================
+
+# Endpoint classes by view function; anything not listed is 'standard'
+ENDPOINT_CLASSES = {
+    'health': 'critical',
+    'index': 'critical',
+    'get_user': 'critical',
+    'get_deviation': 'critical',
+    'get_capa': 'critical',
+    'get_singleflight_metrics': 'critical',
+    'get_live_monitoring_metrics': 'critical',
+    'get_admission_metrics': 'critical',
+    'get_sites': 'critical',
+    'get_report_cache_metrics': 'critical',
+    'get_startup_metrics': 'critical',
+    'get_deviations': 'heavy',
+    'get_deviation_stats': 'heavy',
+    'get_capa_records': 'heavy',
+    'get_capa_stats': 'heavy',
+    'get_changes': 'heavy',
+    'get_dashboard_kpis': 'heavy',
+    'get_dashboard_trends': 'heavy',
+    'get_dashboard_summary': 'heavy',
+    'get_lifecycle_analytics': 'heavy',
+    'run_batch': 'heavy',
+    'get_global_deviation_stats': 'heavy',
+    'get_global_capa_stats': 'heavy',
+    'get_global_kpis': 'heavy',
+    'get_global_trends': 'heavy',
+    'get_monitoring_history': 'low',
+    'export_monitoring_history': 'low',
+    'get_audit_history': 'low',
+    'export_audit_history': 'low',
+    'compact_changes': 'low',
+    'get_reports': 'low',
+    'generate_report': 'low',
+    'get_report_output': 'low',
+    'get_maintenance_health': 'low',
+    'run_maintenance_tasks': 'low',
+}
+
+admission = AdmissionController()
+
+
+@app.before_request
+def admit_request():
+    """Reject the request with 503 if its endpoint class is out of capacity"""
+    # Sub-requests of /api/batch run under the batch's own slot
+    if request.endpoint is None or request.method == 'OPTIONS' or request.environ.get('qms.batch'):
+        return None
+    try:
+        g.admission_ticket = admission.acquire(ENDPOINT_CLASSES.get(request.endpoint, 'standard'))
+    except Overloaded as e:
+        response = jsonify({'error': 'Server busy, retry later', 'class': e.class_name, 'reason': e.reason})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    return None
+
+
+@app.after_request
+def release_on_close(response):
+    """Hold the slot until the response body (e.g. a streamed export) is sent"""
+    ticket = g.pop('admission_ticket', None)
+    if ticket is not None:
+        if response.is_streamed:
+            response.call_on_close(ticket.release)
+        else:
+            ticket.release()
+    return response
+
+
+@app.teardown_request
+def release_admission(exc):
+    """Release the slot of a request that failed before producing a response"""
+    ticket = g.pop('admission_ticket', None)
+    if ticket is not None:
+        ticket.release()
+
+
+# ===================================
+# Query Budgets
+# ===================================
+
+# Seconds of read-query time per request by view function; others use DEFAULT_QUERY_TIMEOUT
+QUERY_BUDGETS = {
+    'health': 1.0,
+    'get_user': 2.0,
+    'get_deviation': 2.0,
+    'get_capa': 2.0,
+    'get_capa_by_deviation': 2.0,
+    'get_deviations': 5.0,
+    'get_capa_records': 5.0,
+    'get_deviation_stats': 5.0,
+    'get_capa_stats': 5.0,
+    'get_dashboard_kpis': 5.0,
+    'get_dashboard_trends': 5.0,
+    'get_recent_activity': 5.0,
+    'get_dashboard_summary': 8.0,
+    'get_global_deviation_stats': 8.0,
+    'get_global_capa_stats': 8.0,
+    'get_global_kpis': 8.0,
+    'get_global_trends': 8.0,
+    'get_monitoring_history': 30.0,
+    'get_audit_history': 30.0,
+    'get_maintenance_health': 30.0,
+}
+
+
+@app.before_request
+def start_query_deadline():
+    """Bound the read queries of this request and cancel them if the client goes away"""
+    if request.endpoint is None:
+        return None
+    budget = QUERY_BUDGETS.get(request.endpoint, DEFAULT_QUERY_TIMEOUT)
+    # The asyncio server (aio_server.py) supplies its own disconnect check
+    is_disconnected = (request.environ.get('qms.is_disconnected')
+                       or socket_disconnected(request.environ.get('werkzeug.socket')))
+    g.query_deadline_token = set_query_deadline(budget, is_disconnected, request.endpoint)
+    return None
+
+
+@app.teardown_request
+def end_query_deadline(exc):
+    token = g.pop('query_deadline_token', None)
+    if token is not None:
+        clear_query_deadline(token)
+
+
+@app.errorhandler(QueryTimeout)
+def query_timeout(e):
+    """Aborted queries: 504 when over budget, 499 when the client disconnected"""
+    if isinstance(e, QueryCancelled):
+        return jsonify({'error': str(e)}), 499
+    return jsonify({
+        'error': str(e),
+        'budget_seconds': e.budget,
+        'elapsed_seconds': e.elapsed
+    }), 504
+
+
+@app.route('/api/health', methods=['GET'])
+def health():
+    """Liveness check served from reserved capacity"""
+    with get_read_connection() as conn:
+        conn.execute('SELECT 1').fetchone()
+    return jsonify({'status': 'ok', 'timestamp': datetime.now().isoformat()})
+
+
 # ===================================
 # User Endpoints
 # ===================================
@@ -34,7 +321,7 @@ def serialize_datetime(obj):
 @app.route('/api/users', methods=['GET'])
 def get_users():
     """Get all users"""
-    with get_db_connection() as conn:
+    with get_read_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM users ORDER BY full_name')
         users = [dict_from_row(row) for row in cursor.fetchall()]
@@ -44,7 +331,7 @@ def get_users():
 @app.route('/api/users/<int:user_id>', methods=['GET'])
 def get_user(user_id):
     """Get specific user"""
-    with get_db_connection() as conn:
+    with get_read_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
         user = dict_from_row(cursor.fetchone())
@@ -57,34 +344,35 @@ def get_user(user_id):
 # Deviation Endpoints
 # ===================================
 
+def query_deviations(conn, args=None):
+    """
+    Deviations filtered, projected and sorted by the query layer
+    See queries.DEVIATION_QUERY for the supported arguments
+    """
+    query, params = DEVIATION_QUERY.compile(args or {})
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    return [dict_from_row(row) for row in cursor.fetchall()]
+
+
 @app.route('/api/deviations', methods=['GET'])
 def get_deviations():
-    """Get all deviations with optional filtering"""
-    status = request.args.get('status')
-    category = request.args.get('category')
-    
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        query = 'SELECT * FROM deviations WHERE 1=1'
-        params = []
-        
-        if status:
-            query += ' AND status = ?'
-            params.append(status)
-        if category:
-            query += ' AND category = ?'
-            params.append(category)
-        
-        query += ' ORDER BY created_at DESC'
-        cursor.execute(query, params)
-        deviations = [dict_from_row(row) for row in cursor.fetchall()]
-        return jsonify(deviations)
+    """
+    Get deviations with optional filtering
+    Supports fields=, sort=, limit/offset, status, category, department,
+    product_batch, rpn_min/rpn_max and detected_/created_ from/to dates
+    """
+    try:
+        with get_read_connection() as conn:
+            return jsonify(query_deviations(conn, request.args))
+    except QueryError as e:
+        return jsonify({'error': str(e)}), 400
 
 
 @app.route('/api/deviations/<int:deviation_id>', methods=['GET'])
 def get_deviation(deviation_id):
     """Get specific deviation"""
-    with get_db_connection() as conn:
+    with get_read_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM deviations WHERE id = ?', (deviation_id,))
         deviation = dict_from_row(cursor.fetchone())
@@ -97,10 +385,10 @@ def get_deviation(deviation_id):
 def create_deviation():
     """Create new deviation"""
     data = request.json
-    
-    with get_db_connection() as conn:
+
+    def insert(conn):
         cursor = conn.cursor()
-        
+
         # Calculate RPN
         rpn = data['severity'] * data['occurrence'] * data['detection']
         
@@ -132,49 +420,44 @@ def create_deviation():
             INSERT INTO audit_logs (user_id, action, entity_type, entity_id, changes)
             VALUES (?, ?, ?, ?, ?)
         ''', (data.get('created_by', 1), 'CREATE', 'deviation', deviation_id, json.dumps(data)))
-        
-        return jsonify({'id': deviation_id, 'message': 'Deviation created successfully'}), 201
+        return deviation_id
+
+    deviation_id = run_write(insert)
+    return jsonify({'id': deviation_id, 'message': 'Deviation created successfully'}), 201
 
 
 @app.route('/api/deviations/<int:deviation_id>', methods=['PUT'])
 def update_deviation(deviation_id):
     """Update deviation"""
     data = request.json
-    
-    with get_db_connection() as conn:
+
+    # Recalculate RPN if risk factors changed
+    if 'severity' in data and 'occurrence' in data and 'detection' in data:
+        data['rpn'] = data['severity'] * data['occurrence'] * data['detection']
+
+    try:
+        query, values = build_update('deviation', deviation_id, data)
+    except WorkflowError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def update(conn):
         cursor = conn.cursor()
-        
-        # Recalculate RPN if risk factors changed
-        if 'severity' in data and 'occurrence' in data and 'detection' in data:
-            data['rpn'] = data['severity'] * data['occurrence'] * data['detection']
-        
-        # Build update query dynamically
-        fields = []
-        values = []
-        for key, value in data.items():
-            if key not in ['id', 'created_at', 'created_by']:
-                fields.append(f'{key} = ?')
-                values.append(value)
-        
-        values.append(datetime.now())
-        values.append(deviation_id)
-        
-        query = f"UPDATE deviations SET {', '.join(fields)}, updated_at = ? WHERE id = ?"
         cursor.execute(query, values)
-        
+
         # Log audit
         cursor.execute('''
             INSERT INTO audit_logs (user_id, action, entity_type, entity_id, changes)
             VALUES (?, ?, ?, ?, ?)
         ''', (data.get('updated_by', 1), 'UPDATE', 'deviation', deviation_id, json.dumps(data)))
-        
-        return jsonify({'message': 'Deviation updated successfully'})
+
+    run_write(update)
+    return jsonify({'message': 'Deviation updated successfully'})
 
 
 @app.route('/api/deviations/<int:deviation_id>', methods=['DELETE'])
 def delete_deviation(deviation_id):
     """Delete deviation"""
-    with get_db_connection() as conn:
+    def delete(conn):
         cursor = conn.cursor()
         cursor.execute('DELETE FROM deviations WHERE id = ?', (deviation_id,))
         
@@ -183,77 +466,110 @@ def delete_deviation(deviation_id):
             INSERT INTO audit_logs (user_id, action, entity_type, entity_id)
             VALUES (?, ?, ?, ?)
         ''', (1, 'DELETE', 'deviation', deviation_id))
-        
-        return jsonify({'message': 'Deviation deleted successfully'})
+
+    run_write(delete)
+    return jsonify({'message': 'Deviation deleted successfully'})
+
+
+@app.route('/api/deviations/transition', methods=['POST'])
+def transition_deviations():
+    """Move a list of deviations to a new status in one transaction"""
+    changed, error = transition_request('deviation')
+    if error:
+        return error
+    return jsonify({'updated': len(changed), 'transitions': changed})
+
+
+def query_deviation_stats(conn):
+    """Deviation counts by status, category and risk level"""
+    cursor = conn.cursor()
+    
+    # Total deviations
+    cursor.execute('SELECT COUNT(*) as total FROM deviations')
+    total = cursor.fetchone()[0]
+    
+    # By status
+    cursor.execute('''
+        SELECT status, COUNT(*) as count 
+        FROM deviations 
+        GROUP BY status
+    ''')
+    by_status = {row[0]: row[1] for row in cursor.fetchall()}
+    
+    # By category
+    cursor.execute('''
+        SELECT category, COUNT(*) as count 
+        FROM deviations 
+        GROUP BY category
+    ''')
+    by_category = {row[0]: row[1] for row in cursor.fetchall()}
+    
+    # By risk level
+    cursor.execute('''
+        SELECT 
+            CASE 
+                WHEN rpn >= 200 THEN 'Critical'
+                WHEN rpn >= 100 THEN 'High'
+                WHEN rpn >= 40 THEN 'Medium'
+                ELSE 'Low'
+            END as risk_level,
+            COUNT(*) as count
+        FROM deviations
+        GROUP BY risk_level
+    ''')
+    by_risk = {row[0]: row[1] for row in cursor.fetchall()}
+    
+    return {
+        'total': total,
+        'by_status': by_status,
+        'by_category': by_category,
+        'by_risk': by_risk
+    }
 
 
 @app.route('/api/deviations/stats', methods=['GET'])
 def get_deviation_stats():
     """Get deviation statistics"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Total deviations
-        cursor.execute('SELECT COUNT(*) as total FROM deviations')
-        total = cursor.fetchone()[0]
-        
-        # By status
-        cursor.execute('''
-            SELECT status, COUNT(*) as count 
-            FROM deviations 
-            GROUP BY status
-        ''')
-        by_status = {row[0]: row[1] for row in cursor.fetchall()}
-        
-        # By category
-        cursor.execute('''
-            SELECT category, COUNT(*) as count 
-            FROM deviations 
-            GROUP BY category
-        ''')
-        by_category = {row[0]: row[1] for row in cursor.fetchall()}
-        
-        # By risk level
-        cursor.execute('''
-            SELECT 
-                CASE 
-                    WHEN rpn >= 200 THEN 'Critical'
-                    WHEN rpn >= 100 THEN 'High'
-                    WHEN rpn >= 40 THEN 'Medium'
-                    ELSE 'Low'
-                END as risk_level,
-                COUNT(*) as count
-            FROM deviations
-            GROUP BY risk_level
-        ''')
-        by_risk = {row[0]: row[1] for row in cursor.fetchall()}
-        
-        return jsonify({
-            'total': total,
-            'by_status': by_status,
-            'by_category': by_category,
-            'by_risk': by_risk
-        })
+    return jsonify(coalesced_read('deviation_stats', query_deviation_stats))
 
 
 # ===================================
 # CAPA Endpoints
 # ===================================
 
+# Due-date timers for open CAPA per site; loaded on first use or at startup
+capa_schedulers = SiteLocal(CapaScheduler)
+
+
+def query_capa_records(conn, args=None):
+    """
+    CAPA records filtered, projected and sorted by the query layer
+    See queries.CAPA_QUERY for the supported arguments
+    """
+    query, params = CAPA_QUERY.compile(args or {})
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    return [dict_from_row(row) for row in cursor.fetchall()]
+
+
 @app.route('/api/capa', methods=['GET'])
 def get_capa_records():
-    """Get all CAPA records"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM capa ORDER BY created_at DESC')
-        capas = [dict_from_row(row) for row in cursor.fetchall()]
-        return jsonify(capas)
+    """
+    Get CAPA records with optional filtering
+    Supports fields=, sort=, limit/offset, status, type, responsible_person,
+    deviation_id and target_/completed_/created_ from/to dates
+    """
+    try:
+        with get_read_connection() as conn:
+            return jsonify(query_capa_records(conn, request.args))
+    except QueryError as e:
+        return jsonify({'error': str(e)}), 400
 
 
 @app.route('/api/capa/<int:capa_id>', methods=['GET'])
 def get_capa(capa_id):
     """Get specific CAPA record"""
-    with get_db_connection() as conn:
+    with get_read_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM capa WHERE id = ?', (capa_id,))
         capa = dict_from_row(cursor.fetchone())
@@ -266,11 +582,11 @@ def get_capa(capa_id):
 def create_capa():
     """Create new CAPA record"""
     data = request.json
-    
-    with get_db_connection() as conn:
+
+    def insert(conn):
         cursor = conn.cursor()
         cursor.execute('''
-            INSERT INTO capa 
+            INSERT INTO capa
             (capa_number, deviation_id, type, title, description, root_cause, 
              action_plan, responsible_person, target_date, status, created_by)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
@@ -295,266 +611,697 @@ def create_capa():
             INSERT INTO audit_logs (user_id, action, entity_type, entity_id, changes)
             VALUES (?, ?, ?, ?, ?)
         ''', (data.get('created_by', 1), 'CREATE', 'capa', capa_id, json.dumps(data)))
-        
-        return jsonify({'id': capa_id, 'message': 'CAPA created successfully'}), 201
+
+        cursor.execute('SELECT * FROM capa WHERE id = ?', (capa_id,))
+        return dict_from_row(cursor.fetchone())
+
+    capa = run_write(insert)
+    capa_schedulers.get().track(capa)
+    return jsonify({'id': capa['id'], 'message': 'CAPA created successfully'}), 201
 
 
 @app.route('/api/capa/<int:capa_id>', methods=['PUT'])
 def update_capa(capa_id):
     """Update CAPA record"""
     data = request.json
-    
-    with get_db_connection() as conn:
+
+    try:
+        query, values = build_update('capa', capa_id, data)
+    except WorkflowError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def update(conn):
         cursor = conn.cursor()
-        
-        fields = []
-        values = []
-        for key, value in data.items():
-            if key not in ['id', 'created_at', 'created_by']:
-                fields.append(f'{key} = ?')
-                values.append(value)
-        
-        values.append(datetime.now())
-        values.append(capa_id)
-        
-        query = f"UPDATE capa SET {', '.join(fields)}, updated_at = ? WHERE id = ?"
         cursor.execute(query, values)
-        
+
         # Log audit
         cursor.execute('''
             INSERT INTO audit_logs (user_id, action, entity_type, entity_id, changes)
             VALUES (?, ?, ?, ?, ?)
         ''', (data.get('updated_by', 1), 'UPDATE', 'capa', capa_id, json.dumps(data)))
-        
-        return jsonify({'message': 'CAPA updated successfully'})
+
+        cursor.execute('SELECT * FROM capa WHERE id = ?', (capa_id,))
+        return dict_from_row(cursor.fetchone())
+
+    capa = run_write(update)
+    if capa:
+        capa_schedulers.get().track(capa)
+    return jsonify({'message': 'CAPA updated successfully'})
+
+
+@app.route('/api/capa/transition', methods=['POST'])
+def transition_capa():
+    """Move a list of CAPA records to a new status in one transaction"""
+    changed, error = transition_request('capa')
+    if error:
+        return error
+    with get_read_connection() as conn:
+        ids = [entry['id'] for entry in changed]
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT * FROM capa WHERE id IN ({', '.join('?' * len(ids))})", ids)
+        for row in cursor.fetchall():
+            capa_schedulers.get().track(dict_from_row(row))
+    return jsonify({'updated': len(changed), 'transitions': changed})
+
+
+@app.route('/api/capa/overdue', methods=['GET'])
+def get_overdue_capa():
+    """Get overdue CAPA from the scheduler's overdue index"""
+    return jsonify(capa_schedulers.get().overdue_list())
+
+
+@app.route('/api/capa/due-soon', methods=['GET'])
+def get_due_soon_capa():
+    """Get CAPA whose target date is within the due-soon window"""
+    return jsonify(capa_schedulers.get().due_soon_list())
 
 
 @app.route('/api/capa/by-deviation/<int:deviation_id>', methods=['GET'])
 def get_capa_by_deviation(deviation_id):
     """Get CAPA records for a specific deviation"""
-    with get_db_connection() as conn:
+    with get_read_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM capa WHERE deviation_id = ?', (deviation_id,))
         capas = [dict_from_row(row) for row in cursor.fetchall()]
         return jsonify(capas)
 
 
+def query_capa_stats(conn):
+    """CAPA counts by status and type with the on-time closure trend"""
+    cursor = conn.cursor()
+    
+    # Total CAPA
+    cursor.execute('SELECT COUNT(*) as total FROM capa')
+    total = cursor.fetchone()[0]
+    
+    # By status
+    cursor.execute('''
+        SELECT status, COUNT(*) as count 
+        FROM capa 
+        GROUP BY status
+    ''')
+    by_status = {row[0]: row[1] for row in cursor.fetchall()}
+    
+    # By type
+    cursor.execute('''
+        SELECT type, COUNT(*) as count 
+        FROM capa 
+        GROUP BY type
+    ''')
+    by_type = {row[0]: row[1] for row in cursor.fetchall()}
+    
+    # On-time closure rate by month (last 6 months)
+    cursor.execute('''
+        SELECT 
+            strftime('%Y-%m', target_date) as month,
+            COUNT(*) as total,
+            SUM(CASE WHEN completion_date <= target_date THEN 1 ELSE 0 END) as on_time
+        FROM capa
+        WHERE target_date >= date('now', '-6 months')
+        AND status = 'Closed'
+        GROUP BY month
+        ORDER BY month
+    ''')
+    closure_trend = []
+    for row in cursor.fetchall():
+        month, total_count, on_time_count = row
+        percentage = round((on_time_count / total_count * 100) if total_count > 0 else 0, 1)
+        closure_trend.append({
+            'month': month,
+            'total': total_count,
+            'on_time': on_time_count,
+            'percentage': percentage
+        })
+    
+    return {
+        'total': total,
+        'by_status': by_status,
+        'by_type': by_type,
+        'closure_trend': closure_trend
+    }
+
+
 @app.route('/api/capa/stats', methods=['GET'])
 def get_capa_stats():
     """Get CAPA statistics"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Total CAPA
-        cursor.execute('SELECT COUNT(*) as total FROM capa')
-        total = cursor.fetchone()[0]
-        
-        # By status
-        cursor.execute('''
-            SELECT status, COUNT(*) as count 
-            FROM capa 
-            GROUP BY status
-        ''')
-        by_status = {row[0]: row[1] for row in cursor.fetchall()}
-        
-        # By type
-        cursor.execute('''
-            SELECT type, COUNT(*) as count 
-            FROM capa 
-            GROUP BY type
-        ''')
-        by_type = {row[0]: row[1] for row in cursor.fetchall()}
-        
-        # On-time closure rate by month (last 6 months)
-        cursor.execute('''
-            SELECT 
-                strftime('%Y-%m', target_date) as month,
-                COUNT(*) as total,
-                SUM(CASE WHEN completion_date <= target_date THEN 1 ELSE 0 END) as on_time
-            FROM capa
-            WHERE target_date >= date('now', '-6 months')
-            AND status = 'Closed'
-            GROUP BY month
-            ORDER BY month
-        ''')
-        closure_trend = []
-        for row in cursor.fetchall():
-            month, total_count, on_time_count = row
-            percentage = round((on_time_count / total_count * 100) if total_count > 0 else 0, 1)
-            closure_trend.append({
-                'month': month,
-                'total': total_count,
-                'on_time': on_time_count,
-                'percentage': percentage
-            })
-        
-        return jsonify({
-            'total': total,
-            'by_status': by_status,
-            'by_type': by_type,
-            'closure_trend': closure_trend
-        })
+    return jsonify(coalesced_read('capa_stats', query_capa_stats))
 
 
 # ===================================
 # Monitoring Endpoints
 # ===================================
 
+# Latest readings per sensor and site, warmed from the database and fed by record_monitoring_data
+live_buffers = SiteLocal(LiveMonitoringBuffer)
+
+LIVE_LIMIT = 100
+
+
+def query_monitoring(conn, parameter_type, location=None, before=None, limit=LIVE_LIMIT):
+    """Monitoring readings of one parameter type, newest first"""
+    filters = {'parameter_type': parameter_type}
+    if location:
+        filters['location'] = location
+    return partitions.query_readings(conn, filters=filters, limit=limit, before=before)
+
+
+def live_monitoring_response(parameter_type, location=None):
+    """
+    Serve a live view from the ring buffer, or from SQL for older history
+    (?before=<timestamp>) and whenever the buffer cannot answer exactly
+    """
+    before = request.args.get('before')
+    data = None if before else live_buffers.get().latest(parameter_type, location, LIVE_LIMIT)
+    source = 'ring-buffer'
+    if data is None:
+        source = 'sql'
+        try:
+            with get_read_connection() as conn:
+                data = query_monitoring(conn, parameter_type, location, before)
+        except ValueError:
+            return jsonify({'error': f'Invalid before timestamp: {before!r}'}), 400
+    response = jsonify(data)
+    response.headers['X-QMS-Source'] = source
+    return response
+
+
 @app.route('/api/monitoring/environmental', methods=['GET'])
 def get_environmental_monitoring():
     """Get environmental monitoring data"""
-    location = request.args.get('location')
-    
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        query = "SELECT * FROM monitoring WHERE parameter_type = 'Environmental'"
-        params = []
-        
-        if location:
-            query += ' AND location = ?'
-            params.append(location)
-        
-        query += ' ORDER BY recorded_at DESC LIMIT 100'
-        cursor.execute(query, params)
-        data = [dict_from_row(row) for row in cursor.fetchall()]
-        return jsonify(data)
+    return live_monitoring_response('Environmental', request.args.get('location'))
 
 
 @app.route('/api/monitoring/process', methods=['GET'])
 def get_process_monitoring():
     """Get process monitoring data"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM monitoring 
-            WHERE parameter_type = 'Process'
-            ORDER BY recorded_at DESC 
-            LIMIT 100
-        ''')
-        data = [dict_from_row(row) for row in cursor.fetchall()]
-        return jsonify(data)
+    return live_monitoring_response('Process')
 
 
 @app.route('/api/monitoring/record', methods=['POST'])
 def record_monitoring_data():
     """Record new monitoring measurement"""
     data = request.json
-    
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Determine status based on limits
-        value = data['value']
-        min_limit = data.get('min_limit')
-        max_limit = data.get('max_limit')
-        
-        if min_limit and max_limit:
-            status = 'Normal' if min_limit <= value <= max_limit else 'Out of Spec'
-        else:
-            status = 'Normal'
-        
-        cursor.execute('''
-            INSERT INTO monitoring 
-            (location, parameter_type, parameter_name, value, unit, min_limit, 
-             max_limit, status, alert_level, recorded_by)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            data['location'],
-            data['parameter_type'],
-            data['parameter_name'],
-            value,
-            data.get('unit'),
-            min_limit,
-            max_limit,
-            status,
-            data.get('alert_level', 'None'),
-            data.get('recorded_by', 1)
-        ))
-        
-        return jsonify({'id': cursor.lastrowid, 'status': status}), 201
+
+    # Checked before the write: the live buffer keeps these in typed arrays
+    try:
+        value = float(data['value'])
+        recorded_by = data.get('recorded_by', 1)
+        if recorded_by is not None:
+            recorded_by = int(str(recorded_by))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'value must be a number and recorded_by a user id'}), 400
+
+    # Determine status based on limits
+    min_limit = data.get('min_limit')
+    max_limit = data.get('max_limit')
+
+    if min_limit and max_limit:
+        status = 'Normal' if min_limit <= value <= max_limit else 'Out of Spec'
+    else:
+        status = 'Normal'
+
+    reading = partitions.record_reading({
+        'location': data['location'],
+        'parameter_type': data['parameter_type'],
+        'parameter_name': data['parameter_name'],
+        'value': value,
+        'unit': data.get('unit'),
+        'min_limit': min_limit,
+        'max_limit': max_limit,
+        'status': status,
+        'alert_level': data.get('alert_level', 'None'),
+        'recorded_by': recorded_by
+    })
+    live_buffers.get().append(reading)
+    return jsonify({'id': reading['id'], 'status': status}), 201
+
+
+# ===================================
+# History & Archive Endpoints
+# ===================================
+
+MONITORING_HISTORY_FILTERS = {
+    'location': str,
+    'parameter_type': str,
+    'parameter_name': str,
+    'status': str
+}
+
+AUDIT_HISTORY_FILTERS = {
+    'entity_type': str,
+    'entity_id': int,
+    'action': str,
+    'user_id': int
+}
+
+
+def history_args(allowed_filters):
+    """Parse start/end/limit and equality filters for historical queries"""
+    filters = {}
+    for name, cast in allowed_filters.items():
+        value = request.args.get(name)
+        if value is not None:
+            filters[name] = cast(value)
+    limit = request.args.get('limit', type=int)
+    return request.args.get('start'), request.args.get('end'), filters, limit
+
+
+def history_response(table, allowed_filters):
+    """JSON history spanning the live table and archived segments"""
+    try:
+        start, end, filters, limit = history_args(allowed_filters)
+        rows = archive.query_history(table, start, end, filters, limit or 1000)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(rows)
+
+
+def export_response(table, allowed_filters):
+    """Streamed CSV export spanning the live table and archived segments"""
+    try:
+        start, end, filters, _ = history_args(allowed_filters)
+        chunks = archive.export_history_csv(table, start, end, filters)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return Response(chunks, mimetype='text/csv', headers={
+        'Content-Disposition': f'attachment; filename={table}_export.csv'
+    })
+
+
+@app.route('/api/monitoring/history', methods=['GET'])
+def get_monitoring_history():
+    """Get monitoring readings across live and archived data"""
+    return history_response('monitoring', MONITORING_HISTORY_FILTERS)
+
+
+@app.route('/api/monitoring/export', methods=['GET'])
+def export_monitoring_history():
+    """Export monitoring readings as CSV across live and archived data"""
+    return export_response('monitoring', MONITORING_HISTORY_FILTERS)
+
+
+@app.route('/api/audit-logs/history', methods=['GET'])
+def get_audit_history():
+    """Get audit log entries across live and archived data"""
+    return history_response('audit_logs', AUDIT_HISTORY_FILTERS)
+
+
+@app.route('/api/audit-logs/export', methods=['GET'])
+def export_audit_history():
+    """Export audit log entries as CSV across live and archived data"""
+    return export_response('audit_logs', AUDIT_HISTORY_FILTERS)
+
+
+@app.route('/api/archive/segments', methods=['GET'])
+def get_archive_segments():
+    """List archived segments and their time ranges"""
+    return jsonify(archive.list_segments(request.args.get('table')))
+
+
+# ===================================
+# Backups
+# ===================================
+
+@app.route('/api/backups', methods=['GET'])
+def get_backups():
+    """List database snapshots, newest first"""
+    return jsonify(backup.list_backups())
+
+
+# ===================================
+# Maintenance
+# ===================================
+
+@app.route('/api/maintenance/health', methods=['GET'])
+def get_maintenance_health():
+    """Storage, fragmentation, WAL, statistics age and index advice for the site's database"""
+    return jsonify(maintenance.health_report())
+
+
+@app.route('/api/maintenance/runs', methods=['GET'])
+def get_maintenance_runs():
+    """Recent maintenance runs with their before/after measurements"""
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    return jsonify(maintenance.list_runs(limit, request.args.get('task')))
+
+
+@app.route('/api/maintenance/run', methods=['POST'])
+def run_maintenance_tasks():
+    """Run maintenance tasks now (body: {"tasks": [...]}, default all)"""
+    data = request.get_json(silent=True) or {}
+    try:
+        return jsonify(maintenance.run_maintenance(data.get('tasks')))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+
+# ===================================
+# Change Feed Endpoints
+# ===================================
+
+@app.route('/api/changes', methods=['GET'])
+def get_changes():
+    """
+    Get upserts and tombstones since a change sequence number
+    ?since=<seq>&limit=<n>&entities=deviations,capa
+    """
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', changefeed.DEFAULT_PAGE_SIZE, type=int)
+    entities = request.args.get('entities')
+    entity_types = [e.strip() for e in entities.split(',') if e.strip()] if entities else None
+
+    try:
+        with get_read_connection() as conn:
+            return jsonify(changefeed.fetch_changes(conn, since, limit, entity_types))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/api/changes/compact', methods=['POST'])
+def compact_changes():
+    """Compact the change log, dropping entries older than the retention window"""
+    data = request.get_json(silent=True) or {}
+    result = changefeed.compact_change_log(data.get('retention_days', changefeed.DEFAULT_RETENTION_DAYS))
+    return jsonify(result)
 
 
 # ===================================
 # Dashboard Endpoints
 # ===================================
 
+def query_dashboard_kpis(conn):
+    """Key performance indicator counts"""
+    cursor = conn.cursor()
+    
+    # Total deviations
+    cursor.execute('SELECT COUNT(*) FROM deviations')
+    total_deviations = cursor.fetchone()[0]
+    
+    # Open deviations
+    cursor.execute("SELECT COUNT(*) FROM deviations WHERE status = 'Open'")
+    open_deviations = cursor.fetchone()[0]
+    
+    # Total CAPA
+    cursor.execute('SELECT COUNT(*) FROM capa')
+    total_capa = cursor.fetchone()[0]
+    
+    # Open CAPA
+    cursor.execute("SELECT COUNT(*) FROM capa WHERE status = 'Open'")
+    open_capa = cursor.fetchone()[0]
+    
+    # Active batches
+    cursor.execute("SELECT COUNT(*) FROM batches WHERE status = 'In Progress'")
+    active_batches = cursor.fetchone()[0]
+    
+    # Out of spec monitoring, across the monthly partitions
+    out_of_spec = partitions.count_readings(conn, status='Out of Spec')
+    
+    return {
+        'total_deviations': total_deviations,
+        'open_deviations': open_deviations,
+        'total_capa': total_capa,
+        'open_capa': open_capa,
+        'active_batches': active_batches,
+        'out_of_spec_parameters': out_of_spec
+    }
+
+
 @app.route('/api/dashboard/kpis', methods=['GET'])
 def get_dashboard_kpis():
     """Get key performance indicators for dashboard"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Total deviations
-        cursor.execute('SELECT COUNT(*) FROM deviations')
-        total_deviations = cursor.fetchone()[0]
-        
-        # Open deviations
-        cursor.execute("SELECT COUNT(*) FROM deviations WHERE status = 'Open'")
-        open_deviations = cursor.fetchone()[0]
-        
-        # Total CAPA
-        cursor.execute('SELECT COUNT(*) FROM capa')
-        total_capa = cursor.fetchone()[0]
-        
-        # Open CAPA
-        cursor.execute("SELECT COUNT(*) FROM capa WHERE status = 'Open'")
-        open_capa = cursor.fetchone()[0]
-        
-        # Active batches
-        cursor.execute("SELECT COUNT(*) FROM batches WHERE status = 'In Progress'")
-        active_batches = cursor.fetchone()[0]
-        
-        # Out of spec monitoring
-        cursor.execute("SELECT COUNT(*) FROM monitoring WHERE status = 'Out of Spec'")
-        out_of_spec = cursor.fetchone()[0]
-        
-        return jsonify({
-            'total_deviations': total_deviations,
-            'open_deviations': open_deviations,
-            'total_capa': total_capa,
-            'open_capa': open_capa,
-            'active_batches': active_batches,
-            'out_of_spec_parameters': out_of_spec
-        })
+    return jsonify(coalesced_read('kpis', query_dashboard_kpis))
+
+
+def query_dashboard_trends(conn):
+    """Deviations per month over the last 6 months"""
+    cursor = conn.cursor()
+    
+    # Deviations by month (last 6 months)
+    cursor.execute('''
+        SELECT 
+            strftime('%Y-%m', detected_date) as month,
+            COUNT(*) as count
+        FROM deviations
+        WHERE detected_date >= date('now', '-6 months')
+        GROUP BY month
+        ORDER BY month
+    ''')
+    deviation_trend = [dict_from_row(row) for row in cursor.fetchall()]
+    
+    return {
+        'deviation_trend': deviation_trend
+    }
 
 
 @app.route('/api/dashboard/trends', methods=['GET'])
 def get_dashboard_trends():
     """Get trend data for charts"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Deviations by month (last 6 months)
-        cursor.execute('''
-            SELECT 
-                strftime('%Y-%m', detected_date) as month,
-                COUNT(*) as count
-            FROM deviations
-            WHERE detected_date >= date('now', '-6 months')
-            GROUP BY month
-            ORDER BY month
-        ''')
-        deviation_trend = [dict_from_row(row) for row in cursor.fetchall()]
-        
-        return jsonify({
-            'deviation_trend': deviation_trend
-        })
+    return jsonify(coalesced_read('trends', query_dashboard_trends))
+
+
+def query_recent_activity(conn):
+    """Latest audit log entries with user names"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT a.*, u.full_name as user_name
+        FROM audit_logs a
+        LEFT JOIN users u ON a.user_id = u.id
+        ORDER BY a.timestamp DESC
+        LIMIT 20
+    ''')
+    activities = [dict_from_row(row) for row in cursor.fetchall()]
+    return activities
 
 
 @app.route('/api/dashboard/recent-activity', methods=['GET'])
 def get_recent_activity():
     """Get recent activity log"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT a.*, u.full_name as user_name
-            FROM audit_logs a
-            LEFT JOIN users u ON a.user_id = u.id
-            ORDER BY a.timestamp DESC
-            LIMIT 20
-        ''')
-        activities = [dict_from_row(row) for row in cursor.fetchall()]
-        return jsonify(activities)
+    with get_read_connection() as conn:
+        return jsonify(query_recent_activity(conn))
+
+
+# Widgets available to the composite summary endpoint
+DASHBOARD_WIDGETS = {
+    'kpis': query_dashboard_kpis,
+    'trends': query_dashboard_trends,
+    'recent_activity': query_recent_activity,
+    'deviation_stats': query_deviation_stats,
+    'capa_stats': query_capa_stats,
+    'deviations': query_deviations,
+    'capa': query_capa_records
+}
+
+# Thread pool that runs summary widgets concurrently on their own read connections
+summary_executor = ThreadPoolExecutor(max_workers=len(DASHBOARD_WIDGETS),
+                                      thread_name_prefix='qms-summary')
+
+
+def run_widget(key, query_func, *args):
+    """Run one widget query through the single-flight layer and time it"""
+    started = time.perf_counter()
+    result = coalesced_read(key, query_func, *args)
+    return result, round((time.perf_counter() - started) * 1000, 2)
+
+
+@app.route('/api/dashboard/summary', methods=['GET'])
+def get_dashboard_summary():
+    """
+    Get several dashboard widgets in one round trip
+    ?widgets=kpis,trends,... (default: all); the remaining arguments are passed
+    to the list query layer for the deviations and capa widgets
+    """
+    requested = request.args.get('widgets')
+    names = [w.strip() for w in requested.split(',') if w.strip()] if requested else list(DASHBOARD_WIDGETS)
+    unknown = [name for name in names if name not in DASHBOARD_WIDGETS]
+    if unknown:
+        return jsonify({'error': f"Unknown widgets: {', '.join(unknown)}",
+                        'available': list(DASHBOARD_WIDGETS)}), 400
+
+    started = time.perf_counter()
+    calls = {}
+    for name in names:
+        if name in ('deviations', 'capa'):
+            key = coalesce_key(name, request.args, exclude=('widgets',))
+            calls[name] = (key, DASHBOARD_WIDGETS[name], request.args)
+        else:
+            calls[name] = (name, DASHBOARD_WIDGETS[name])
+
+    widgets = {}
+    timings = {}
+    try:
+        if in_read_snapshot():
+            # A snapshot's connection belongs to this thread, so its widgets run here in turn
+            for name, args in calls.items():
+                widgets[name], timings[name] = run_widget(*args)
+        else:
+            futures = {name: summary_executor.submit(contextvars.copy_context().run, run_widget, *args)
+                       for name, args in calls.items()}
+            for name, future in futures.items():
+                widgets[name], timings[name] = future.result()
+    except QueryError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({
+        'widgets': widgets,
+        'timings_ms': timings,
+        'total_ms': round((time.perf_counter() - started) * 1000, 2)
+    })
+
+
+# ===================================
+# Analytics Endpoints
+# ===================================
+
+@app.route('/api/analytics/risk', methods=['GET'])
+def get_risk_analytics():
+    """
+    Risk heatmap, severity x occurrence x detection matrix and RPN histogram
+    Sliced by ?category=, ?department=, ?from=/?to= (YYYY-MM); served from risk_cube
+    """
+    try:
+        return jsonify(coalesced_read(coalesce_key('risk_analytics', request.args),
+                                      query_risk_analytics, request.args))
+    except QueryError as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/api/analytics/lifecycle', methods=['GET'])
+def get_lifecycle_analytics():
+    """
+    Cycle times, time in state, bottleneck states and aging of deviations and CAPA
+    For ?period= (as in reports) or ?from=/?to= (YYYY-MM-DD); ?entity=deviation|capa
+    limits the output. Served from the report cache until the source data changes.
+    """
+    entity = request.args.get('entity')
+    if entity and entity not in STATUS_HISTORY_TABLES:
+        return jsonify({'error': f"entity must be one of {', '.join(STATUS_HISTORY_TABLES)}"}), 400
+    parameters = {'period': request.args.get('period'),
+                  'startDate': request.args.get('from'), 'endDate': request.args.get('to')}
+    try:
+        output, info = report_cache.get_report('Lifecycle', parameters)
+    except report_cache.ReportError as e:
+        return jsonify({'error': str(e)}), 400
+    if entity:
+        output = {'period': output['period'], entity: output[entity]}
+    return jsonify(dict(output, cached=info['cached'], data_version=info['data_version']))
+
+
+# ===================================
+# Cross-Site Endpoints
+# ===================================
+
+# Thread pool fanning cross-site queries out to the per-site databases
+site_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='qms-sites')
+
+
+def sum_counts(parts):
+    """Add up {key: count} mappings"""
+    merged = {}
+    for part in parts:
+        for key, count in part.items():
+            merged[key] = merged.get(key, 0) + (count or 0)
+    return merged
+
+
+def sum_by_month(rows, fields):
+    """Add up the given fields of [{'month': ..., ...}] lists, ordered by month"""
+    months = {}
+    for row in rows:
+        merged = months.setdefault(row['month'], dict.fromkeys(fields, 0))
+        for field in fields:
+            merged[field] += row[field] or 0
+    return [dict(month=month, **months[month]) for month in sorted(months, key=str)]
+
+
+def merge_deviation_stats(parts):
+    return {
+        'total': sum(p['total'] for p in parts),
+        'by_status': sum_counts(p['by_status'] for p in parts),
+        'by_category': sum_counts(p['by_category'] for p in parts),
+        'by_risk': sum_counts(p['by_risk'] for p in parts)
+    }
+
+
+def merge_capa_stats(parts):
+    closure_trend = sum_by_month([row for p in parts for row in p['closure_trend']], ('total', 'on_time'))
+    for row in closure_trend:
+        row['percentage'] = round(row['on_time'] / row['total'] * 100 if row['total'] else 0, 1)
+    return {
+        'total': sum(p['total'] for p in parts),
+        'by_status': sum_counts(p['by_status'] for p in parts),
+        'by_type': sum_counts(p['by_type'] for p in parts),
+        'closure_trend': closure_trend
+    }
+
+
+def merge_trends(parts):
+    return {'deviation_trend': sum_by_month([row for p in parts for row in p['deviation_trend']],
+                                            ('count',))}
+
+
+def run_on_site(site, key, query_func):
+    """Run one per-site query of a fan-out and time it"""
+    with use_site(site):
+        return run_widget(key, query_func)
+
+
+def fan_out(key, query_func, merge):
+    """
+    Run query_func on every site (or ?sites=a,b) concurrently and merge the results
+    Sites whose query fails are reported under 'errors' and left out of 'merged'.
+    """
+    requested = request.args.get('sites')
+    sites = [s.strip() for s in requested.split(',') if s.strip()] if requested else list_sites()
+    unknown = [site for site in sites if site not in list_sites()]
+    if unknown:
+        return jsonify({'error': f"Unknown sites: {', '.join(unknown)}", 'sites': list_sites()}), 404
+
+    started = time.perf_counter()
+    futures = {site: site_executor.submit(contextvars.copy_context().run, run_on_site, site, key, query_func)
+               for site in sites}
+    by_site = {}
+    timings = {}
+    errors = {}
+    for site, future in futures.items():
+        try:
+            by_site[site], timings[site] = future.result()
+        except (QueryTimeout, sqlite3.Error) as e:
+            errors[site] = str(e)
+    if not by_site and errors:
+        return jsonify({'error': 'No site could be queried', 'errors': errors}), 503
+
+    return jsonify({
+        'sites': sites,
+        'merged': merge(list(by_site.values())),
+        'by_site': by_site,
+        'errors': errors,
+        'timings_ms': timings,
+        'total_ms': round((time.perf_counter() - started) * 1000, 2)
+    })
+
+
+@app.route('/api/global/deviations/stats', methods=['GET'])
+def get_global_deviation_stats():
+    """Deviation statistics summed over all sites (?sites= to choose)"""
+    return fan_out('deviation_stats', query_deviation_stats, merge_deviation_stats)
+
+
+@app.route('/api/global/capa/stats', methods=['GET'])
+def get_global_capa_stats():
+    """CAPA statistics summed over all sites, with on-time rates recomputed from the totals"""
+    return fan_out('capa_stats', query_capa_stats, merge_capa_stats)
+
+
+@app.route('/api/global/dashboard/kpis', methods=['GET'])
+def get_global_kpis():
+    """Dashboard KPIs summed over all sites"""
+    return fan_out('kpis', query_dashboard_kpis, sum_counts)
+
+
+@app.route('/api/global/dashboard/trends', methods=['GET'])
+def get_global_trends():
+    """Monthly deviation trend summed over all sites"""
+    return fan_out('trends', query_dashboard_trends, merge_trends)
 
 
 # ===================================
@@ -564,7 +1311,7 @@ def get_recent_activity():
 @app.route('/api/reports', methods=['GET'])
 def get_reports():
     """Get all reports"""
-    with get_db_connection() as conn:
+    with get_read_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('''
             SELECT r.*, u.full_name as generated_by_name
@@ -578,26 +1325,58 @@ def get_reports():
 
 @app.route('/api/reports/generate', methods=['POST'])
 def generate_report():
-    """Generate new report"""
+    """
+    Generate new report
+    The output is served from the report cache when the same report type and
+    normalized parameters were built before and the source data is unchanged
+    """
     data = request.json
-    
-    with get_db_connection() as conn:
+    try:
+        parameters = report_cache.decode_parameters(data.get('parameters'))
+        output, info = report_cache.get_report(data['report_type'], parameters)
+    except report_cache.ReportError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def insert(conn):
         cursor = conn.cursor()
         cursor.execute('''
-            INSERT INTO reports 
+            INSERT INTO reports
             (report_type, title, description, parameters, file_format, generated_by)
             VALUES (?, ?, ?, ?, ?, ?)
         ''', (
             data['report_type'],
             data['title'],
             data.get('description'),
-            json.dumps(data.get('parameters', {})),
+            json.dumps(parameters),
             data.get('file_format', 'PDF'),
             data.get('generated_by', 1)
         ))
-        
-        report_id = cursor.lastrowid
-        return jsonify({'id': report_id, 'message': 'Report generated successfully'}), 201
+        return cursor.lastrowid
+
+    report_id = run_write(insert)
+    return jsonify({
+        'id': report_id,
+        'message': 'Report generated successfully',
+        'cached': info['cached'],
+        'cache_key': info['cache_key'],
+        'output': output
+    }), 201
+
+
+@app.route('/api/reports/<int:report_id>/output', methods=['GET'])
+def get_report_output(report_id):
+    """Get a report's output, rebuilt only if its source data changed"""
+    with get_read_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT report_type, parameters FROM reports WHERE id = ?', (report_id,))
+        report = cursor.fetchone()
+    if not report:
+        return jsonify({'error': 'Report not found'}), 404
+    try:
+        output, info = report_cache.get_report(report['report_type'], report['parameters'])
+    except report_cache.ReportError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'id': report_id, 'output': output, **info})
 
 
 # ===================================
@@ -607,13 +1386,291 @@ def generate_report():
 @app.route('/api/batches', methods=['GET'])
 def get_batches():
     """Get all batches"""
-    with get_db_connection() as conn:
+    with get_read_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM batches ORDER BY start_date DESC')
         batches = [dict_from_row(row) for row in cursor.fetchall()]
         return jsonify(batches)
 
 
+# ===================================
+# Document Endpoints
+# ===================================
+
+@app.route('/api/documents', methods=['GET'])
+def get_documents():
+    """Get documents, optionally filtered by ?status= and ?document_type="""
+    query = 'SELECT * FROM documents WHERE 1=1'
+    params = []
+    for column in ('status', 'document_type'):
+        if request.args.get(column):
+            query += f' AND {column} = ?'
+            params.append(request.args[column])
+    query += ' ORDER BY document_number'
+    with get_read_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        return jsonify([dict_from_row(row) for row in cursor.fetchall()])
+
+
+@app.route('/api/documents/<int:document_id>', methods=['GET'])
+def get_document(document_id):
+    """Get a document with its revision history"""
+    with get_read_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM documents WHERE id = ?', (document_id,))
+        document = dict_from_row(cursor.fetchone())
+        if not document:
+            return jsonify({'error': 'Document not found'}), 404
+        document['revisions'] = document_store.list_revisions(conn, document_id)
+        return jsonify(document)
+
+
+@app.route('/api/documents', methods=['POST'])
+def create_document():
+    """Create a document record; content is uploaded as revisions"""
+    data = request.json
+    missing = [k for k in ('document_number', 'title', 'document_type') if not data.get(k)]
+    if missing:
+        return jsonify({'error': f"Missing fields: {', '.join(missing)}"}), 400
+
+    def insert(conn):
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO documents
+            (document_number, title, document_type, version, status, effective_date,
+             review_date, created_by)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            data['document_number'],
+            data['title'],
+            data['document_type'],
+            data.get('version', '0'),
+            data.get('status', 'Draft'),
+            data.get('effective_date'),
+            data.get('review_date'),
+            data.get('created_by', 1)
+        ))
+        document_id = cursor.lastrowid
+
+        # Log audit
+        cursor.execute('''
+            INSERT INTO audit_logs (user_id, action, entity_type, entity_id, changes)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (data.get('created_by', 1), 'CREATE', 'document', document_id, json.dumps(data)))
+        return document_id
+
+    try:
+        document_id = run_write(insert)
+    except sqlite3.IntegrityError:
+        return jsonify({'error': 'Document number already exists'}), 409
+    return jsonify({'id': document_id, 'message': 'Document created successfully'}), 201
+
+
+@app.route('/api/documents/<int:document_id>/revisions', methods=['POST'])
+def upload_document_revision(document_id):
+    """
+    Upload a revision: ?version= is required, ?file_name= and ?uploaded_by= optional
+    The body is either the raw file or a multipart form with a 'file' field
+    """
+    version = request.args.get('version')
+    if not version:
+        return jsonify({'error': 'version is required'}), 400
+
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    file_name = request.args.get('file_name') or (upload.filename if upload else None)
+    mime_type = (upload.mimetype if upload else request.mimetype) or 'application/octet-stream'
+    try:
+        revision = document_store.add_revision(
+            document_id, version, stream, file_name, mime_type,
+            request.args.get('uploaded_by', 1, type=int)
+        )
+    except document_store.DocumentNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except document_store.DocumentError as e:
+        return jsonify({'error': str(e)}), 409
+    return jsonify(revision), 201
+
+
+@app.route('/api/documents/<int:document_id>/content', methods=['GET'])
+def download_document(document_id):
+    """
+    Stream a revision's content (?version=, default latest)
+    Supports single byte ranges (206) and If-None-Match on the SHA-256 ETag
+    """
+    with get_read_connection() as conn:
+        try:
+            revision = document_store.get_revision(conn, document_id, request.args.get('version'))
+        except document_store.DocumentNotFound as e:
+            return jsonify({'error': str(e)}), 404
+
+    etag = f'"{revision["sha256"]}"'
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Content-Disposition': content_disposition('inline', revision['file_name'] or revision['sha256'])
+    }
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headers=headers)
+
+    size = revision['byte_size']
+    try:
+        byte_range = document_store.parse_range(request.headers.get('Range'), size)
+    except document_store.RangeNotSatisfiable:
+        headers['Content-Range'] = f'bytes */{size}'
+        return Response(status=416, headers=headers)
+
+    status = 200
+    start, end = 0, size - 1
+    if byte_range:
+        start, end = byte_range
+        status = 206
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    headers['Content-Length'] = str(end - start + 1 if size else 0)
+    return Response(document_store.iter_content(revision, start, end), status=status,
+                    mimetype=revision['mime_type'] or 'application/octet-stream',
+                    headers=headers, direct_passthrough=True)
+
+
+# ===================================
+# Batch Requests
+# ===================================
+
+# Largest number of sub-requests accepted by /api/batch
+MAX_BATCH_REQUESTS = 50
+
+BATCH_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+
+# Thread pool running the consecutive reads of a batch concurrently
+batch_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='qms-batch')
+
+
+def batch_error(index, message):
+    return jsonify({'error': message, 'index': index}), 400
+
+
+def dispatch_subrequest(sub, environ_base, headers):
+    """Run one sub-request through the routing table; returns {id, status, body}"""
+    started = time.perf_counter()
+    body = sub.get('body')
+    builder = EnvironBuilder(path=sub['path'], method=sub.get('method', 'GET').upper(),
+                             headers={**headers, **(sub.get('headers') or {})},
+                             json=body if body is not None else None, environ_base=environ_base)
+    # A fresh app context gives the sub-request its own g (site, deadline tokens)
+    with app.app_context(), app.request_context(builder.get_environ()):
+        try:
+            response = app.full_dispatch_request()
+        except Exception as e:
+            print(f"Batch sub-request {sub['path']} failed: {e!r}")
+            response = jsonify({'error': 'Internal server error'})
+            response.status_code = 500
+    try:
+        content = response.get_json(silent=True) if response.is_json else response.get_data(as_text=True)
+    finally:
+        response.close()
+    return {
+        'id': sub.get('id'),
+        'status': response.status_code,
+        'body': content,
+        'duration_ms': round((time.perf_counter() - started) * 1000, 2)
+    }
+
+
+@app.route('/api/batch', methods=['POST'])
+def run_batch():
+    """
+    Run several API requests in one round trip
+    Body: {"requests": [{"id", "method", "path", "body", "headers"}, ...], "snapshot": false}
+
+    Consecutive GETs run concurrently. Any other method waits for everything
+    before it and holds back everything after it, so writes keep their order
+    and later reads see them. With "snapshot": true each run of GETs shares
+    one read transaction instead, executed in order on that connection.
+    Sub-requests inherit the batch's site unless they name their own.
+    """
+    data = request.get_json(silent=True)
+    subs = data.get('requests') if isinstance(data, dict) else data
+    snapshot = bool(data.get('snapshot')) if isinstance(data, dict) else False
+    if not isinstance(subs, list) or not subs:
+        return jsonify({'error': 'Expected a non-empty list of requests'}), 400
+    if len(subs) > MAX_BATCH_REQUESTS:
+        return jsonify({'error': f'At most {MAX_BATCH_REQUESTS} requests per batch'}), 400
+    for index, sub in enumerate(subs):
+        if not isinstance(sub, dict) or not isinstance(sub.get('path'), str):
+            return batch_error(index, 'Each request needs a path')
+        if not sub['path'].startswith('/api/') or sub['path'].split('?')[0].rstrip('/') == '/api/batch':
+            return batch_error(index, 'Paths must be API endpoints other than /api/batch')
+        if str(sub.get('method', 'GET')).upper() not in BATCH_METHODS:
+            return batch_error(index, f"Method must be one of {', '.join(BATCH_METHODS)}")
+
+    environ_base = {
+        'REMOTE_ADDR': request.remote_addr,
+        'qms.batch': True,
+        'qms.is_disconnected': (request.environ.get('qms.is_disconnected')
+                                or socket_disconnected(request.environ.get('werkzeug.socket')))
+    }
+    headers = {'X-QMS-Site': current_site()}
+    dispatch = lambda sub: dispatch_subrequest(sub, environ_base, headers)
+
+    started = time.perf_counter()
+    responses = []
+    reads = []
+    for sub in subs + [None]:
+        if sub is not None and str(sub.get('method', 'GET')).upper() == 'GET':
+            reads.append(sub)
+            continue
+        if snapshot and reads:
+            with read_snapshot():
+                responses.extend(dispatch(read) for read in reads)
+        elif reads:
+            futures = [batch_executor.submit(contextvars.copy_context().run, dispatch, read)
+                       for read in reads]
+            responses.extend(future.result() for future in futures)
+        reads = []
+        if sub is not None:
+            responses.append(dispatch(sub))
+
+    return jsonify({
+        'responses': responses,
+        'total_ms': round((time.perf_counter() - started) * 1000, 2)
+    })
+
+
+# ===================================
+# Metrics Endpoints
+# ===================================
+
+@app.route('/api/metrics/singleflight', methods=['GET'])
+def get_singleflight_metrics():
+    """Get per-key request coalescing metrics"""
+    return jsonify(read_coalescer.metrics())
+
+
+@app.route('/api/metrics/live-monitoring', methods=['GET'])
+def get_live_monitoring_metrics():
+    """Get ring buffer size, memory use and hit/fallback counters"""
+    return jsonify(live_buffers.get().metrics())
+
+
+@app.route('/api/metrics/report-cache', methods=['GET'])
+def get_report_cache_metrics():
+    """Get report cache size and hit/miss/eviction counters"""
+    return jsonify(report_cache.cache_metrics())
+
+
+@app.route('/api/metrics/startup', methods=['GET'])
+def get_startup_metrics():
+    """Import, schema and warm-up timings of the last start"""
+    return jsonify(startup_report)
+
+
+@app.route('/api/metrics/admission', methods=['GET'])
+def get_admission_metrics():
+    """Per-class admission limits, rejections and queue-time statistics"""
+    return jsonify(admission.metrics())
+
+
 # ===================================
 # Server Startup
 # ===================================
@@ -630,12 +1687,101 @@ def index():
             'capa': '/api/capa',
             'monitoring': '/api/monitoring',
             'dashboard': '/api/dashboard',
+            'sites': '/api/sites',
+            'global': '/api/global',
+            'analytics': '/api/analytics/risk',
+            'lifecycle': '/api/analytics/lifecycle',
             'reports': '/api/reports',
-            'batches': '/api/batches'
+            'batches': '/api/batches',
+            'documents': '/api/documents',
+            'archive': '/api/archive/segments',
+            'backups': '/api/backups',
+            'maintenance': '/api/maintenance/health',
+            'changes': '/api/changes',
+            'health': '/api/health',
+            'batch': '/api/batch',
+            'metrics': '/api/metrics'
         }
     })
 
 
+# Startup phase timings in milliseconds, completed by start_services()
+startup_report = {'import_ms': round((time.perf_counter() - _import_started) * 1000, 1), 'sites': {}}
+
+
+# Seconds after startup before the backup and maintenance threads start; their
+# modules are imported then, off the startup path
+DEFERRED_START_SECONDS = float(os.environ.get('QMS_DEFERRED_START_SECONDS', 60))
+
+# Run `python api.py` with the debugger and reloader; 0 serves without them
+DEBUG = os.environ.get('QMS_DEBUG', '1') != '0'
+
+_services_lock = threading.Lock()
+
+
+def elapsed_ms(since):
+    return round((time.perf_counter() - since) * 1000, 1)
+
+
+def start_deferred(name, start):
+    """Call start() in the current context after DEFERRED_START_SECONDS on a timer thread"""
+    def run():
+        try:
+            start()
+        except Exception as e:
+            print(f"Starting {name} failed: {e}")
+
+    timer = threading.Timer(DEFERRED_START_SECONDS, contextvars.copy_context().run, args=(run,))
+    timer.name = f'qms-start-{name}'
+    timer.daemon = True
+    timer.start()
+
+
+def start_services():
+    """
+    Bring every site's schema up to date, warm its caches and start its background threads
+    Runs once per process; every server entry point (api.py, aio_server.py, wsgi.py) calls it
+    """
+    with _services_lock:
+        if 'ready_ms' not in startup_report:
+            _start_services()
+
+
+def _start_services():
+    for site in list_sites():
+        with use_site(site):
+            started = time.perf_counter()
+            hold_server_lock()
+            schema = init_database()
+            partitions.count_partitions()
+            schema_ms = elapsed_ms(started)
+            started = time.perf_counter()
+            live_buffers.get().warm()
+            capa_schedulers.get().start()
+            warm_up_ms = elapsed_ms(started)
+            started = time.perf_counter()
+            changefeed.start_compaction_thread()
+            start_deferred('backup', lambda: backup.start_backup_thread())
+            startup_report['sites'][site] = {
+                'schema_ms': schema_ms,
+                'schema_version': schema['version'],
+                'migrations_applied': schema['applied'],
+                'warm_up_ms': warm_up_ms,
+                'threads_ms': elapsed_ms(started)
+            }
+    # One maintenance thread takes care of every site
+    start_deferred('maintenance', lambda: maintenance.start_maintenance_thread(admission.activity))
+    startup_report['ready_ms'] = elapsed_ms(_import_started)
+
+    print(f"Startup: imports {startup_report['import_ms']} ms")
+    for site, phases in startup_report['sites'].items():
+        migrations = ', '.join(map(str, phases['migrations_applied'])) or 'none'
+        print(f"  site {site}: schema {phases['schema_ms']} ms (v{phases['schema_version']}, "
+              f"migrations applied: {migrations}), warm-up {phases['warm_up_ms']} ms, "
+              f"background threads {phases['threads_ms']} ms")
+    print(f"Ready after {startup_report['ready_ms']} ms")
+
+
 if __name__ == '__main__':
     print("=" * 60)
     print("Pharmaceutical QMS API Server")
@@ -643,4 +1789,8 @@ if __name__ == '__main__':
     print("Server starting on http://localhost:5001")
     print("API Documentation: http://localhost:5001")
     print("=" * 60)
-    app.run(debug=True, host='0.0.0.0', port=5001)
+    # The debug reloader runs this block in a file-watching parent and again in the
+    # serving child; only the serving process needs databases and background threads
+    if not DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_services()
+    app.run(debug=DEBUG, host='0.0.0.0', port=5001)
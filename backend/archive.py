@@ -0,0 +1,464 @@
+"""
+Tiered archival for monitoring and audit data
+Moves rows older than a configurable horizon out of the live tables into
+immutable, compressed, columnar segment files with a min/max time index
+"""
+import os
+import io
+import csv
+import json
+import mmap
+import zlib
+import struct
+import secrets
+from datetime import datetime, timedelta
+from database import (get_read_connection, run_write, init_database, record_removal, site_dir, set_site,
+                      use_site, current_site, DEFAULT_SITE)
+import partitions
+
+# Directory holding the segment files (other sites use a subdirectory)
+ARCHIVE_DIR = os.path.join(os.path.dirname(__file__), 'archive')
+
+# Rows older than this many days are moved out of the live tables
+DEFAULT_HORIZON_DAYS = int(os.environ.get('QMS_ARCHIVE_HORIZON_DAYS', 365))
+
+# Maximum number of rows written to a single segment
+SEGMENT_ROWS = 50000
+
+# Archivable tables and the timestamp column used for the time index
+ARCHIVABLE_TABLES = {
+    'monitoring': 'recorded_at',
+    'audit_logs': 'timestamp'
+}
+
+SEGMENT_MAGIC = b'QMSSEG01'
+_HEADER_LEN = struct.Struct('<I')
+
+
+# ===================================
+# Segment Files
+# ===================================
+
+def write_segment(path, table, columns, rows, ts_column):
+    """
+    Write rows to an immutable columnar segment file
+
+    Layout: magic, header length, JSON header, then one zlib-compressed
+    JSON array per column. The header records each column's offset so a
+    reader only decompresses the columns it needs.
+    """
+    ts_index = columns.index(ts_column)
+    blobs = []
+    for i, name in enumerate(columns):
+        values = [row[i] for row in rows]
+        blobs.append(zlib.compress(json.dumps(values, separators=(',', ':')).encode('utf-8'), 6))
+
+    timestamps = [row[ts_index] for row in rows]
+    header = {
+        'table': table,
+        'ts_column': ts_column,
+        'row_count': len(rows),
+        'min_ts': min(timestamps),
+        'max_ts': max(timestamps),
+        'columns': []
+    }
+    offset = 0
+    for name, blob in zip(columns, blobs):
+        header['columns'].append({'name': name, 'offset': offset, 'length': len(blob)})
+        offset += len(blob)
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(SEGMENT_MAGIC)
+        f.write(_HEADER_LEN.pack(len(header_bytes)))
+        f.write(header_bytes)
+        for blob in blobs:
+            f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    os.chmod(path, 0o444)
+    return header
+
+
+class Segment:
+    """
+    Read-only view of a segment file through a memory map
+
+    Column blobs are handed to zlib as memoryview slices of the map, so the
+    compressed data is never copied into Python bytes objects.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+        magic_end = len(SEGMENT_MAGIC)
+        if self._view[:magic_end] != SEGMENT_MAGIC:
+            self.close()
+            raise ValueError(f'Not a QMS archive segment: {path}')
+        (header_len,) = _HEADER_LEN.unpack_from(self._view, magic_end)
+        header_start = magic_end + _HEADER_LEN.size
+        self.header = json.loads(bytes(self._view[header_start:header_start + header_len]))
+        self._data_start = header_start + header_len
+        self._columns = {c['name']: c for c in self.header['columns']}
+
+    @property
+    def column_names(self):
+        return [c['name'] for c in self.header['columns']]
+
+    def column(self, name):
+        """Decompress and return a single column as a list"""
+        meta = self._columns[name]
+        start = self._data_start + meta['offset']
+        return json.loads(zlib.decompress(self._view[start:start + meta['length']]))
+
+    def rows(self, start=None, end=None, filters=None):
+        """
+        Return matching rows as dictionaries
+
+        The timestamp and filter columns are decoded first; the remaining
+        columns are only decompressed when at least one row matches.
+        """
+        ts_values = self.column(self.header['ts_column'])
+        selected = [i for i, ts in enumerate(ts_values)
+                    if (start is None or ts >= start) and (end is None or ts <= end)]
+
+        for name, value in (filters or {}).items():
+            if not selected:
+                break
+            column = self.column(name)
+            selected = [i for i in selected if column[i] == value]
+
+        if not selected:
+            return []
+
+        data = {name: self.column(name) for name in self.column_names}
+        return [{name: data[name][i] for name in self.column_names} for i in selected]
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ===================================
+# Archival
+# ===================================
+
+def _check_table(table):
+    if table not in ARCHIVABLE_TABLES:
+        raise ValueError(f'Table {table} is not archivable')
+    return ARCHIVABLE_TABLES[table]
+
+
+def archive_table(table, horizon_days=DEFAULT_HORIZON_DAYS):
+    """
+    Move rows older than the horizon into segment files
+
+    Each segment is written and fsynced before its index row is inserted and
+    the source rows are deleted in the same transaction, so a crash never
+    loses data. Monitoring partitions are archived whole once their month is
+    entirely past the horizon, and then dropped as files.
+    """
+    ts_column = _check_table(table)
+    cutoff = (datetime.utcnow() - timedelta(days=horizon_days)).strftime('%Y-%m-%d %H:%M:%S')
+    os.makedirs(site_dir(ARCHIVE_DIR), exist_ok=True)
+
+    archived = 0
+    segments = []
+    while True:
+        with get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT * FROM {table}
+                WHERE {ts_column} < ?
+                ORDER BY {ts_column}, id
+                LIMIT ?
+            ''', (cutoff, SEGMENT_ROWS))
+            rows = cursor.fetchall()
+        if not rows:
+            break
+
+        columns = list(rows[0].keys())
+        file_name, path = _new_segment(table)
+        header = write_segment(path, table, columns, [tuple(row) for row in rows], ts_column)
+        ids = [row['id'] for row in rows]
+
+        def commit_segment(conn):
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO archive_segments
+                (table_name, file_name, row_count, min_ts, max_ts, min_id, max_id, byte_size)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (table, file_name, header['row_count'], header['min_ts'], header['max_ts'],
+                  min(ids), max(ids), os.path.getsize(path)))
+            cursor.executemany(f'DELETE FROM {table} WHERE id = ?', [(i,) for i in ids])
+            record_removal(conn, table)
+
+        try:
+            run_write(commit_segment)
+        except Exception:
+            _remove_segment(path)
+            raise
+
+        archived += len(rows)
+        segments.append(file_name)
+
+    if table == 'monitoring':
+        for month in _expired_months(cutoff):
+            rows, month_segments = _archive_partition(month, ts_column)
+            archived += rows
+            segments.extend(month_segments)
+        partitions.remove_orphans(partitions.month_of(cutoff))
+
+    return {'table': table, 'cutoff': cutoff, 'archived_rows': archived, 'segments': segments}
+
+
+def _expired_months(cutoff):
+    """Partition months that end before the cutoff"""
+    with get_read_connection() as conn:
+        return [m for m in partitions.list_months(conn) if f'{partitions.next_month(m)}-01' <= cutoff]
+
+
+def _new_segment(table):
+    file_name = f'{table}-{datetime.utcnow():%Y%m%d%H%M%S}-{secrets.token_hex(4)}.qseg'
+    return file_name, os.path.join(site_dir(ARCHIVE_DIR), file_name)
+
+
+def _remove_segment(path):
+    os.chmod(path, 0o644)
+    os.remove(path)
+
+
+def _archive_partition(month, ts_column):
+    """
+    Write a month's partition to segment files, then index them and take the
+    month out of the catalog in one transaction before deleting its file
+    """
+    written = []
+    rows_total = 0
+    try:
+        with get_read_connection(partitions.partition_path(month)) as source:
+            last = ('', 0)
+            while True:
+                rows = source.execute(f'''
+                    SELECT * FROM monitoring
+                    WHERE ({ts_column}, id) > (?, ?)
+                    ORDER BY {ts_column}, id
+                    LIMIT ?
+                ''', (*last, SEGMENT_ROWS)).fetchall()
+                if not rows:
+                    break
+                file_name, path = _new_segment('monitoring')
+                header = write_segment(path, 'monitoring', list(rows[0].keys()),
+                                       [tuple(row) for row in rows], ts_column)
+                ids = [row['id'] for row in rows]
+                written.append((file_name, path, header, min(ids), max(ids)))
+                rows_total += len(rows)
+                last = (rows[-1][ts_column], rows[-1]['id'])
+
+        def index_segments(conn):
+            conn.executemany('''
+                INSERT INTO archive_segments
+                (table_name, file_name, row_count, min_ts, max_ts, min_id, max_id, byte_size)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [('monitoring', file_name, header['row_count'], header['min_ts'], header['max_ts'],
+                   min_id, max_id, os.path.getsize(path))
+                  for file_name, path, header, min_id, max_id in written])
+
+        partitions.uncatalog(month, on_drop=index_segments)
+    except Exception:
+        for _, path, _, _, _ in written:
+            _remove_segment(path)
+        raise
+    # A file left behind here is removed as an orphan on the next run
+    partitions.remove_files(month)
+    return rows_total, [file_name for file_name, _, _, _, _ in written]
+
+
+def list_segments(table=None):
+    """List archive segments from the time index"""
+    with get_read_connection() as conn:
+        cursor = conn.cursor()
+        query = 'SELECT * FROM archive_segments'
+        params = []
+        if table:
+            query += ' WHERE table_name = ?'
+            params.append(table)
+        query += ' ORDER BY table_name, min_ts'
+        cursor.execute(query, params)
+        return [dict(row) for row in cursor.fetchall()]
+
+
+# ===================================
+# Historical Queries
+# ===================================
+
+def _check_filters(cursor, table, filters):
+    """Reject filter columns that do not exist on the table"""
+    columns = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})')]
+    for name in filters:
+        if name not in columns:
+            raise ValueError(f'Unknown filter column: {name}')
+    return columns
+
+
+def _live_query(table, ts_column, start, end, filters, descending):
+    """Build the SQL for the live part of a historical query"""
+    direction = 'DESC' if descending else 'ASC'
+    query = f'SELECT * FROM {table} WHERE 1=1'
+    params = []
+    if start:
+        query += f' AND {ts_column} >= ?'
+        params.append(start)
+    if end:
+        query += f' AND {ts_column} <= ?'
+        params.append(end)
+    for name, value in filters.items():
+        query += f' AND {name} = ?'
+        params.append(value)
+    query += f' ORDER BY {ts_column} {direction}, id {direction}'
+    return query, params
+
+
+def _segments_in_range(cursor, table, start, end, descending):
+    """Prune segments using the min/max time index"""
+    query = 'SELECT file_name, min_ts, max_ts FROM archive_segments WHERE table_name = ?'
+    params = [table]
+    if start:
+        query += ' AND max_ts >= ?'
+        params.append(start)
+    if end:
+        query += ' AND min_ts <= ?'
+        params.append(end)
+    query += ' ORDER BY max_ts DESC' if descending else ' ORDER BY min_ts'
+    cursor.execute(query, params)
+    return cursor.fetchall()
+
+
+def query_history(table, start=None, end=None, filters=None, limit=None):
+    """
+    Query a table across the live rows and the archived segments
+
+    Segments are pruned using their min/max time index before any file is
+    opened. Results are returned newest first.
+    """
+    ts_column = _check_table(table)
+    filters = filters or {}
+
+    with get_read_connection() as conn:
+        cursor = conn.cursor()
+        _check_filters(cursor, table, filters)
+        if table == 'monitoring':
+            results = partitions.query_readings(conn, start, end, filters, limit)
+        else:
+            query, params = _live_query(table, ts_column, start, end, filters, descending=True)
+            if limit:
+                query += ' LIMIT ?'
+                params.append(limit)
+            cursor.execute(query, params)
+            results = [dict(row) for row in cursor.fetchall()]
+        segments = _segments_in_range(cursor, table, start, end, descending=True)
+
+    sort_key = lambda r: (r[ts_column] or '', r['id'])
+    for file_name, _, max_ts in segments:
+        # Segments are visited newest first; once the limit is filled with
+        # rows newer than this segment, nothing older can displace them
+        if limit and len(results) >= limit:
+            results.sort(key=sort_key, reverse=True)
+            if results[limit - 1][ts_column] > max_ts:
+                break
+        with Segment(os.path.join(site_dir(ARCHIVE_DIR), file_name)) as segment:
+            results.extend(segment.rows(start, end, filters))
+
+    results.sort(key=sort_key, reverse=True)
+    return results[:limit] if limit else results
+
+
+def _iter_history(site, table, ts_column, start, end, filters):
+    """Yield archived rows segment by segment (oldest first), then live rows"""
+    # Streaming outlives the request, so the site is bound here rather than taken from it
+    with use_site(site):
+        yield from _iter_site_history(table, ts_column, start, end, filters)
+
+
+def _iter_site_history(table, ts_column, start, end, filters):
+    with get_read_connection() as conn:
+        segments = _segments_in_range(conn.cursor(), table, start, end, descending=False)
+
+    for file_name, _, _ in segments:
+        with Segment(os.path.join(site_dir(ARCHIVE_DIR), file_name)) as segment:
+            yield from segment.rows(start, end, filters)
+
+    with get_read_connection() as conn:
+        if table == 'monitoring':
+            yield from partitions.iter_readings(conn, start, end, filters)
+            return
+        query, params = _live_query(table, ts_column, start, end, filters, descending=False)
+        for row in conn.execute(query, params):
+            yield dict(row)
+
+
+def _csv_chunks(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns)
+    writer.writeheader()
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % 1000 == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_history_csv(table, start=None, end=None, filters=None):
+    """
+    Return a generator of CSV chunks spanning archived and live rows
+
+    Arguments are validated up front so errors surface before streaming
+    starts. Only one segment is decoded at a time, so memory stays bounded
+    by the segment size rather than the export size.
+    """
+    ts_column = _check_table(table)
+    filters = filters or {}
+    if table == 'monitoring':
+        partitions.check_range(start, end)
+    with get_read_connection() as conn:
+        columns = _check_filters(conn.cursor(), table, filters)
+    return _csv_chunks(columns, _iter_history(current_site(), table, ts_column, start, end, filters))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Archive old monitoring and audit data')
+    parser.add_argument('--days', type=int, default=DEFAULT_HORIZON_DAYS,
+                        help='Archive rows older than this many days')
+    parser.add_argument('--table', choices=sorted(ARCHIVABLE_TABLES),
+                        help='Archive a single table (default: all)')
+    parser.add_argument('--list', action='store_true', help='List existing segments')
+    parser.add_argument('--site', default=DEFAULT_SITE, help='Site whose database to archive')
+    args = parser.parse_args()
+
+    set_site(args.site)
+    init_database()
+    if args.list:
+        for seg in list_segments(args.table):
+            print(f"{seg['table_name']:12} {seg['min_ts']} .. {seg['max_ts']} "
+                  f"{seg['row_count']:>7} rows {seg['byte_size']:>10} bytes  {seg['file_name']}")
+    else:
+        for table in ([args.table] if args.table else sorted(ARCHIVABLE_TABLES)):
+            result = archive_table(table, args.days)
+            print(f"{table}: archived {result['archived_rows']} rows older than "
+                  f"{result['cutoff']} into {len(result['segments'])} segment(s)")
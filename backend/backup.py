@@ -0,0 +1,365 @@
+"""
+Online backups for the QMS database
+Copies the live database and its monitoring partitions with the SQLite backup
+API in small page steps, stores rotated gzip snapshots with a manifest, and
+verifies and restores them
+"""
+import os
+import gzip
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import contextvars
+from datetime import datetime
+from urllib.request import pathname2url
+import database
+import partitions
+
+# Directory holding the compressed snapshots and their manifests (other sites use a subdirectory)
+BACKUP_DIR = os.environ.get('QMS_BACKUP_DIR', os.path.join(os.path.dirname(__file__), 'backups'))
+
+# Number of snapshots kept; older ones are deleted after each backup
+DEFAULT_KEEP = int(os.environ.get('QMS_BACKUP_KEEP', 14))
+
+# Hours between scheduled backups
+DEFAULT_INTERVAL_HOURS = float(os.environ.get('QMS_BACKUP_INTERVAL_HOURS', 6))
+
+# Pages copied per backup step and the pause between steps
+PAGES_PER_STEP = 256
+STEP_PAUSE = 0.005
+
+SNAPSHOT_SUFFIX = '.db.gz'
+PARTITION_SUFFIX = '.part.gz'
+_COPY_CHUNK = 1024 * 1024
+
+
+def _table_counts(conn):
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+    )]
+    return {table: conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] for table in tables}
+
+
+def _manifest_path(snapshot_path):
+    return snapshot_path[:-len(SNAPSHOT_SUFFIX)] + '.json'
+
+
+def _partition_snapshot_path(snapshot_path, month):
+    return snapshot_path[:-len(SNAPSHOT_SUFFIX)] + f'.monitoring-{month}{PARTITION_SUFFIX}'
+
+
+def _partition_months(conn):
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'monitoring_partitions'").fetchone():
+        return []
+    return partitions.list_months(conn)
+
+
+def _backup_pages(source, target):
+    """Copy source into target a few pages at a time, yielding between steps"""
+    def pause(status, remaining, total):
+        if remaining:
+            time.sleep(STEP_PAUSE)
+    source.backup(target, pages=PAGES_PER_STEP, progress=pause)
+
+
+def _copy_database(db_path, snapshot_path, work_dir, inspect=None):
+    """
+    Copy a live database file into a gzip snapshot
+
+    The source is opened read-only and holds one read transaction for the
+    whole copy, so the backup never restarts because of concurrent writes. Its
+    journal mode is left alone: files the writer has opened are in WAL mode,
+    where the pinned snapshot does not block the writer; in any other mode
+    writes wait until the copy is done. inspect(source) runs inside that
+    transaction; returns the snapshot's manifest entry and inspect's result.
+    """
+    started = time.perf_counter()
+    fd, raw_path = tempfile.mkstemp(prefix='.qms-backup-', suffix='.db', dir=work_dir)
+    os.close(fd)
+    try:
+        uri = f'file:{pathname2url(os.path.abspath(db_path))}?mode=ro'
+        source = sqlite3.connect(uri, uri=True, isolation_level=None)
+        target = sqlite3.connect(raw_path)
+        try:
+            source.execute('BEGIN')
+            counts = _table_counts(source)
+            inspected = inspect(source) if inspect else None
+            _backup_pages(source, target)
+            source.execute('COMMIT')
+            target.execute('PRAGMA journal_mode = DELETE')
+            page_count = target.execute('PRAGMA page_count').fetchone()[0]
+        finally:
+            target.close()
+            source.close()
+        copy_ms = (time.perf_counter() - started) * 1000
+
+        digest = hashlib.sha256()
+        tmp_snapshot = snapshot_path + '.tmp'
+        with open(raw_path, 'rb') as raw, gzip.open(tmp_snapshot, 'wb', compresslevel=6) as out:
+            for chunk in iter(lambda: raw.read(_COPY_CHUNK), b''):
+                digest.update(chunk)
+                out.write(chunk)
+        os.replace(tmp_snapshot, snapshot_path)
+
+        entry = {
+            'file_name': os.path.basename(snapshot_path),
+            'sha256': digest.hexdigest(),
+            'db_bytes': os.path.getsize(raw_path),
+            'compressed_bytes': os.path.getsize(snapshot_path),
+            'page_count': page_count,
+            'table_counts': counts,
+            'copy_ms': round(copy_ms, 2)
+        }
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+    return entry, inspected
+
+
+def create_backup(backup_dir=None, keep=DEFAULT_KEEP, label=None):
+    """
+    Write a consistent snapshot of the live database
+    keep=None skips rotation
+
+    Monitoring partitions (see partitions.py) are separate files and are
+    copied after the main file, each into its own snapshot listed in the
+    manifest; the main file's catalog decides which months are included.
+    """
+    backup_dir = backup_dir or database.site_dir(BACKUP_DIR)
+    os.makedirs(backup_dir, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    name = f"qms-{stamp}{'-' + label if label else ''}"
+    snapshot_path = os.path.join(backup_dir, name + SNAPSHOT_SUFFIX)
+    db_path = database.current_db_path()
+
+    started = time.perf_counter()
+    written = [snapshot_path]
+    try:
+        entry, months = _copy_database(db_path, snapshot_path, backup_dir, _partition_months)
+        manifest = {'file_name': entry.pop('file_name'), 'created_at': datetime.now().isoformat(), **entry}
+        manifest['partitions'] = {}
+        for month in months:
+            path = partitions.partition_path(month, db_path)
+            if not os.path.exists(path):
+                continue
+            part_path = _partition_snapshot_path(snapshot_path, month)
+            written.append(part_path)
+            manifest['partitions'][month], _ = _copy_database(path, part_path, backup_dir)
+        manifest['total_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        with open(_manifest_path(snapshot_path), 'w') as f:
+            json.dump(manifest, f, indent=2)
+    except Exception:
+        for path in written:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    manifest['removed'] = rotate_backups(backup_dir, keep) if keep else []
+    return manifest
+
+
+def list_backups(backup_dir=None):
+    """Snapshot manifests, newest first"""
+    backup_dir = backup_dir or database.site_dir(BACKUP_DIR)
+    if not os.path.isdir(backup_dir):
+        return []
+    manifests = []
+    for file_name in sorted(os.listdir(backup_dir), reverse=True):
+        if not file_name.endswith(SNAPSHOT_SUFFIX):
+            continue
+        path = os.path.join(backup_dir, file_name)
+        try:
+            with open(_manifest_path(path)) as f:
+                manifests.append(json.load(f))
+        except (OSError, ValueError):
+            manifests.append({'file_name': file_name, 'manifest_missing': True})
+    return manifests
+
+
+def rotate_backups(backup_dir=None, keep=DEFAULT_KEEP):
+    """Delete all but the newest `keep` snapshots; returns the removed file names"""
+    backup_dir = backup_dir or database.site_dir(BACKUP_DIR)
+    removed = []
+    for manifest in list_backups(backup_dir)[keep:]:
+        path = os.path.join(backup_dir, manifest['file_name'])
+        parts = [os.path.join(backup_dir, part['file_name'])
+                 for part in manifest.get('partitions', {}).values()]
+        for stale in [path, _manifest_path(path)] + parts:
+            if os.path.exists(stale):
+                os.remove(stale)
+        removed.append(manifest['file_name'])
+    return removed
+
+
+def _resolve(snapshot, backup_dir=None):
+    if os.path.exists(snapshot):
+        return snapshot
+    return os.path.join(backup_dir or database.site_dir(BACKUP_DIR), snapshot)
+
+
+def _decompress(snapshot_path, target_dir):
+    fd, raw_path = tempfile.mkstemp(prefix='.qms-verify-', suffix='.db', dir=target_dir)
+    digest = hashlib.sha256()
+    with os.fdopen(fd, 'wb') as raw, gzip.open(snapshot_path, 'rb') as src:
+        for chunk in iter(lambda: src.read(_COPY_CHUNK), b''):
+            digest.update(chunk)
+            raw.write(chunk)
+    return raw_path, digest.hexdigest()
+
+
+def _verify_file(snapshot_path, expected):
+    """Decompress a snapshot file and check it against its manifest entry; returns (problems, db path)"""
+    raw_path, sha256 = _decompress(snapshot_path, os.path.dirname(os.path.abspath(snapshot_path)))
+    try:
+        conn = sqlite3.connect(raw_path)
+        try:
+            integrity = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+            counts = _table_counts(conn)
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        integrity, counts = [str(e)], {}
+
+    problems = []
+    if sha256 != expected['sha256']:
+        problems.append('checksum mismatch')
+    if integrity != ['ok']:
+        problems.append(f"integrity_check: {'; '.join(integrity[:5])}")
+    if counts != expected['table_counts']:
+        problems.append('table row counts differ from manifest')
+    return problems, raw_path
+
+
+def verify_backup(snapshot, backup_dir=None, keep_file=False):
+    """
+    Check a snapshot against its manifest
+
+    Decompresses it and its partition snapshots, compares checksums and
+    per-table row counts with the manifest and runs PRAGMA integrity_check.
+    With keep_file=True the decompressed database path is returned in
+    'db_path' and those of the partitions in 'partition_paths', for the
+    caller to use and remove.
+    """
+    snapshot_path = _resolve(snapshot, backup_dir)
+    with open(_manifest_path(snapshot_path)) as f:
+        manifest = json.load(f)
+
+    problems, raw_path = _verify_file(snapshot_path, manifest)
+    partition_paths = {}
+    for month, entry in manifest.get('partitions', {}).items():
+        part_path = os.path.join(os.path.dirname(os.path.abspath(snapshot_path)), entry['file_name'])
+        if not os.path.exists(part_path):
+            problems.append(f'partition {month}: snapshot file missing')
+            continue
+        part_problems, partition_paths[month] = _verify_file(part_path, entry)
+        problems.extend(f'partition {month}: {problem}' for problem in part_problems)
+
+    result = {'file_name': manifest['file_name'], 'ok': not problems, 'problems': problems}
+    if keep_file and not problems:
+        result['db_path'] = raw_path
+        result['partition_paths'] = partition_paths
+    else:
+        for path in [raw_path, *partition_paths.values()]:
+            os.remove(path)
+    return result
+
+
+def _copy_into(source_path, target_path):
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path, timeout=30)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+
+def restore_backup(snapshot, backup_dir=None, target_path=None):
+    """
+    Replace the contents of the database with a verified snapshot
+
+    The current database is backed up first (labelled pre-restore). The
+    snapshot is then copied in through the backup API on a normal
+    connection, so WAL readers see either the old or the restored database.
+    Partitions follow the restored catalog: months in the snapshot are copied
+    in the same way and months it does not have are deleted.
+
+    A running server keeps the database's rows in memory (read pools, attached
+    partitions, the live buffer, CAPA timers), so restoring under it is refused;
+    stop the server, restore, then start it again.
+    """
+    target_path = target_path or database.current_db_path()
+    if database.server_running(target_path):
+        raise RuntimeError(f'A server is running on {target_path}; stop it before restoring')
+    verified = verify_backup(snapshot, backup_dir, keep_file=True)
+    if not verified['ok']:
+        raise ValueError(f"Snapshot failed verification: {', '.join(verified['problems'])}")
+
+    restored = verified['partition_paths']
+    try:
+        safety = create_backup(backup_dir, keep=None, label='pre-restore')
+        _copy_into(verified['db_path'], target_path)
+        partitions.discard([m for m in partitions.partition_files(target_path) if m not in restored],
+                           target_path)
+        if restored:
+            os.makedirs(partitions.partition_dir(target_path), exist_ok=True)
+        for month, path in restored.items():
+            _copy_into(path, partitions.partition_path(month, target_path))
+    finally:
+        for path in [verified['db_path'], *restored.values()]:
+            os.remove(path)
+    return {'restored': verified['file_name'], 'pre_restore_backup': safety['file_name']}
+
+
+def start_backup_thread(interval_hours=DEFAULT_INTERVAL_HOURS, keep=DEFAULT_KEEP):
+    """Take a snapshot of the current site periodically on a daemon thread"""
+    stop = threading.Event()
+
+    def loop():
+        while not stop.wait(interval_hours * 3600):
+            try:
+                manifest = create_backup(keep=keep)
+                print(f"Backup written: {manifest['file_name']} ({manifest['compressed_bytes']} bytes)")
+            except Exception as e:
+                print(f"Scheduled backup failed: {e}")
+
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(loop,), name='qms-backup', daemon=True).start()
+    return stop
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Back up, verify and restore the QMS database')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--list', action='store_true', help='List snapshots')
+    group.add_argument('--verify', metavar='SNAPSHOT', help='Verify a snapshot against its manifest')
+    group.add_argument('--restore', metavar='SNAPSHOT', help='Restore the database from a snapshot')
+    parser.add_argument('--keep', type=int, default=DEFAULT_KEEP, help='Snapshots to keep after a backup')
+    parser.add_argument('--site', default=database.DEFAULT_SITE, help='Site whose database to use')
+    args = parser.parse_args()
+    database.set_site(args.site)
+
+    if args.list:
+        for manifest in list_backups():
+            print(f"{manifest['file_name']:48} {manifest.get('created_at', '?'):26} "
+                  f"{manifest.get('compressed_bytes', 0):>10} bytes")
+    elif args.verify:
+        result = verify_backup(args.verify)
+        print(f"{result['file_name']}: {'OK' if result['ok'] else 'FAILED'}")
+        for problem in result['problems']:
+            print(f"  {problem}")
+        raise SystemExit(0 if result['ok'] else 1)
+    elif args.restore:
+        result = restore_backup(args.restore)
+        print(f"Restored {result['restored']} (previous state saved as {result['pre_restore_backup']})")
+    else:
+        manifest = create_backup(keep=args.keep)
+        print(f"Backup written: {manifest['file_name']} ({manifest['db_bytes']} -> "
+              f"{manifest['compressed_bytes']} bytes in {manifest['total_ms']} ms)")
+        for removed in manifest['removed']:
+            print(f"  rotated out {removed}")
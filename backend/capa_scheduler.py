@@ -0,0 +1,253 @@
+"""
+CAPA due-date scheduler
+Loads open CAPA target dates into a hierarchical timer wheel, fires due-soon
+and overdue events, records escalations and keeps an in-memory overdue index
+"""
+import os
+import json
+import time
+import threading
+import contextvars
+from datetime import datetime, date, timedelta
+from database import get_read_connection, run_write
+
+# Days before the target date that a due-soon event fires
+DUE_SOON_DAYS = int(os.environ.get('QMS_CAPA_DUE_SOON_DAYS', 7))
+
+# Statuses for which no due-date events are scheduled
+CLOSED_STATUSES = ('Effective', 'Closed')
+
+# Wheel resolution in seconds
+TICK_SECONDS = 60
+
+
+class HierarchicalTimerWheel:
+    """
+    Hashed hierarchical timer wheel
+
+    Level 0 has one slot per tick; each higher level covers `slots` times the
+    span of the level below. Timers far in the future sit in a coarse slot
+    and cascade down as the wheel turns, so scheduling and cancelling are
+    O(1) and each tick only touches the timers that are about to expire.
+    """
+
+    def __init__(self, start_tick, slots=64, levels=4):
+        self.slots = slots
+        self.levels = levels
+        self.current_tick = start_tick
+        self._wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self._overflow = []
+
+    def add(self, expiry_tick, item):
+        """Schedule item; returns True if it is already due"""
+        delta = expiry_tick - self.current_tick
+        if delta <= 0:
+            return True
+        for level in range(self.levels):
+            if delta < self.slots ** (level + 1):
+                slot = (expiry_tick // self.slots ** level) % self.slots
+                self._wheels[level][slot].append((expiry_tick, item))
+                return False
+        self._overflow.append((expiry_tick, item))
+        return False
+
+    def advance(self, to_tick):
+        """Turn the wheel up to to_tick and return the expired items in order"""
+        expired = []
+        while self.current_tick < to_tick:
+            self.current_tick += 1
+            tick = self.current_tick
+            # Cascade coarser levels whose slot boundary was just crossed
+            for level in range(self.levels - 1, 0, -1):
+                span = self.slots ** level
+                if tick % span == 0:
+                    slot = (tick // span) % self.slots
+                    entries, self._wheels[level][slot] = self._wheels[level][slot], []
+                    self._readd(entries, expired)
+            if tick % self.slots ** self.levels == 0 and self._overflow:
+                entries, self._overflow = self._overflow, []
+                self._readd(entries, expired)
+            slot = tick % self.slots
+            entries, self._wheels[0][slot] = self._wheels[0][slot], []
+            for expiry_tick, item in entries:
+                if expiry_tick <= tick:
+                    expired.append(item)
+                else:
+                    self.add(expiry_tick, item)
+        return expired
+
+    def _readd(self, entries, expired):
+        for expiry_tick, item in entries:
+            if self.add(expiry_tick, item):
+                expired.append(item)
+
+
+def _as_date(value):
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+
+class CapaScheduler:
+    """
+    Tracks open CAPA due dates and escalates them when they pass
+
+    Each CAPA has a due-soon timer (DUE_SOON_DAYS before the target date)
+    and an overdue timer (the day after the target date). Rescheduling bumps
+    a per-CAPA generation so stale timers are ignored when they fire.
+    Escalations are stored in capa_escalations, one per CAPA, event and
+    target date, so a restart never repeats them.
+    """
+
+    def __init__(self, clock=time.time, tick_seconds=TICK_SECONDS, due_soon_days=DUE_SOON_DAYS):
+        self.clock = clock
+        self.tick_seconds = tick_seconds
+        self.due_soon_days = due_soon_days
+        self._lock = threading.RLock()
+        self._wheel = HierarchicalTimerWheel(self._tick(clock()))
+        self._records = {}
+        self._generation = {}
+        self.overdue = {}
+        self.due_soon = {}
+        self._pending = []
+        self._loaded = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _tick(self, timestamp):
+        return int(timestamp // self.tick_seconds)
+
+    def _tick_for(self, day):
+        return self._tick(datetime.combine(day, datetime.min.time()).timestamp())
+
+    def load(self):
+        """Load every open CAPA from the database"""
+        with get_read_connection() as conn:
+            placeholders = ', '.join('?' * len(CLOSED_STATUSES))
+            rows = conn.execute(f'''
+                SELECT id, capa_number, title, responsible_person, target_date, status
+                FROM capa
+                WHERE status NOT IN ({placeholders})
+            ''', CLOSED_STATUSES).fetchall()
+        with self._lock:
+            for row in rows:
+                self._schedule(dict(row))
+            self._loaded = True
+        self.run_pending()
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def track(self, record):
+        """Schedule, reschedule or cancel the timers for a CAPA record"""
+        with self._lock:
+            if not self._loaded:
+                return
+            self._schedule(dict(record))
+        self.run_pending()
+
+    def _schedule(self, record):
+        capa_id = record['id']
+        generation = self._generation.get(capa_id, 0) + 1
+        self._generation[capa_id] = generation
+        self.overdue.pop(capa_id, None)
+        self.due_soon.pop(capa_id, None)
+
+        if record['status'] in CLOSED_STATUSES or not record.get('target_date'):
+            self._records.pop(capa_id, None)
+            return
+
+        self._records[capa_id] = record
+        target = _as_date(record['target_date'])
+        due_soon_day = target - timedelta(days=self.due_soon_days)
+        overdue_day = target + timedelta(days=1)
+        timers = [('due_soon', due_soon_day), ('overdue', overdue_day)]
+        if self._tick_for(overdue_day) <= self._wheel.current_tick:
+            # Already overdue; a due-soon escalation would only be noise
+            timers = timers[1:]
+        for event, day in timers:
+            item = (capa_id, generation, event)
+            if self._wheel.add(self._tick_for(day), item):
+                self._pending.append(item)
+
+    def run_pending(self):
+        """Advance the wheel to now and handle every expired timer"""
+        with self._lock:
+            fired, self._pending = self._pending, []
+            fired += self._wheel.advance(self._tick(self.clock()))
+
+            events = []
+            for capa_id, generation, event in fired:
+                if self._generation.get(capa_id) != generation or capa_id not in self._records:
+                    continue
+                record = self._records[capa_id]
+                entry = {
+                    'id': capa_id,
+                    'capa_number': record.get('capa_number'),
+                    'title': record.get('title'),
+                    'responsible_person': record.get('responsible_person'),
+                    'target_date': str(record['target_date'])[:10],
+                    'status': record['status']
+                }
+                if event == 'overdue':
+                    self.due_soon.pop(capa_id, None)
+                    self.overdue[capa_id] = entry
+                elif capa_id in self.overdue:
+                    continue
+                else:
+                    self.due_soon[capa_id] = entry
+                events.append((event, entry))
+
+        if events:
+            self._record_escalations(events)
+        return events
+
+    def _record_escalations(self, events):
+        def record(conn):
+            cursor = conn.cursor()
+            for event, entry in events:
+                cursor.execute('''
+                    INSERT OR IGNORE INTO capa_escalations (capa_id, event, target_date)
+                    VALUES (?, ?, ?)
+                ''', (entry['id'], event, entry['target_date']))
+                if cursor.rowcount:
+                    cursor.execute('''
+                        INSERT INTO audit_logs (user_id, action, entity_type, entity_id, changes)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', (None, 'ESCALATE', 'capa', entry['id'],
+                          json.dumps({'event': event, 'target_date': entry['target_date']})))
+        run_write(record)
+
+    def overdue_list(self):
+        """Overdue CAPA, oldest target date first"""
+        self.ensure_loaded()
+        self.run_pending()
+        with self._lock:
+            return sorted(self.overdue.values(), key=lambda e: (e['target_date'], e['id']))
+
+    def due_soon_list(self):
+        """CAPA due within DUE_SOON_DAYS, soonest first"""
+        self.ensure_loaded()
+        self.run_pending()
+        with self._lock:
+            return sorted(self.due_soon.values(), key=lambda e: (e['target_date'], e['id']))
+
+    def start(self):
+        """Load open CAPA and turn the wheel on a background thread, against the current site"""
+        self.ensure_loaded()
+
+        def loop():
+            while not self._stop.wait(self.tick_seconds):
+                try:
+                    self.run_pending()
+                except Exception as e:
+                    print(f"CAPA scheduler tick failed: {e}")
+
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(target=context.run, args=(loop,), name='qms-capa-scheduler',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
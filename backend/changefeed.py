@@ -0,0 +1,222 @@
+"""
+Change feed for incremental client sync
+Reads the trigger-maintained change_log and returns compact upserts and
+tombstones since a client's last sequence number
+"""
+import os
+import threading
+import contextvars
+from datetime import datetime, timedelta
+from database import (CHANGE_FEED_TABLES, DEFAULT_SITE, get_read_connection, read_transaction, run_write,
+                      init_database, set_site)
+import partitions
+
+# Maximum number of changed entities returned per page
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+# How long a logged monitoring reading may stay invisible in its partition
+# before it is treated as lost rather than not yet committed
+PENDING_GRACE_SECONDS = 60
+
+# Entries older than this are dropped; clients further behind must resync
+DEFAULT_RETENTION_DAYS = int(os.environ.get('QMS_CHANGE_LOG_RETENTION_DAYS', 30))
+
+
+def latest_seq(conn):
+    """
+    Return the newest change sequence number
+    Read from sqlite_sequence so it survives compaction emptying the log
+    """
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+    return row[0] if row else 0
+
+
+def latest_seq_by_entity(conn):
+    """Newest change sequence number per entity type (0 when the log has none)"""
+    return {
+        entity_type: conn.execute(
+            'SELECT MAX(seq) FROM change_log WHERE entity_type = ?', (entity_type,)
+        ).fetchone()[0] or 0
+        for entity_type in CHANGE_FEED_TABLES
+    }
+
+
+def fetch_changes(conn, since, limit=DEFAULT_PAGE_SIZE, entity_types=None):
+    """
+    Return the changes after sequence number `since`
+
+    Multiple changes to the same row collapse into its latest operation, so a
+    page costs O(changed rows) no matter how often each row was touched.
+    Upserts carry the current row; deletes become tombstones. A client whose
+    cursor is older than the compaction watermark (or who has no cursor yet)
+    receives reset=True and must reload the full dataset before syncing, as
+    does one whose cursor is newer than the log (it came from a restored or
+    replaced database).
+    """
+    entity_types = entity_types or CHANGE_FEED_TABLES
+    unknown = [t for t in entity_types if t not in CHANGE_FEED_TABLES]
+    if unknown:
+        raise ValueError(f"Unknown entity types: {', '.join(unknown)}")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    # One read transaction so the log and the row snapshots agree
+    with read_transaction(conn):
+        compacted_through = conn.execute(
+            'SELECT compacted_through FROM change_log_state WHERE id = 1'
+        ).fetchone()[0]
+        newest = latest_seq(conn)
+        if since < 1 or since < compacted_through or since > newest:
+            return {'reset': True, 'since': since, 'latest_seq': newest}
+
+        placeholders = ', '.join('?' * len(entity_types))
+        rows = conn.execute(f'''
+            SELECT c.entity_type, c.entity_id, c.seq, c.op, c.changed_at
+            FROM change_log c
+            JOIN (
+                SELECT entity_type, entity_id, MAX(seq) AS seq
+                FROM change_log
+                WHERE seq > ? AND entity_type IN ({placeholders})
+                GROUP BY entity_type, entity_id
+            ) latest ON latest.seq = c.seq
+            ORDER BY c.seq
+            LIMIT ?
+        ''', [since, *entity_types, limit + 1]).fetchall()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        # Without more pages the client has seen everything up to the newest entry
+        cursor_seq = rows[-1]['seq'] if has_more else newest
+
+        upsert_ids = {}
+        tombstones = {}
+        for row in rows:
+            if row['op'] == 'delete':
+                tombstones.setdefault(row['entity_type'], []).append(row['entity_id'])
+            else:
+                upsert_ids.setdefault(row['entity_type'], []).append(row['entity_id'])
+
+        upserts = {}
+        pending = set()
+        grace_start = datetime.utcnow() - timedelta(seconds=PENDING_GRACE_SECONDS)
+        grace_start = grace_start.strftime('%Y-%m-%d %H:%M:%S')
+        for entity_type, ids in upsert_ids.items():
+            if entity_type == 'monitoring':
+                found, uncommitted = partitions.readings_by_id(conn, ids)
+                # Past the grace period the partition commit was lost, not late
+                recent = {row['entity_id'] for row in rows
+                          if row['entity_type'] == 'monitoring' and row['changed_at'] >= grace_start}
+                pending = {i for i in uncommitted if i in recent}
+            else:
+                found = {}
+                for start in range(0, len(ids), 500):
+                    chunk = ids[start:start + 500]
+                    for record in conn.execute(
+                        f"SELECT * FROM {entity_type} WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+                    ):
+                        found[record['id']] = dict(record)
+            upserts[entity_type] = [found[i] for i in ids if i in found]
+            # Rows removed without a delete entry (e.g. archived) are tombstoned
+            missing = [i for i in ids if i not in found
+                       and not (entity_type == 'monitoring' and i in pending)]
+            if missing:
+                tombstones.setdefault(entity_type, []).extend(missing)
+
+        if pending:
+            # A partition commits after the main file, so a reading can be logged
+            # before it is visible; end the page just before the first such entry
+            cut = min(row['seq'] for row in rows
+                      if row['entity_type'] == 'monitoring' and row['entity_id'] in pending)
+            kept = {(row['entity_type'], row['entity_id']) for row in rows if row['seq'] < cut}
+            upserts = {t: [r for r in records if (t, r['id']) in kept] for t, records in upserts.items()}
+            tombstones = {t: kept_ids for t, ids in tombstones.items()
+                          if (kept_ids := [i for i in ids if (t, i) in kept])}
+            has_more = True
+            cursor_seq = cut - 1
+
+        return {
+            'reset': False,
+            'since': since,
+            'latest_seq': cursor_seq,
+            'has_more': has_more,
+            'upserts': upserts,
+            'tombstones': tombstones
+        }
+
+
+def compact_change_log(retention_days=DEFAULT_RETENTION_DAYS):
+    """
+    Compact the change log
+
+    Superseded entries (an entity changed again later) are always removed.
+    Entries older than the retention window are dropped entirely and the
+    watermark advances, forcing clients behind it to do a full resync.
+    """
+    def compact(conn):
+        cursor = conn.cursor()
+        cursor.execute('''
+            DELETE FROM change_log
+            WHERE seq NOT IN (
+                SELECT MAX(seq) FROM change_log GROUP BY entity_type, entity_id
+            )
+        ''')
+        superseded = cursor.rowcount
+
+        cursor.execute('''
+            SELECT MAX(seq) FROM change_log
+            WHERE changed_at < datetime('now', ?)
+        ''', (f'-{int(retention_days)} days',))
+        expired_through = cursor.fetchone()[0]
+        expired = 0
+        if expired_through:
+            cursor.execute('DELETE FROM change_log WHERE seq <= ?', (expired_through,))
+            expired = cursor.rowcount
+            cursor.execute('''
+                UPDATE change_log_state
+                SET compacted_through = MAX(compacted_through, ?)
+                WHERE id = 1
+            ''', (expired_through,))
+
+        cursor.execute('SELECT compacted_through FROM change_log_state WHERE id = 1')
+        return {
+            'superseded_removed': superseded,
+            'expired_removed': expired,
+            'compacted_through': cursor.fetchone()[0]
+        }
+
+    return run_write(compact)
+
+
+def start_compaction_thread(interval_hours=24, retention_days=DEFAULT_RETENTION_DAYS):
+    """Compact the current site's change log periodically on a daemon thread"""
+    stop = threading.Event()
+
+    def loop():
+        while not stop.wait(interval_hours * 3600):
+            try:
+                compact_change_log(retention_days)
+            except Exception as e:
+                print(f"Change log compaction failed: {e}")
+
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(loop,), name='qms-changelog-compaction',
+                     daemon=True).start()
+    return stop
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Change log maintenance')
+    parser.add_argument('--days', type=int, default=DEFAULT_RETENTION_DAYS,
+                        help='Drop change entries older than this many days')
+    parser.add_argument('--site', default=DEFAULT_SITE, help='Site whose change log to compact')
+    args = parser.parse_args()
+
+    set_site(args.site)
+    init_database()
+    result = compact_change_log(args.days)
+    print(f"Removed {result['superseded_removed']} superseded and {result['expired_removed']} "
+          f"expired entries; watermark is now {result['compacted_through']}")
+    with get_read_connection() as conn:
+        print(f"Latest sequence: {latest_seq(conn)}")
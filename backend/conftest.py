@@ -0,0 +1,52 @@
+"""
+pytest fixtures: every test gets its own database files under tmp_path
+"""
+import os
+import shutil
+import pytest
+import database
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """Point the default site at a fresh, empty database file; writers and read pools are closed afterwards"""
+    path = str(tmp_path / 'qms.db')
+    monkeypatch.setattr(database, 'DB_PATH', path)
+    monkeypatch.setattr(database, 'SITES_DIR', str(tmp_path / 'sites'))
+    yield path
+    with database._writer_lock:
+        writers = [database._writers.pop(p) for p in list(database._writers) if p.startswith(str(tmp_path))]
+    for writer in writers:
+        writer.stop()
+    for lock_path in [p for p in database._server_locks if p.startswith(str(tmp_path))]:
+        database._server_locks.pop(lock_path).close()
+    for pool_path in list(database._read_pools):
+        if pool_path.startswith(str(tmp_path)):
+            database.close_read_pool(pool_path)
+
+
+@pytest.fixture
+def legacy_db(db_path):
+    """The committed sample database, created before schema versioning (user_version 0)"""
+    shutil.copy(os.path.join(os.path.dirname(__file__), 'qms_database.db'), db_path)
+    return db_path
+
+
+@pytest.fixture
+def qms_db(db_path):
+    """A migrated database holding the init_db sample data"""
+    import init_db
+    database.init_database()
+    init_db.seed_sample_data()
+    # Starting the writer switches the file to WAL, as on any server that has written once
+    database.run_write(lambda conn: None)
+    return db_path
+
+
+@pytest.fixture
+def client(qms_db, monkeypatch):
+    """Flask test client of the API; its per-site buffers and schedulers start empty for each database"""
+    import api
+    for site_local in (api.live_buffers, api.capa_schedulers):
+        monkeypatch.setattr(site_local, '_instances', {})
+    return api.app.test_client()
@@ -3,12 +3,270 @@ Database connection and initialization module for Pharmaceutical QMS
 """
 import sqlite3
 import os
+import queue
+import socket
+import threading
+import time
+import re
+import hashlib
+import weakref
+import contextvars
 from datetime import datetime
+from collections import OrderedDict, deque
 from contextlib import contextmanager
+from concurrent.futures import Future
+from urllib.request import pathname2url
 
-# Database file path
+# Database file path of the default site
 DB_PATH = os.path.join(os.path.dirname(__file__), 'qms_database.db')
 
+# Site served when a request names none; its database is DB_PATH
+DEFAULT_SITE = os.environ.get('QMS_DEFAULT_SITE', 'main')
+
+# Directory holding one <site>.db file per additional manufacturing site
+SITES_DIR = os.environ.get('QMS_SITES_DIR', os.path.join(os.path.dirname(__file__), 'sites'))
+
+# Additional sites to create on startup, comma-separated (existing files in SITES_DIR are found anyway)
+CONFIGURED_SITES = [s.strip() for s in os.environ.get('QMS_SITES', '').split(',') if s.strip()]
+
+SITE_NAME_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$')
+
+# Maximum number of queued write transactions committed together
+WRITE_BATCH_SIZE = 64
+
+# Databases the writer keeps attached at once (SQLite's default SQLITE_MAX_ATTACHED)
+MAX_ATTACHED = 10
+
+# Tables whose inserts, updates and deletes are recorded in change_log
+CHANGE_FEED_TABLES = ['deviations', 'capa', 'batches', 'monitoring', 'reports']
+
+# Tables whose status changes are recorded in status_history, by audit_logs entity type
+STATUS_HISTORY_TABLES = {'deviation': 'deviations', 'capa': 'capa'}
+
+# Default time budget in seconds for the read queries of one request; 0 disables
+DEFAULT_QUERY_TIMEOUT = float(os.environ.get('QMS_QUERY_TIMEOUT', 10))
+
+# SQLite VM instructions executed between deadline checks
+PROGRESS_STEPS = 10000
+
+# Seconds between client-disconnect checks while a query runs
+DISCONNECT_CHECK_INTERVAL = 0.1
+
+# Idle read-only connections kept per database file for reuse; 0 disables pooling
+READ_POOL_SIZE = int(os.environ.get('QMS_READ_POOL_SIZE', 16))
+
+# Recent statements kept per endpoint for index advice (see maintenance.py); 0 disables sampling.
+# They are the expanded SQL of the trace callback, so they hold the requests' literal values in memory
+STATEMENT_SAMPLES = int(os.environ.get('QMS_STATEMENT_SAMPLES', 32))
+
+
+class QueryTimeout(Exception):
+    """Raised when a read query is aborted for exceeding its time budget"""
+
+    def __init__(self, message, sql=None, plan=None, budget=None, elapsed=None):
+        super().__init__(message)
+        self.sql = sql
+        self.plan = plan or []
+        self.budget = budget
+        self.elapsed = elapsed
+
+
+class QueryCancelled(QueryTimeout):
+    """Raised when a read query is aborted because the client disconnected"""
+
+
+class UnknownSite(LookupError):
+    """Raised when a request names a site that has no database"""
+
+
+_current_site = contextvars.ContextVar('qms_site', default=None)
+
+
+def list_sites():
+    """The default site, the configured sites and any site database found in SITES_DIR"""
+    sites = [DEFAULT_SITE]
+    found = []
+    if os.path.isdir(SITES_DIR):
+        found = sorted(name[:-3] for name in os.listdir(SITES_DIR) if name.endswith('.db'))
+    for site in CONFIGURED_SITES + found:
+        if site not in sites and SITE_NAME_PATTERN.match(site):
+            sites.append(site)
+    return sites
+
+
+def site_db_path(site):
+    """Database file of a site; raises UnknownSite for names that are not served"""
+    if site == DEFAULT_SITE:
+        return DB_PATH
+    if site not in list_sites():
+        raise UnknownSite(f'Unknown site: {site}')
+    return os.path.join(SITES_DIR, f'{site}.db')
+
+
+def current_site():
+    return _current_site.get() or DEFAULT_SITE
+
+
+def current_db_path():
+    return site_db_path(current_site())
+
+
+def site_dir(base):
+    """Per-site subdirectory of a data directory (base itself for the default site)"""
+    site = current_site()
+    return base if site == DEFAULT_SITE else os.path.join(base, 'sites', site)
+
+
+def set_site(site):
+    """Route the connections of the current context to a site; returns a reset token"""
+    site_db_path(site)
+    return _current_site.set(site)
+
+
+def reset_site(token):
+    _current_site.reset(token)
+
+
+@contextmanager
+def use_site(site):
+    token = set_site(site)
+    try:
+        yield site
+    finally:
+        reset_site(token)
+
+
+class SiteLocal:
+    """One lazily created factory() instance per site, picked by the current site"""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def get(self):
+        site = current_site()
+        with self._lock:
+            if site not in self._instances:
+                self._instances[site] = self.factory()
+            return self._instances[site]
+
+
+class QueryDeadline:
+    """
+    Time budget and cancellation state for the queries of one request
+
+    check() is installed as the SQLite progress handler of every read
+    connection opened while the deadline is active; returning True makes
+    SQLite abort the running statement with an 'interrupted' error.
+    """
+
+    def __init__(self, seconds, is_disconnected=None, label=None):
+        self.started = time.monotonic()
+        self.seconds = seconds
+        self.expires_at = self.started + seconds if seconds else None
+        self.is_disconnected = is_disconnected
+        self.label = label
+        self.reason = None
+        self.last_sql = None
+        self._next_disconnect_check = self.started
+
+    def check(self):
+        now = time.monotonic()
+        if self.expires_at is not None and now >= self.expires_at:
+            self.reason = 'timeout'
+            return True
+        if self.is_disconnected is not None and now >= self._next_disconnect_check:
+            self._next_disconnect_check = now + DISCONNECT_CHECK_INTERVAL
+            if self.is_disconnected():
+                self.reason = 'disconnected'
+                return True
+        return False
+
+    def trace(self, sql):
+        self.last_sql = sql
+        if self.label and STATEMENT_SAMPLES > 0:
+            _sample_statement(self.label, sql)
+
+    def error(self):
+        """Build (and log) the exception for an aborted statement"""
+        elapsed = round(time.monotonic() - self.started, 3)
+        if self.reason == 'disconnected':
+            print(f"Query cancelled, client disconnected ({self.label}) after {elapsed}s: {self.last_sql}")
+            return QueryCancelled('Client disconnected', self.last_sql, None, self.seconds, elapsed)
+        plan = explain_query_plan(self.last_sql)
+        print(f"Query timeout ({self.label}) after {elapsed}s, budget {self.seconds}s: {self.last_sql}")
+        for line in plan:
+            print(f"    {line}")
+        return QueryTimeout('Query exceeded its time budget', self.last_sql, plan, self.seconds, elapsed)
+
+
+_query_deadline = contextvars.ContextVar('qms_query_deadline', default=None)
+
+_statement_samples = {}
+
+
+def _sample_statement(label, sql):
+    key = (current_db_path(), label)
+    samples = _statement_samples.get(key)
+    if samples is None:
+        samples = _statement_samples.setdefault(key, deque(maxlen=STATEMENT_SAMPLES))
+    samples.append(sql)
+
+
+def statement_samples():
+    """
+    Statements recently run by requests on the current site's database, by endpoint
+    Bound parameters appear as the literal values the requests used
+    """
+    db_path = current_db_path()
+    return {label: list(samples) for (path, label), samples in list(_statement_samples.items())
+            if path == db_path}
+
+
+def set_query_deadline(seconds, is_disconnected=None, label=None):
+    """Start a deadline for the read queries of the current context; returns a reset token"""
+    return _query_deadline.set(QueryDeadline(seconds, is_disconnected, label))
+
+
+def clear_query_deadline(token):
+    _query_deadline.reset(token)
+
+
+def socket_disconnected(sock):
+    """
+    Return a callable telling whether the peer of sock has closed the connection
+    Peeks without consuming so pipelined request bytes are left in place;
+    returns None where non-blocking peeks are unsupported
+    """
+    if sock is None or not hasattr(socket, 'MSG_DONTWAIT'):
+        return None
+
+    def check():
+        try:
+            return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            return True
+    return check
+
+
+def explain_query_plan(sql):
+    """EXPLAIN QUERY PLAN lines for a (parameter-expanded) statement, on a fresh connection"""
+    if not sql:
+        return []
+    conn = None
+    try:
+        uri = f'file:{pathname2url(os.path.abspath(current_db_path()))}?mode=ro'
+        conn = sqlite3.connect(uri, uri=True)
+        return [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}')]
+    except sqlite3.Error as e:
+        return [f'plan unavailable: {e}']
+    finally:
+        if conn is not None:
+            conn.close()
+
 
 @contextmanager
 def get_db_connection():
@@ -16,7 +274,7 @@ def get_db_connection():
     Context manager for database connections
     Ensures connections are properly closed
     """
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(current_db_path())
     conn.row_factory = sqlite3.Row  # Enable column access by name
     try:
         yield conn
@@ -28,165 +286,1104 @@ def get_db_connection():
         conn.close()
 
 
-def init_database():
+class ReadConnection(sqlite3.Connection):
     """
-    Initialize the database with all required tables
+    Read-only connection that can be handed to another request
+
+    Every cursor is tracked so release() can close them: a cursor left
+    mid-result keeps its read transaction, and with it a stale WAL snapshot,
+    open for whoever uses the connection next.
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                full_name TEXT NOT NULL,
-                role TEXT NOT NULL,
-                department TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_login TIMESTAMP
-            )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cursors = weakref.WeakSet()
+
+    def cursor(self, factory=sqlite3.Cursor):
+        cursor = super().cursor(factory)
+        self._cursors.add(cursor)
+        return cursor
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+    def release(self):
+        """Finish all statements and clear per-request state before reuse"""
+        for cursor in list(self._cursors):
+            cursor.close()
+        if self.in_transaction:
+            self.rollback()
+        self.set_progress_handler(None, 0)
+        self.set_trace_callback(None)
+        self.row_factory = sqlite3.Row
+
+
+_read_pools = {}
+_read_pool_lock = threading.Lock()
+
+
+def _read_pool(db_path):
+    with _read_pool_lock:
+        if db_path not in _read_pools:
+            _read_pools[db_path] = queue.LifoQueue(maxsize=READ_POOL_SIZE)
+        return _read_pools[db_path]
+
+
+def _open_read_connection(db_path):
+    uri = f'file:{pathname2url(db_path)}?mode=ro'
+    conn = sqlite3.connect(uri, uri=True, factory=ReadConnection, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA query_only = ON')
+    return conn
+
+
+_shared_read_connection = contextvars.ContextVar('qms_shared_read_connection', default=None)
+
+
+@contextmanager
+def read_snapshot():
+    """
+    Serve every get_read_connection() of the current context from one connection
+    inside one read transaction, so all reads see the same database state.
+    The connection is not thread-safe to share, so only the thread that opened
+    the snapshot uses it: a copied context running on another thread gets its
+    own pooled connection (and so no snapshot).
+    """
+    with get_read_connection() as conn:
+        conn.execute('BEGIN')
+        token = _shared_read_connection.set((os.path.abspath(current_db_path()), conn, threading.get_ident()))
+        try:
+            yield conn
+        finally:
+            _shared_read_connection.reset(token)
+
+
+def in_read_snapshot():
+    """Whether reads on this thread are served by an enclosing read_snapshot()"""
+    shared = _shared_read_connection.get()
+    return shared is not None and shared[2] == threading.get_ident()
+
+
+@contextmanager
+def read_transaction(conn):
+    """Run reads on conn in one transaction, joining the enclosing one if there is one"""
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute('BEGIN')
+    try:
+        yield conn
+    finally:
+        conn.rollback()
+
+
+@contextmanager
+def _shared_read(conn):
+    deadline = _query_deadline.get()
+    if deadline is not None:
+        conn.set_progress_handler(deadline.check, PROGRESS_STEPS)
+        conn.set_trace_callback(deadline.trace)
+    try:
+        yield conn
+    except sqlite3.OperationalError as e:
+        if deadline is not None and deadline.reason:
+            raise deadline.error() from e
+        raise
+    finally:
+        conn.set_progress_handler(None, 0)
+        conn.set_trace_callback(None)
+
+
+def close_read_pool(db_path):
+    """Close the idle pooled connections of a database file (e.g. before deleting it)"""
+    with _read_pool_lock:
+        pool = _read_pools.pop(os.path.abspath(db_path), None)
+    while pool is not None:
+        try:
+            pool.get_nowait().close()
+        except queue.Empty:
+            break
+
+
+@contextmanager
+def get_read_connection(db_path=None):
+    """
+    Context manager for read-only connections used by GET handlers
+    Opened with mode=ro and query_only so a reader can never take the write lock.
+    Statements are aborted with QueryTimeout/QueryCancelled once the current
+    query deadline (see set_query_deadline) expires or its client goes away.
+    Connects to the database of the current site (see use_site) unless given
+    another file, reusing an idle pooled connection when there is one, or the
+    connection of an enclosing read_snapshot().
+    """
+    db_path = os.path.abspath(db_path or current_db_path())
+    shared = _shared_read_connection.get()
+    if shared is not None and shared[0] == db_path and shared[2] == threading.get_ident():
+        with _shared_read(shared[1]) as conn:
+            yield conn
+        return
+    pool = _read_pool(db_path)
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open_read_connection(db_path)
+    deadline = _query_deadline.get()
+    if deadline is not None:
+        conn.set_progress_handler(deadline.check, PROGRESS_STEPS)
+        conn.set_trace_callback(deadline.trace)
+    failed = True
+    try:
+        yield conn
+        failed = False
+    except sqlite3.OperationalError as e:
+        if deadline is not None and deadline.reason:
+            raise deadline.error() from e
+        raise
+    finally:
+        # Connections that saw an error are not trusted for reuse
+        if failed or READ_POOL_SIZE <= 0:
+            conn.close()
+        else:
+            conn.release()
+            try:
+                pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+
+class DatabaseWriter:
+    """
+    Dedicated writer thread that owns the only write connection
+
+    Callers submit a function taking the connection; the thread drains the
+    queue, runs each job inside its own savepoint and commits the whole group
+    in one transaction. A failing job is rolled back to its savepoint without
+    affecting the others, and its exception is re-raised in the caller.
+    Jobs must not call commit() or rollback() themselves.
+
+    Jobs may name other database files to attach (and aliases to detach).
+    ATTACH and DETACH are not allowed inside a transaction, so they run before
+    the group's BEGIN; at most MAX_ATTACHED stay attached, least recently
+    used first out.
+    """
+
+    def __init__(self, db_path=None, batch_size=WRITE_BATCH_SIZE):
+        self.db_path = db_path or current_db_path()
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._attached = OrderedDict()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                name = f'qms-db-writer-{os.path.basename(self.db_path)}'
+                self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, fn, *args, attach=(), detach=()):
+        """
+        Queue a write job and return a Future for its result
+        attach is a sequence of (alias, path) the job needs attached, detach
+        a sequence of aliases to detach before it runs
+        """
+        self.start()
+        future = Future()
+        self._queue.put((fn, args, future, tuple(attach), tuple(detach)))
+        return future
+
+    def execute(self, fn, *args, attach=(), detach=()):
+        """Run a write job on the writer thread and wait for its result"""
+        return self.submit(fn, *args, attach=attach, detach=detach).result()
+
+    def _connect(self):
+        # A large statement cache keeps the per-column-set UPDATE statements prepared
+        conn = sqlite3.connect(self.db_path, isolation_level=None, cached_statements=256)
+        try:
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA busy_timeout = 5000')
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def _run(self):
+        conn = None
+        try:
+            while True:
+                job = self._queue.get()
+                if job is None:
+                    break
+                batch = [job]
+                while len(batch) < self.batch_size:
+                    try:
+                        job = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        self._queue.put(None)
+                        break
+                    batch.append(job)
+                if conn is None:
+                    # Connecting can fail (e.g. the switch to WAL while a reader holds the file);
+                    # the batch gets the error and the next one tries again
+                    try:
+                        conn = self._connect()
+                    except Exception as e:
+                        for _, _, future, _, _ in batch:
+                            if future.set_running_or_notify_cancel():
+                                future.set_exception(e)
+                        continue
+                    self._attached.clear()
+                for group in self._groups(batch):
+                    self._commit_batch(conn, group)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _groups(self, batch):
+        """
+        Split a batch where a job detaches something or would need more than
+        MAX_ATTACHED databases attached alongside the jobs before it
+        """
+        group, aliases = [], set()
+        for job in batch:
+            needed = aliases | {alias for alias, _ in job[3]}
+            if group and (job[4] or len(needed) > MAX_ATTACHED):
+                yield group
+                group, needed = [], {alias for alias, _ in job[3]}
+            group.append(job)
+            aliases = needed
+        if group:
+            yield group
+
+    def _prepare(self, conn, batch):
+        """Detach and attach what the batch asks for, outside any transaction"""
+        for alias in (alias for job in batch for alias in job[4]):
+            if self._attached.pop(alias, None) is not None:
+                conn.execute(f'DETACH DATABASE {alias}')
+        needed = dict(pair for job in batch for pair in job[3])
+        for alias, path in needed.items():
+            if alias in self._attached:
+                self._attached.move_to_end(alias)
+                continue
+            for stale in [a for a in self._attached if a not in needed]:
+                if len(self._attached) < MAX_ATTACHED:
+                    break
+                del self._attached[stale]
+                conn.execute(f'DETACH DATABASE {stale}')
+            conn.execute(f'ATTACH DATABASE ? AS {alias}', (path,))
+            conn.execute(f'PRAGMA {alias}.journal_mode = WAL')
+            conn.execute(f'PRAGMA {alias}.synchronous = NORMAL')
+            self._attached[alias] = path
+
+    def _commit_batch(self, conn, batch):
+        outcomes = []
+        try:
+            self._prepare(conn, batch)
+            conn.execute('BEGIN IMMEDIATE')
+        except Exception as e:
+            for _, _, future, _, _ in batch:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            return
+
+        for fn, args, future, _, _ in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            conn.execute('SAVEPOINT write_job')
+            try:
+                result = fn(conn, *args)
+                conn.execute('RELEASE write_job')
+                outcomes.append((future, result, None))
+            except Exception as e:
+                conn.execute('ROLLBACK TO write_job')
+                conn.execute('RELEASE write_job')
+                outcomes.append((future, None, e))
+
+        try:
+            conn.execute('COMMIT')
+        except Exception as e:
+            conn.execute('ROLLBACK')
+            for future, _, _ in outcomes:
+                future.set_exception(e)
+            return
+
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+_writers = {}
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """Return the writer of the current site's database, starting it on first use"""
+    db_path = os.path.abspath(current_db_path())
+    with _writer_lock:
+        if db_path not in _writers:
+            _writers[db_path] = DatabaseWriter(db_path)
+        return _writers[db_path]
+
+
+def run_write(fn, *args, attach=(), detach=()):
+    """
+    Run fn(conn, *args) as a write transaction on the current site's writer thread
+    See DatabaseWriter.submit for attach and detach
+    """
+    return get_writer().execute(fn, *args, attach=attach, detach=detach)
+
+
+def record_removal(conn, table):
+    """
+    Count rows leaving a table without change_log entries (moved into archive
+    segments, or a monitoring month dropped); call in the removing write job
+    """
+    conn.execute('''
+        INSERT INTO removal_counters (table_name, removals) VALUES (?, 1)
+        ON CONFLICT (table_name) DO UPDATE SET removals = removals + 1
+    ''', (table,))
+
+
+def removal_count(conn, table):
+    """Times rows left a table unlogged; caches of its rows compare it to notice"""
+    row = conn.execute('SELECT removals FROM removal_counters WHERE table_name = ?', (table,)).fetchone()
+    return row[0] if row else 0
+
+
+# Exclusive transactions on <database>.server-lock files, held open by a serving process
+_server_locks = {}
+
+
+def _server_lock_path(db_path):
+    return os.path.abspath(db_path) + '.server-lock'
+
+
+def hold_server_lock():
+    """
+    Mark the current site's database as served by this process until it exits
+    (see server_running); returns False if another process already serves it
+    """
+    db_path = os.path.abspath(current_db_path())
+    with _writer_lock:
+        if db_path in _server_locks:
+            return True
+        conn = sqlite3.connect(_server_lock_path(db_path), timeout=0, isolation_level=None,
+                               check_same_thread=False)
+        try:
+            conn.execute('BEGIN EXCLUSIVE')
+        except sqlite3.OperationalError:
+            conn.close()
+            return False
+        _server_locks[db_path] = conn
+        return True
+
+
+def server_running(db_path=None):
+    """True while a process holds the server lock of a database (default: the current site's)"""
+    db_path = os.path.abspath(db_path or current_db_path())
+    if db_path in _server_locks:
+        return True
+    if not os.path.exists(_server_lock_path(db_path)):
+        return False
+    conn = sqlite3.connect(_server_lock_path(db_path), timeout=0, isolation_level=None)
+    try:
+        conn.execute('BEGIN EXCLUSIVE')
+        conn.execute('ROLLBACK')
+        return False
+    except sqlite3.OperationalError:
+        return True
+    finally:
+        conn.close()
+
+
+def _migrate_baseline(cursor):
+    """
+    The tables of the original schema, as every deployed database has them
+    Written with IF NOT EXISTS so it also adopts databases created before
+    schema versioning.
+    """
+    # Users table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            full_name TEXT NOT NULL,
+            role TEXT NOT NULL,
+            department TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_login TIMESTAMP
+        )
+    ''')
+    
+    # Deviations table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS deviations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            deviation_number TEXT UNIQUE NOT NULL,
+            title TEXT NOT NULL,
+            description TEXT NOT NULL,
+            category TEXT NOT NULL,
+            severity INTEGER NOT NULL,
+            occurrence INTEGER NOT NULL,
+            detection INTEGER NOT NULL,
+            rpn INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'Open',
+            department TEXT,
+            product_batch TEXT,
+            detected_date DATE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_by INTEGER,
+            FOREIGN KEY (created_by) REFERENCES users(id)
+        )
+    ''')
+    
+    # CAPA (Corrective and Preventive Actions) table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS capa (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            capa_number TEXT UNIQUE NOT NULL,
+            deviation_id INTEGER,
+            type TEXT NOT NULL,
+            title TEXT NOT NULL,
+            description TEXT NOT NULL,
+            root_cause TEXT,
+            action_plan TEXT NOT NULL,
+            responsible_person TEXT NOT NULL,
+            target_date DATE NOT NULL,
+            completion_date DATE,
+            status TEXT NOT NULL DEFAULT 'Open',
+            effectiveness TEXT,
+            verification_date DATE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_by INTEGER,
+            FOREIGN KEY (deviation_id) REFERENCES deviations(id),
+            FOREIGN KEY (created_by) REFERENCES users(id)
+        )
+    ''')
+    
+    # Reports table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reports (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            report_type TEXT NOT NULL,
+            title TEXT NOT NULL,
+            description TEXT,
+            parameters TEXT,
+            file_path TEXT,
+            file_format TEXT,
+            generated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            generated_by INTEGER,
+            FOREIGN KEY (generated_by) REFERENCES users(id)
+        )
+    ''')
+    
+    # Monitoring data table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS monitoring (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            location TEXT NOT NULL,
+            parameter_type TEXT NOT NULL,
+            parameter_name TEXT NOT NULL,
+            value REAL NOT NULL,
+            unit TEXT,
+            min_limit REAL,
+            max_limit REAL,
+            status TEXT NOT NULL,
+            alert_level TEXT,
+            recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            recorded_by INTEGER,
+            FOREIGN KEY (recorded_by) REFERENCES users(id)
+        )
+    ''')
+    
+    # Audit logs table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS audit_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            action TEXT NOT NULL,
+            entity_type TEXT NOT NULL,
+            entity_id INTEGER,
+            changes TEXT,
+            ip_address TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    
+    # Batches table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS batches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            batch_number TEXT UNIQUE NOT NULL,
+            product_name TEXT NOT NULL,
+            product_code TEXT,
+            quantity INTEGER NOT NULL,
+            unit TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'In Progress',
+            start_date DATE NOT NULL,
+            completion_date DATE,
+            release_date DATE,
+            expiry_date DATE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Documents table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS documents (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            document_number TEXT UNIQUE NOT NULL,
+            title TEXT NOT NULL,
+            document_type TEXT NOT NULL,
+            version TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'Draft',
+            effective_date DATE,
+            review_date DATE,
+            file_path TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_by INTEGER,
+            FOREIGN KEY (created_by) REFERENCES users(id)
+        )
+    ''')
+
+
+def _migrate_archive_segments(cursor):
+    """Archive segment index and the timestamp indexes used by archival and history scans (see archive.py)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archive_segments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            file_name TEXT UNIQUE NOT NULL,
+            row_count INTEGER NOT NULL,
+            min_ts TIMESTAMP NOT NULL,
+            max_ts TIMESTAMP NOT NULL,
+            min_id INTEGER,
+            max_id INTEGER,
+            byte_size INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Indexes for time-range scans and archival
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_archive_segments_range
+        ON archive_segments (table_name, min_ts, max_ts)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_monitoring_recorded_at
+        ON monitoring (recorded_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_audit_logs_timestamp
+        ON audit_logs (timestamp)
+    ''')
+
+
+def _migrate_list_indexes(cursor):
+    """Indexes for the deviation and CAPA list filters (see queries.py)"""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_deviations_status
+        ON deviations (status, created_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_deviations_detected_date
+        ON deviations (detected_date)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_deviations_rpn
+        ON deviations (rpn)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_capa_status
+        ON capa (status, created_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_capa_target_date
+        ON capa (target_date)
+    ''')
+
+
+def _migrate_capa_escalations(cursor):
+    """CAPA due-date escalations (see capa_scheduler.py)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS capa_escalations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            capa_id INTEGER NOT NULL,
+            event TEXT NOT NULL,
+            target_date DATE NOT NULL,
+            fired_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (capa_id, event, target_date),
+            FOREIGN KEY (capa_id) REFERENCES capa(id)
+        )
+    ''')
+
+
+def _migrate_document_revisions(cursor):
+    """Document revisions stored as deduplicated chunks (see document_store.py)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS document_revisions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            document_id INTEGER NOT NULL,
+            version TEXT NOT NULL,
+            file_name TEXT,
+            mime_type TEXT,
+            byte_size INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            chunks TEXT NOT NULL,
+            uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            uploaded_by INTEGER,
+            UNIQUE (document_id, version),
+            FOREIGN KEY (document_id) REFERENCES documents(id),
+            FOREIGN KEY (uploaded_by) REFERENCES users(id)
+        )
+    ''')
+
+
+def _migrate_report_cache(cursor):
+    """Memoized report output (see report_cache.py)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS report_cache (
+            cache_key TEXT PRIMARY KEY,
+            report_type TEXT NOT NULL,
+            parameters TEXT NOT NULL,
+            data_version TEXT NOT NULL,
+            output TEXT NOT NULL,
+            byte_size INTEGER NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_report_cache_last_used
+        ON report_cache (last_used_at)
+    ''')
+    
+    # Unwrap report parameters that older clients stored double-encoded
+    cursor.execute('''
+        UPDATE reports SET parameters = json_extract(parameters, '$')
+        WHERE json_valid(parameters) AND json_type(parameters) = 'text'
+    ''')
+
+
+def _migrate_risk_cube(cursor):
+    """Deviation counts by category, department, month and risk factors (see analytics.py)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS risk_cube (
+            category TEXT NOT NULL,
+            department TEXT NOT NULL,
+            month TEXT NOT NULL,
+            severity INTEGER NOT NULL,
+            occurrence INTEGER NOT NULL,
+            detection INTEGER NOT NULL,
+            rpn INTEGER NOT NULL,
+            deviation_count INTEGER NOT NULL,
+            PRIMARY KEY (category, department, month, severity, occurrence, detection, rpn)
+        ) WITHOUT ROWID
+    ''')
+    cube_key = 'category, department, month, severity, occurrence, detection, rpn'
+
+    def cube_values(ref):
+        return (f"{ref}.category, COALESCE({ref}.department, ''), substr({ref}.detected_date, 1, 7), "
+                f"{ref}.severity, {ref}.occurrence, {ref}.detection, {ref}.rpn")
+
+    def cube_add(ref):
+        return f'''
+            INSERT INTO risk_cube ({cube_key}, deviation_count)
+            VALUES ({cube_values(ref)}, 1)
+            ON CONFLICT ({cube_key}) DO UPDATE SET deviation_count = deviation_count + 1;
+        '''
+
+    def cube_remove(ref):
+        match = (f"({cube_key}) = ({cube_values(ref)})")
+        return f'''
+            UPDATE risk_cube SET deviation_count = deviation_count - 1 WHERE {match};
+            DELETE FROM risk_cube WHERE {match} AND deviation_count <= 0;
+        '''
+
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_deviations_insert_risk_cube
+        AFTER INSERT ON deviations
+        BEGIN {cube_add('NEW')} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_deviations_delete_risk_cube
+        AFTER DELETE ON deviations
+        BEGIN {cube_remove('OLD')} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_deviations_update_risk_cube
+        AFTER UPDATE OF category, department, detected_date, severity, occurrence, detection, rpn
+        ON deviations
+        BEGIN {cube_remove('OLD')} {cube_add('NEW')} END
+    ''')
+    # Rebuild the cube if it does not account for every deviation (first run or drift)
+    cursor.execute('''
+        SELECT (SELECT COUNT(*) FROM deviations),
+               (SELECT COALESCE(SUM(deviation_count), 0) FROM risk_cube)
+    ''')
+    deviation_total, cube_total = cursor.fetchone()
+    if deviation_total != cube_total:
+        cursor.execute('DELETE FROM risk_cube')
+        cursor.execute(f'''
+            INSERT INTO risk_cube ({cube_key}, deviation_count)
+            SELECT {cube_values('d')}, COUNT(*)
+            FROM deviations d
+            GROUP BY {cube_values('d')}
         ''')
-        
-        # Deviations table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS deviations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                deviation_number TEXT UNIQUE NOT NULL,
-                title TEXT NOT NULL,
-                description TEXT NOT NULL,
-                category TEXT NOT NULL,
-                severity INTEGER NOT NULL,
-                occurrence INTEGER NOT NULL,
-                detection INTEGER NOT NULL,
-                rpn INTEGER NOT NULL,
-                status TEXT NOT NULL DEFAULT 'Open',
-                department TEXT,
-                product_batch TEXT,
-                detected_date DATE NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                created_by INTEGER,
-                FOREIGN KEY (created_by) REFERENCES users(id)
-            )
+
+
+def _migrate_change_log(cursor):
+    """Change log and its triggers feeding /api/changes (see changefeed.py)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity_type TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_change_log_entity
+        ON change_log (entity_type, entity_id, seq)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_change_log_type_seq
+        ON change_log (entity_type, seq)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_log_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            compacted_through INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO change_log_state (id) VALUES (1)')
+    # Start the sequence at 1 so since=0 always means "no cursor yet"
+    cursor.execute('''
+        INSERT INTO sqlite_sequence (name, seq)
+        SELECT 'change_log', 1
+        WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'change_log')
+    ''')
+    
+    for table in CHANGE_FEED_TABLES:
+        for event, op, ref in (('INSERT', 'upsert', 'NEW'),
+                               ('UPDATE', 'upsert', 'NEW'),
+                               ('DELETE', 'delete', 'OLD')):
+            # Rows moved into archive segments are not deletions
+            condition = ''
+            if event == 'DELETE' and table == 'monitoring':
+                condition = f'''WHEN NOT EXISTS (
+                    SELECT 1 FROM archive_segments
+                    WHERE table_name = '{table}' AND OLD.id BETWEEN min_id AND max_id
+                )'''
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_change_log
+                AFTER {event} ON {table} {condition}
+                BEGIN
+                    INSERT INTO change_log (entity_type, entity_id, op)
+                    VALUES ('{table}', {ref}.id, '{op}');
+                END
+            ''')
+
+
+def _migrate_status_history(cursor):
+    """
+    Status transition history of deviations and CAPA (see analytics.py)
+    Triggers record every insert and status change, and stamp left_at on the
+    entry being left, so each row is a complete interval. Existing records
+    are backfilled once from audit_logs.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS status_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity_type TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            from_status TEXT,
+            to_status TEXT NOT NULL,
+            changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            left_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_status_history_entity
+        ON status_history (entity_type, entity_id, changed_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_status_history_status
+        ON status_history (entity_type, to_status, changed_at)
+    ''')
+    for entity, table in STATUS_HISTORY_TABLES.items():
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_insert_status_history
+            AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO status_history (entity_type, entity_id, to_status, changed_at)
+                VALUES ('{entity}', NEW.id, NEW.status, COALESCE(NEW.created_at, CURRENT_TIMESTAMP));
+            END
         ''')
-        
-        # CAPA (Corrective and Preventive Actions) table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS capa (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                capa_number TEXT UNIQUE NOT NULL,
-                deviation_id INTEGER,
-                type TEXT NOT NULL,
-                title TEXT NOT NULL,
-                description TEXT NOT NULL,
-                root_cause TEXT,
-                action_plan TEXT NOT NULL,
-                responsible_person TEXT NOT NULL,
-                target_date DATE NOT NULL,
-                completion_date DATE,
-                status TEXT NOT NULL DEFAULT 'Open',
-                effectiveness TEXT,
-                verification_date DATE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                created_by INTEGER,
-                FOREIGN KEY (deviation_id) REFERENCES deviations(id),
-                FOREIGN KEY (created_by) REFERENCES users(id)
-            )
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_update_status_history
+            AFTER UPDATE OF status ON {table}
+            WHEN OLD.status IS NOT NEW.status
+            BEGIN
+                UPDATE status_history SET left_at = CURRENT_TIMESTAMP
+                WHERE entity_type = '{entity}' AND entity_id = NEW.id AND left_at IS NULL;
+                INSERT INTO status_history (entity_type, entity_id, from_status, to_status)
+                VALUES ('{entity}', NEW.id, OLD.status, NEW.status);
+            END
         ''')
-        
-        # Reports table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS reports (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                report_type TEXT NOT NULL,
-                title TEXT NOT NULL,
-                description TEXT,
-                parameters TEXT,
-                file_path TEXT,
-                file_format TEXT,
-                generated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                generated_by INTEGER,
-                FOREIGN KEY (generated_by) REFERENCES users(id)
-            )
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_delete_status_history
+            AFTER DELETE ON {table}
+            BEGIN
+                DELETE FROM status_history WHERE entity_type = '{entity}' AND entity_id = OLD.id;
+            END
         ''')
-        
-        # Monitoring data table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS monitoring (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                location TEXT NOT NULL,
-                parameter_type TEXT NOT NULL,
-                parameter_name TEXT NOT NULL,
-                value REAL NOT NULL,
-                unit TEXT,
-                min_limit REAL,
-                max_limit REAL,
-                status TEXT NOT NULL,
-                alert_level TEXT,
-                recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                recorded_by INTEGER,
-                FOREIGN KEY (recorded_by) REFERENCES users(id)
+
+    if cursor.execute('SELECT 1 FROM status_history LIMIT 1').fetchone():
+        return
+    for entity, table in STATUS_HISTORY_TABLES.items():
+        # Status-setting audit events, oldest first; UPDATEs that did not touch
+        # status and repeats of the previous status are dropped with LAG()
+        cursor.execute(f'''
+            WITH audited AS (
+                SELECT a.entity_id, a.timestamp AS changed_at, a.id AS audit_id, a.action,
+                       CASE a.action
+                           WHEN 'CREATE' THEN COALESCE(json_extract(a.changes, '$.status'), 'Open')
+                           WHEN 'TRANSITION' THEN json_extract(a.changes, '$.to')
+                           ELSE json_extract(a.changes, '$.status')
+                       END AS to_status,
+                       CASE a.action WHEN 'TRANSITION' THEN json_extract(a.changes, '$.from') END AS from_hint
+                FROM audit_logs a
+                JOIN {table} r ON r.id = a.entity_id
+                WHERE a.entity_type = '{entity}' AND a.action IN ('CREATE', 'UPDATE', 'TRANSITION')
+                  AND json_valid(a.changes)
+                  AND (a.action = 'CREATE' OR json_extract(a.changes, '$.status') IS NOT NULL
+                       OR json_extract(a.changes, '$.to') IS NOT NULL)
+            ),
+            events AS (
+                SELECT entity_id, changed_at, audit_id, to_status FROM audited
+                UNION ALL
+                -- Records created without an audited CREATE start in the status they
+                -- were first transitioned from, or the default
+                SELECT r.id, r.created_at, 0,
+                       COALESCE((SELECT from_hint FROM audited
+                                 WHERE entity_id = r.id AND from_hint IS NOT NULL
+                                 ORDER BY audit_id LIMIT 1),
+                                CASE WHEN EXISTS (SELECT 1 FROM audited WHERE entity_id = r.id)
+                                     THEN 'Open' ELSE r.status END)
+                FROM {table} r
+                WHERE NOT EXISTS (SELECT 1 FROM audited WHERE entity_id = r.id AND action = 'CREATE')
+            ),
+            ordered AS (
+                SELECT entity_id, changed_at, to_status,
+                       LAG(to_status) OVER entity_order AS from_status
+                FROM events
+                WINDOW entity_order AS (PARTITION BY entity_id ORDER BY changed_at, audit_id)
             )
+            INSERT INTO status_history (entity_type, entity_id, from_status, to_status, changed_at)
+            SELECT '{entity}', entity_id, from_status, to_status, COALESCE(changed_at, CURRENT_TIMESTAMP)
+            FROM ordered
+            WHERE from_status IS NULL OR from_status != to_status
+            ORDER BY changed_at, entity_id
         ''')
-        
-        # Audit logs table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS audit_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                action TEXT NOT NULL,
-                entity_type TEXT NOT NULL,
-                entity_id INTEGER,
-                changes TEXT,
-                ip_address TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id)
+        # Changes made without an audit row: close the gap so the newest entry
+        # always holds the current status
+        cursor.execute(f'''
+            INSERT INTO status_history (entity_type, entity_id, from_status, to_status, changed_at)
+            SELECT '{entity}', r.id, h.to_status, r.status, COALESCE(r.updated_at, CURRENT_TIMESTAMP)
+            FROM {table} r
+            JOIN status_history h ON h.id = (
+                SELECT id FROM status_history
+                WHERE entity_type = '{entity}' AND entity_id = r.id
+                ORDER BY changed_at DESC, id DESC LIMIT 1
             )
+            WHERE h.to_status != r.status
         ''')
-        
-        # Batches table
+    cursor.execute('''
+        UPDATE status_history SET left_at = n.next_at
+        FROM (
+            SELECT id, LEAD(changed_at) OVER (
+                PARTITION BY entity_type, entity_id ORDER BY changed_at, id
+            ) AS next_at
+            FROM status_history
+        ) AS n
+        WHERE n.id = status_history.id AND n.next_at IS NOT NULL
+    ''')
+
+
+def _migrate_monitoring_partitions(cursor):
+    """Catalog of the monthly monitoring partition files (see partitions.py)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS monitoring_partitions (
+            month TEXT PRIMARY KEY,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _migrate_partition_counts(cursor):
+    """
+    Readings per status of each monitoring partition, kept by partitions.py so
+    counts need not open every month; counted marks months whose counts are complete
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS monitoring_partition_counts (
+            month TEXT NOT NULL,
+            status TEXT NOT NULL,
+            readings INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (month, status)
+        )
+    ''')
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(monitoring_partitions)')]
+    if 'counted' not in columns:
+        cursor.execute('ALTER TABLE monitoring_partitions ADD COLUMN counted INTEGER NOT NULL DEFAULT 0')
+
+
+def _migrate_maintenance_runs(cursor):
+    """History of maintenance tasks with their before/after measurements (see maintenance.py)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task TEXT NOT NULL,
+            status TEXT NOT NULL,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            duration_ms REAL,
+            details TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_maintenance_runs_task
+        ON maintenance_runs (task, started_at)
+    ''')
+
+
+def _migrate_removal_counters(cursor):
+    """Per-table counts of unlogged row removals (see record_removal)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS removal_counters (
+            table_name TEXT PRIMARY KEY,
+            removals INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+
+# Schema migrations in order: (user_version, description, function taking a cursor).
+# Each schema change is its own migration: append new ones instead of editing
+# applied ones, and keep them idempotent, since all are re-applied if the stored
+# fingerprint no longer matches the schema.
+MIGRATIONS = [
+    (1, 'Baseline schema', _migrate_baseline),
+    (2, 'Archive segment index', _migrate_archive_segments),
+    (3, 'Deviation and CAPA list indexes', _migrate_list_indexes),
+    (4, 'Change log', _migrate_change_log),
+    (5, 'CAPA escalations', _migrate_capa_escalations),
+    (6, 'Document revisions', _migrate_document_revisions),
+    (7, 'Report cache', _migrate_report_cache),
+    (8, 'Risk cube', _migrate_risk_cube),
+    (9, 'Deviation and CAPA status history', _migrate_status_history),
+    (10, 'Monitoring partition catalog', _migrate_monitoring_partitions),
+    (11, 'Maintenance run history', _migrate_maintenance_runs),
+    (12, 'Removal counters', _migrate_removal_counters),
+    (13, 'Monitoring partition counts', _migrate_partition_counts),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_fingerprint(conn):
+    """SHA-256 over the definitions of every table, index, view and trigger"""
+    digest = hashlib.sha256()
+    for row in conn.execute('''
+        SELECT type, name, sql FROM sqlite_master
+        WHERE name NOT LIKE 'sqlite_%' AND name != 'schema_state'
+        ORDER BY type, name
+    '''):
+        digest.update(repr(tuple(row)).encode())
+    return digest.hexdigest()
+
+
+def _schema_state(conn):
+    """(user_version, stored fingerprint); the fingerprint is None before versioning"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    try:
+        row = conn.execute('SELECT fingerprint FROM schema_state WHERE id = 1').fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    return version, row[0] if row else None
+
+
+def init_database():
+    """
+    Bring the current site's database up to SCHEMA_VERSION
+
+    A database already at SCHEMA_VERSION whose schema still matches the
+    stored fingerprint is left untouched, so this costs one PRAGMA and one
+    read of sqlite_master per start. Otherwise the pending migrations (all of
+    them if the schema drifted) run in a single transaction.
+    Returns {'version', 'applied', 'drift'}.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(current_db_path())), exist_ok=True)
+    with get_db_connection() as conn:
+        version, stored = _schema_state(conn)
+        if version == SCHEMA_VERSION and stored == schema_fingerprint(conn):
+            return {'version': version, 'applied': [], 'drift': False}
+
+        # Re-read under the write lock in case another process migrated meanwhile
+        conn.execute('BEGIN IMMEDIATE')
+        version, stored = _schema_state(conn)
+        drift = version == SCHEMA_VERSION and stored != schema_fingerprint(conn)
+        if version == SCHEMA_VERSION and not drift:
+            return {'version': version, 'applied': [], 'drift': False}
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f'Database schema version {version} is newer than this code '
+                               f'({SCHEMA_VERSION})')
+
+        cursor = conn.cursor()
+        applied = []
+        for number, description, migrate in MIGRATIONS:
+            if number > version or drift:
+                migrate(cursor)
+                applied.append(number)
+                print(f"Applied schema migration {number}: {description}")
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS batches (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                batch_number TEXT UNIQUE NOT NULL,
-                product_name TEXT NOT NULL,
-                product_code TEXT,
-                quantity INTEGER NOT NULL,
-                unit TEXT NOT NULL,
-                status TEXT NOT NULL DEFAULT 'In Progress',
-                start_date DATE NOT NULL,
-                completion_date DATE,
-                release_date DATE,
-                expiry_date DATE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            CREATE TABLE IF NOT EXISTS schema_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                fingerprint TEXT NOT NULL,
+                migrated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        
-        # Documents table
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS documents (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                document_number TEXT UNIQUE NOT NULL,
-                title TEXT NOT NULL,
-                document_type TEXT NOT NULL,
-                version TEXT NOT NULL,
-                status TEXT NOT NULL DEFAULT 'Draft',
-                effective_date DATE,
-                review_date DATE,
-                file_path TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                created_by INTEGER,
-                FOREIGN KEY (created_by) REFERENCES users(id)
-            )
-        ''')
-        
+            INSERT OR REPLACE INTO schema_state (id, fingerprint) VALUES (1, ?)
+        ''', (schema_fingerprint(conn),))
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
         conn.commit()
-        print("Database initialized successfully!")
+        print(f"Database schema at version {SCHEMA_VERSION}")
+        return {'version': SCHEMA_VERSION, 'applied': applied, 'drift': drift}
 
 
 def drop_all_tables():
@@ -195,15 +1392,21 @@ def drop_all_tables():
     """
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        tables = ['audit_logs', 'monitoring', 'reports', 'capa', 'deviations', 
+        tables = ['schema_state', 'removal_counters', 'maintenance_runs', 'monitoring_partition_counts',
+                  'monitoring_partitions', 'status_history', 'risk_cube', 'report_cache',
+                  'document_revisions', 'capa_escalations', 'change_log', 'change_log_state',
+                  'archive_segments', 'audit_logs', 'monitoring', 'reports', 'capa', 'deviations',
                   'documents', 'batches', 'users']
         for table in tables:
             cursor.execute(f'DROP TABLE IF EXISTS {table}')
+        cursor.execute('PRAGMA user_version = 0')
         conn.commit()
         print("All tables dropped!")
 
 
 if __name__ == '__main__':
-    print("Initializing database...")
-    init_database()
-    print(f"Database created at: {DB_PATH}")
+    for site in list_sites():
+        with use_site(site):
+            print(f"Initializing database of site {site}...")
+            init_database()
+            print(f"Database created at: {current_db_path()}")
@@ -0,0 +1,487 @@
+"""
+Content-addressed storage for controlled documents
+Uploads are split into content-defined chunks named by their SHA-256, so the
+unchanged parts of a revision share chunk files with earlier revisions even
+when bytes were inserted or removed before them
+"""
+import os
+import json
+import mmap
+import time
+import bisect
+import hashlib
+import secrets
+from database import (get_read_connection, run_write, init_database, list_sites, use_site, site_dir,
+                      current_site, DEFAULT_SITE)
+
+# Directory holding the chunk files (other sites use a subdirectory). Before stores
+# were per site, every site kept its chunks here, so reads fall back to it.
+STORE_DIR = os.environ.get('QMS_DOCUMENT_STORE_DIR',
+                           os.path.join(os.path.dirname(__file__), 'document_store'))
+
+# Bounds for content-defined chunks. Every position gets a byte mixing its own
+# value with the BOUNDARY_CONTEXT bytes before it, and a chunk ends after
+# BOUNDARY_RUN positions in a row whose mixed byte has the top bit set: about
+# 1 MiB past the minimum on compressed content. Revisions record their layout,
+# so older fixed-size revisions still read back.
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+BOUNDARY_CONTEXT = 3
+BOUNDARY_RUN = 19
+
+# Bytes examined per step while looking for a boundary
+BOUNDARY_SCAN = 256 * 1024
+
+# chunk_size stored for content-defined revisions, whose chunks list [digest, length] pairs
+CONTENT_DEFINED = 0
+
+# Mixing tables; changing them moves every boundary and so loses deduplication
+# against existing revisions
+_MIX = [bytes(hashlib.sha256(bytes([back, value])).digest()[0] for value in range(256))
+        for back in range(BOUNDARY_CONTEXT + 1)]
+_TOP_BIT = bytes(value >> 7 for value in range(256))
+_RUN = b'\x01' * BOUNDARY_RUN
+
+# Largest piece yielded to the server while streaming a download
+STREAM_PIECE = 256 * 1024
+
+# Unreferenced chunks younger than this are kept, covering a chunk an upload reuses
+# while garbage collection is deciding to delete it
+GC_MIN_AGE_SECONDS = 3600
+
+# Pending manifests of uploads not touched for this long belong to uploads that died
+PENDING_MAX_AGE_SECONDS = 24 * 3600
+
+
+class DocumentError(ValueError):
+    """Raised for invalid document operations such as duplicate versions"""
+
+
+class DocumentNotFound(DocumentError):
+    """Raised for unknown documents or revisions"""
+
+
+class RangeNotSatisfiable(ValueError):
+    """Raised when a Range header lies entirely outside the content"""
+
+
+def store_dir():
+    """Chunk store of the current site"""
+    return site_dir(STORE_DIR)
+
+
+def _chunk_path(digest, root=None):
+    return os.path.join(root or store_dir(), 'chunks', digest[:2], digest)
+
+
+def _stored_chunk_path(digest):
+    """A chunk of the current site, found in the shared STORE_DIR if it predates per-site stores"""
+    path = _chunk_path(digest)
+    if not os.path.exists(path):
+        shared = _chunk_path(digest, STORE_DIR)
+        if os.path.exists(shared):
+            return shared
+    return path
+
+
+def _read_exact(stream, size):
+    """Read up to size bytes, looping over short reads"""
+    parts = []
+    remaining = size
+    while remaining:
+        data = stream.read(remaining)
+        if not data:
+            break
+        parts.append(data)
+        remaining -= len(data)
+    return b''.join(parts)
+
+
+def _boundary(data, low, high):
+    """
+    Offset just past the first chunk boundary of data ending in [low, high), or None
+
+    A boundary depends only on the BOUNDARY_CONTEXT + BOUNDARY_RUN bytes
+    before it, so an edit moves the boundaries near it and no others. The
+    mixing runs as bytes.translate and integer XOR over BOUNDARY_SCAN bytes
+    at a time rather than a Python loop per byte.
+    """
+    for block in range(low, high, BOUNDARY_SCAN):
+        # Also cover runs that started before the block and the context of their first position
+        start = block - BOUNDARY_RUN + 1 - BOUNDARY_CONTEXT
+        segment = bytes(data[start:min(high, block + BOUNDARY_SCAN)])
+        mixed = 0
+        for back, table in enumerate(_MIX):
+            mixed ^= int.from_bytes(segment.translate(table), 'big') >> (8 * back)
+        flags = mixed.to_bytes(len(segment), 'big').translate(_TOP_BIT)
+        found = flags.find(_RUN, BOUNDARY_CONTEXT)
+        if found >= 0:
+            return start + found + BOUNDARY_RUN
+    return None
+
+
+def _chunk_spans(revision):
+    """(digest, offset, length) of each chunk of a revision, for either layout"""
+    spans = []
+    offset = 0
+    for entry in revision['chunks']:
+        if revision['chunk_size'] == CONTENT_DEFINED:
+            digest, length = entry
+        else:
+            digest, length = entry, min(revision['chunk_size'], revision['byte_size'] - offset)
+        spans.append((digest, offset, length))
+        offset += length
+    return spans
+
+
+def _digests(chunks):
+    return [entry if isinstance(entry, str) else entry[0] for entry in chunks]
+
+
+def _write_chunk(digest, data):
+    """Store a chunk unless it exists; returns True if it was new"""
+    path = _chunk_path(digest)
+    if os.path.exists(path):
+        # Refresh the mtime so garbage collection spares it during this upload
+        os.utime(path)
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{secrets.token_hex(4)}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    os.chmod(path, 0o444)
+    return True
+
+
+class PendingUpload:
+    """
+    Manifest of the chunks an upload in progress relies on
+    Each digest is appended before its chunk is written, so garbage
+    collection keeps the chunks of an upload however long it takes.
+    """
+
+    def __init__(self):
+        directory = os.path.join(store_dir(), 'pending')
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f'{secrets.token_hex(8)}.txt')
+        self._file = open(self.path, 'a')
+
+    def add(self, digest):
+        self._file.write(digest + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+        os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _pending_digests(root):
+    """Digests of a store's uploads in progress; manifests of dead uploads are removed"""
+    digests = set()
+    directory = os.path.join(root, 'pending')
+    if not os.path.isdir(directory):
+        return digests
+    cutoff = time.time() - PENDING_MAX_AGE_SECONDS
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                continue
+            with open(path) as f:
+                digests.update(line.strip() for line in f if line.strip())
+        except FileNotFoundError:
+            # Finished meanwhile; its revision is committed
+            continue
+    return digests
+
+
+def store_stream(stream, pending=None):
+    """
+    Split a readable stream into content-defined chunks and store the new ones
+
+    At most MAX_CHUNK_SIZE bytes are buffered at a time, so arbitrarily large
+    uploads are stored in constant memory. Each chunk is added to pending (a
+    PendingUpload) before it is written.
+    """
+    whole = hashlib.sha256()
+    chunks = []
+    size = 0
+    new_chunks = 0
+    new_bytes = 0
+    buffer = bytearray()
+    exhausted = False
+    while True:
+        # Read a block at a time until the buffer holds a boundary, MAX_CHUNK_SIZE or the rest
+        cut = None
+        scanned = MIN_CHUNK_SIZE
+        while cut is None:
+            limit = min(len(buffer), MAX_CHUNK_SIZE)
+            if limit > scanned:
+                cut = _boundary(buffer, scanned, limit)
+                scanned = limit
+            if cut is None and (exhausted or limit == MAX_CHUNK_SIZE):
+                cut = limit
+            elif cut is None:
+                data = _read_exact(stream, BOUNDARY_SCAN)
+                exhausted = len(data) < BOUNDARY_SCAN
+                buffer += data
+        if not cut:
+            break
+        data = bytes(buffer[:cut])
+        del buffer[:cut]
+        whole.update(data)
+        digest = hashlib.sha256(data).hexdigest()
+        if pending is not None:
+            pending.add(digest)
+        if _write_chunk(digest, data):
+            new_chunks += 1
+            new_bytes += len(data)
+        chunks.append([digest, len(data)])
+        size += len(data)
+    return {
+        'sha256': whole.hexdigest(),
+        'byte_size': size,
+        'chunk_size': CONTENT_DEFINED,
+        'chunks': chunks,
+        'new_chunks': new_chunks,
+        'new_bytes': new_bytes
+    }
+
+
+def add_revision(document_id, version, stream, file_name=None, mime_type=None, user_id=1):
+    """
+    Store an uploaded revision and make it the document's current version
+    Raises DocumentNotFound for an unknown document, DocumentError for an existing version
+    """
+    def check(conn):
+        cursor = conn.cursor()
+        cursor.execute('SELECT id FROM documents WHERE id = ?', (document_id,))
+        if cursor.fetchone() is None:
+            raise DocumentNotFound(f'Document {document_id} not found')
+        cursor.execute('''
+            SELECT 1 FROM document_revisions WHERE document_id = ? AND version = ?
+        ''', (document_id, version))
+        if cursor.fetchone():
+            raise DocumentError(f'Version {version} already exists')
+
+    # Reject early so no chunks are written for a request that cannot succeed
+    with get_read_connection() as conn:
+        check(conn)
+
+    def insert(conn, stored):
+        # Checked again inside the write transaction in case of a concurrent upload
+        check(conn)
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO document_revisions
+            (document_id, version, file_name, mime_type, byte_size, sha256, chunk_size,
+             chunks, uploaded_by)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (document_id, version, file_name, mime_type, stored['byte_size'], stored['sha256'],
+              stored['chunk_size'], json.dumps(stored['chunks']), user_id))
+        revision_id = cursor.lastrowid
+        cursor.execute('''
+            UPDATE documents SET version = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (version, document_id))
+        cursor.execute('''
+            INSERT INTO audit_logs (user_id, action, entity_type, entity_id, changes)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, 'UPLOAD', 'document', document_id,
+              json.dumps({'version': version, 'sha256': stored['sha256'],
+                          'byte_size': stored['byte_size']})))
+        return revision_id
+
+    # The manifest keeps the chunks from garbage collection until the revision references them
+    with PendingUpload() as pending:
+        stored = store_stream(stream, pending)
+        revision_id = run_write(insert, stored)
+    return {
+        'id': revision_id,
+        'document_id': document_id,
+        'version': version,
+        'sha256': stored['sha256'],
+        'byte_size': stored['byte_size'],
+        'chunks': len(stored['chunks']),
+        'new_chunks': stored['new_chunks'],
+        'deduplicated_bytes': stored['byte_size'] - stored['new_bytes']
+    }
+
+
+def list_revisions(conn, document_id):
+    """Revision metadata for a document, newest first"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, document_id, version, file_name, mime_type, byte_size, sha256,
+               uploaded_at, uploaded_by
+        FROM document_revisions
+        WHERE document_id = ?
+        ORDER BY id DESC
+    ''', (document_id,))
+    return [dict(row) for row in cursor.fetchall()]
+
+
+def get_revision(conn, document_id, version=None):
+    """A revision including its chunk list; the latest one if version is None"""
+    cursor = conn.cursor()
+    if version is None:
+        cursor.execute('''
+            SELECT * FROM document_revisions WHERE document_id = ? ORDER BY id DESC LIMIT 1
+        ''', (document_id,))
+    else:
+        cursor.execute('''
+            SELECT * FROM document_revisions WHERE document_id = ? AND version = ?
+        ''', (document_id, version))
+    row = cursor.fetchone()
+    if row is None:
+        raise DocumentNotFound('Revision not found')
+    revision = dict(row)
+    revision['chunks'] = json.loads(revision['chunks'])
+    return revision
+
+
+def parse_range(header, size):
+    """
+    Parse a single-range Range header into inclusive (start, end)
+
+    Returns None when the header is absent, malformed or asks for several
+    ranges; the whole content is then served, as RFC 9110 allows.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[len('bytes='):].strip().partition('-')
+    try:
+        start = int(first) if first else None
+        end = int(last) if last else None
+    except ValueError:
+        return None
+    if start is None:
+        # Suffix range: the last `end` bytes
+        if end is None:
+            return None
+        if end <= 0 or size == 0:
+            raise RangeNotSatisfiable(header)
+        return max(0, size - end), size - 1
+    if end is not None and end < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable(header)
+    end = size - 1 if end is None else end
+    return start, min(end, size - 1)
+
+
+def iter_content(revision, start=0, end=None):
+    """
+    Return an iterator over bytes start..end (inclusive) of a revision
+
+    Each chunk file is memory-mapped and sliced into STREAM_PIECE pieces, so
+    memory use stays constant however large the document or range is. Chunk
+    files are located now, in the current site, not when the server iterates.
+    """
+    end = revision['byte_size'] - 1 if end is None else end
+    spans = [(_stored_chunk_path(digest), offset, length)
+             for digest, offset, length in _chunk_spans(revision)]
+    return _iter_spans(spans, start, end)
+
+
+def _iter_spans(spans, start, end):
+    index = bisect.bisect_right([offset for _, offset, _ in spans], start) - 1
+    position = start
+    while position <= end:
+        path, chunk_start, _ = spans[index]
+        offset = position - chunk_start
+        with open(path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                stop = min(len(mapped), end - chunk_start + 1)
+                while offset < stop:
+                    piece_end = min(offset + STREAM_PIECE, stop)
+                    yield mapped[offset:piece_end]
+                    position += piece_end - offset
+                    offset = piece_end
+        index += 1
+
+
+def _chunk_files(root):
+    chunks = os.path.join(root, 'chunks')
+    if not os.path.isdir(chunks):
+        return []
+    return [(name, os.path.join(chunks, prefix, name))
+            for prefix in os.listdir(chunks) for name in os.listdir(os.path.join(chunks, prefix))]
+
+
+def collect_garbage(min_age_seconds=GC_MIN_AGE_SECONDS):
+    """
+    Delete the current site's chunk files that neither its revisions nor its
+    uploads in progress reference; returns (files, bytes) removed
+
+    Files are listed before the references are read, so a chunk written
+    meanwhile is never a candidate. The default site's store is the shared
+    one of old, so the revisions of every site count there.
+    """
+    root = store_dir()
+    candidates = _chunk_files(root)
+    referenced = _pending_digests(root)
+    for site in list_sites() if current_site() == DEFAULT_SITE else [current_site()]:
+        with use_site(site), get_read_connection() as conn:
+            for row in conn.execute('SELECT chunks FROM document_revisions'):
+                referenced.update(_digests(json.loads(row[0])))
+
+    removed = 0
+    removed_bytes = 0
+    cutoff = time.time() - min_age_seconds
+    for name, path in candidates:
+        if name in referenced or os.path.getmtime(path) > cutoff:
+            continue
+        removed_bytes += os.path.getsize(path)
+        os.remove(path)
+        removed += 1
+    return removed, removed_bytes
+
+
+def store_stats():
+    """Logical bytes across the current site's revisions versus bytes in its store"""
+    with get_read_connection() as conn:
+        logical, revisions = conn.execute(
+            'SELECT COALESCE(SUM(byte_size), 0), COUNT(*) FROM document_revisions'
+        ).fetchone()
+    stored = 0
+    files = 0
+    root = os.path.join(store_dir(), 'chunks')
+    if os.path.isdir(root):
+        for prefix in os.listdir(root):
+            for name in os.listdir(os.path.join(root, prefix)):
+                stored += os.path.getsize(os.path.join(root, prefix, name))
+                files += 1
+    return {
+        'revisions': revisions,
+        'logical_bytes': logical,
+        'stored_bytes': stored,
+        'chunk_files': files
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Document store maintenance')
+    parser.add_argument('--gc', action='store_true', help='Remove unreferenced chunk files')
+    args = parser.parse_args()
+
+    for site in list_sites():
+        with use_site(site):
+            init_database()
+            if args.gc:
+                files, size = collect_garbage()
+                print(f"{site}: removed {files} unreferenced chunk(s), {size} bytes")
+            stats = store_stats()
+            print(f"{site}: {stats['revisions']} revision(s): {stats['logical_bytes']} bytes logical, "
+                  f"{stats['stored_bytes']} bytes in {stats['chunk_files']} chunk file(s)")
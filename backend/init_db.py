@@ -5,7 +5,8 @@ Run this script to create and populate the database with demo data
 import sqlite3
 from datetime import datetime, timedelta
 import random
-from database import init_database, get_db_connection, DB_PATH
+from database import init_database, get_db_connection, get_read_connection, DB_PATH
+import partitions
 
 
 def seed_sample_data():
@@ -127,25 +128,18 @@ def seed_sample_data():
             max_limit = param[4]
             status = 'Normal' if min_limit <= value <= max_limit else 'Out of Spec'
             
-            monitoring_data.append((
-                location,
-                param_type,
-                param[0],
-                value,
-                param[2],
-                min_limit,
-                max_limit,
-                status,
-                'High' if status == 'Out of Spec' else 'None',
-                random.randint(1, 5)
-            ))
-        
-        cursor.executemany('''
-            INSERT INTO monitoring 
-            (location, parameter_type, parameter_name, value, unit, min_limit, 
-             max_limit, status, alert_level, recorded_by)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', monitoring_data)
+            monitoring_data.append({
+                'location': location,
+                'parameter_type': param_type,
+                'parameter_name': param[0],
+                'value': value,
+                'unit': param[2],
+                'min_limit': min_limit,
+                'max_limit': max_limit,
+                'status': status,
+                'alert_level': 'High' if status == 'Out of Spec' else 'None',
+                'recorded_by': random.randint(1, 5)
+            })
         
         # Sample batches
         products = [
@@ -203,7 +197,10 @@ def seed_sample_data():
         ''', reports)
         
         conn.commit()
-        print("Sample data inserted successfully!")
+
+    # Readings go to the current month's partition, as recorded readings do
+    partitions.record_readings(monitoring_data)
+    print("Sample data inserted successfully!")
 
 
 def main():
@@ -230,11 +227,14 @@ def main():
         print("Database Summary:")
         print("=" * 60)
         
-        tables = ['users', 'deviations', 'capa', 'monitoring', 'batches', 'reports']
+        tables = ['users', 'deviations', 'capa', 'batches', 'reports']
         for table in tables:
             cursor.execute(f'SELECT COUNT(*) FROM {table}')
             count = cursor.fetchone()[0]
             print(f"{table.capitalize():20} {count:>5} records")
+    with get_read_connection() as conn:
+        # Main table and monthly partitions
+        print(f"{'Monitoring':20} {partitions.count_readings(conn):>5} records")
     
     print("\n" + "=" * 60)
     print(f"Database location: {DB_PATH}")
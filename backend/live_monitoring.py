@@ -0,0 +1,264 @@
+"""
+In-memory latest-readings ring buffer for live monitoring views
+Keeps the most recent readings of each sensor in compact, preallocated
+arrays so the live endpoints are served without querying the readings; a
+single counter lookup per request notices readings archived or dropped elsewhere
+"""
+import os
+import math
+import heapq
+import threading
+from array import array
+from database import get_read_connection, removal_count
+import partitions
+
+# Readings kept per sensor unless overridden in depth_overrides
+DEFAULT_DEPTH = int(os.environ.get('QMS_LIVE_DEPTH', 200))
+
+# Upper bound on sensors held in memory; least recently updated are evicted
+DEFAULT_MAX_SENSORS = int(os.environ.get('QMS_LIVE_MAX_SENSORS', 2048))
+
+MONITORING_COLUMNS = (
+    'id', 'location', 'parameter_type', 'parameter_name', 'value', 'unit',
+    'min_limit', 'max_limit', 'status', 'alert_level', 'recorded_at', 'recorded_by'
+)
+
+_NULL_INT = -(2 ** 63)
+_NAN = float('nan')
+
+
+class StringTable:
+    """Interns low-cardinality strings (units, statuses) as small integer codes"""
+
+    def __init__(self):
+        self._codes = {None: 0}
+        self._values = [None]
+
+    def code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self._values)
+            self._values.append(value)
+        return code
+
+    def value(self, code):
+        return self._values[code]
+
+
+class SensorRing:
+    """
+    Fixed-depth ring of readings for one sensor
+
+    Numeric columns live in typed arrays and repeated strings are stored as
+    codes into a shared StringTable; only recorded_at keeps a Python string
+    per slot so it round-trips exactly as SQLite returned it.
+    """
+
+    def __init__(self, key, depth, strings):
+        self.key = key
+        self.depth = depth
+        self.strings = strings
+        self.ids = array('q', [0] * depth)
+        self.values = array('d', [0.0] * depth)
+        self.min_limits = array('d', [_NAN] * depth)
+        self.max_limits = array('d', [_NAN] * depth)
+        self.recorded_by = array('q', [_NULL_INT] * depth)
+        self.codes = array('H', [0] * (depth * 3))  # unit, status, alert_level
+        self.recorded_at = [None] * depth
+        self.head = 0
+        self.count = 0
+        # True when older readings exist in the database than the ring holds
+        self.truncated = False
+
+    def append(self, row):
+        i = self.head
+        if self.count == self.depth:
+            self.truncated = True
+        else:
+            self.count += 1
+        self.ids[i] = row['id']
+        self.values[i] = row['value']
+        self.min_limits[i] = _NAN if row['min_limit'] is None else row['min_limit']
+        self.max_limits[i] = _NAN if row['max_limit'] is None else row['max_limit']
+        self.recorded_by[i] = _NULL_INT if row['recorded_by'] is None else row['recorded_by']
+        self.codes[i * 3] = self.strings.code(row['unit'])
+        self.codes[i * 3 + 1] = self.strings.code(row['status'])
+        self.codes[i * 3 + 2] = self.strings.code(row['alert_level'])
+        self.recorded_at[i] = row['recorded_at']
+        self.head = (i + 1) % self.depth
+
+    def slots(self):
+        start = (self.head - self.count) % self.depth
+        return [(start + n) % self.depth for n in range(self.count)]
+
+    def sort_key(self, i):
+        return (self.recorded_at[i] or '', self.ids[i])
+
+    def oldest_key(self):
+        return min(self.sort_key(i) for i in self.slots()) if self.count else None
+
+    def row(self, i):
+        location, parameter_type, parameter_name = self.key
+        min_limit = self.min_limits[i]
+        max_limit = self.max_limits[i]
+        recorded_by = self.recorded_by[i]
+        return {
+            'id': self.ids[i],
+            'location': location,
+            'parameter_type': parameter_type,
+            'parameter_name': parameter_name,
+            'value': self.values[i],
+            'unit': self.strings.value(self.codes[i * 3]),
+            'min_limit': None if math.isnan(min_limit) else min_limit,
+            'max_limit': None if math.isnan(max_limit) else max_limit,
+            'status': self.strings.value(self.codes[i * 3 + 1]),
+            'alert_level': self.strings.value(self.codes[i * 3 + 2]),
+            'recorded_at': self.recorded_at[i],
+            'recorded_by': None if recorded_by == _NULL_INT else recorded_by
+        }
+
+    def nbytes(self):
+        arrays = (self.ids, self.values, self.min_limits, self.max_limits,
+                  self.recorded_by, self.codes)
+        return sum(a.itemsize * len(a) for a in arrays) + 8 * self.depth
+
+
+class LiveMonitoringBuffer:
+    """
+    Per-sensor ring buffers serving the live monitoring endpoints
+
+    latest() returns None whenever the buffer cannot prove its answer equals
+    the SQL result (a truncated sensor could hide a newer-than-cutoff reading,
+    or a sensor of that type was evicted); callers then fall back to SQL.
+    """
+
+    def __init__(self, depth=DEFAULT_DEPTH, max_sensors=DEFAULT_MAX_SENSORS, depth_overrides=None):
+        self.depth = depth
+        self.max_sensors = max_sensors
+        # Maps a (location, parameter_type, parameter_name) key or a
+        # parameter_name to a custom depth
+        self.depth_overrides = dict(depth_overrides or {})
+        self._strings = StringTable()
+        self._sensors = {}
+        self._evicted_types = set()
+        self._lock = threading.Lock()
+        self._warmed = False
+        # Removal count of the monitoring table the buffer was loaded at
+        self._removals = None
+        self.hits = 0
+        self.fallbacks = 0
+
+    def _depth_for(self, key):
+        return self.depth_overrides.get(key, self.depth_overrides.get(key[2], self.depth))
+
+    def _sensor(self, key):
+        sensor = self._sensors.pop(key, None)
+        if sensor is None:
+            if len(self._sensors) >= self.max_sensors:
+                evicted_key = next(iter(self._sensors))
+                del self._sensors[evicted_key]
+                self._evicted_types.add(evicted_key[1])
+            sensor = SensorRing(key, self._depth_for(key), self._strings)
+        # Re-insert so dict order tracks recency of updates
+        self._sensors[key] = sensor
+        return sensor
+
+    def warm(self, conn=None):
+        """Load the latest readings of every sensor from the database"""
+        if conn is None:
+            with get_read_connection() as conn:
+                return self.warm(conn)
+
+        removals = removal_count(conn, 'monitoring')
+        max_depth = max([self.depth] + list(self.depth_overrides.values()))
+        # Newest readings per sensor in each source (the main table and the
+        # monthly partitions), merged per sensor
+        candidates = {}
+        totals = {}
+        for _, source in partitions.each_source(conn):
+            for row in source.execute('''
+                SELECT * FROM (
+                    SELECT m.*,
+                           ROW_NUMBER() OVER w AS rn,
+                           COUNT(*) OVER (PARTITION BY location, parameter_type, parameter_name) AS total
+                    FROM monitoring m
+                    WINDOW w AS (PARTITION BY location, parameter_type, parameter_name
+                                 ORDER BY recorded_at DESC, id DESC)
+                )
+                WHERE rn <= ?
+            ''', (max_depth,)):
+                key = (row['location'], row['parameter_type'], row['parameter_name'])
+                candidates.setdefault(key, []).append(row)
+                if row['rn'] == 1:
+                    totals[key] = totals.get(key, 0) + row['total']
+        rows = []
+        for key, found in candidates.items():
+            found.sort(key=lambda row: (row['recorded_at'], row['id']), reverse=True)
+            rows.extend((key, rn, row) for rn, row in enumerate(found[:max_depth], 1))
+        rows.sort(key=lambda entry: (entry[2]['recorded_at'], entry[2]['id']))
+
+        with self._lock:
+            self._sensors.clear()
+            self._evicted_types.clear()
+            for key, rn, row in rows:
+                if rn > self._depth_for(key):
+                    continue
+                sensor = self._sensor(key)
+                sensor.append(row)
+                if totals[key] > sensor.depth:
+                    sensor.truncated = True
+            self._warmed = True
+            self._removals = removals
+        return len(rows)
+
+    def ensure_current(self):
+        """Reload when readings left the database (archived, month dropped) since the last warm"""
+        with get_read_connection() as conn:
+            if not self._warmed or removal_count(conn, 'monitoring') != self._removals:
+                self.warm(conn)
+
+    def append(self, row):
+        """Add a newly committed reading"""
+        key = (row['location'], row['parameter_type'], row['parameter_name'])
+        with self._lock:
+            if self._warmed:
+                self._sensor(key).append(row)
+
+    def latest(self, parameter_type, location=None, limit=100):
+        """
+        Newest readings for a parameter type (and optional location)
+        Returns None when the answer must come from SQL instead
+        """
+        self.ensure_current()
+        with self._lock:
+            if parameter_type in self._evicted_types:
+                self.fallbacks += 1
+                return None
+            sensors = [s for key, s in self._sensors.items()
+                       if key[1] == parameter_type and (location is None or key[0] == location)]
+            candidates = ((s.sort_key(i), s, i) for s in sensors for i in s.slots())
+            top = heapq.nlargest(limit, candidates, key=lambda c: c[0])
+
+            for sensor in sensors:
+                if sensor.truncated:
+                    # Hidden readings are older than the sensor's oldest slot;
+                    # they can only be missing if the result reaches past it
+                    if len(top) < limit or top[-1][0] < sensor.oldest_key():
+                        self.fallbacks += 1
+                        return None
+
+            self.hits += 1
+            return [s.row(i) for _, s, i in top]
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'sensors': len(self._sensors),
+                'max_sensors': self.max_sensors,
+                'default_depth': self.depth,
+                'readings': sum(s.count for s in self._sensors.values()),
+                'approx_bytes': sum(s.nbytes() for s in self._sensors.values()),
+                'evicted_parameter_types': sorted(self._evicted_types),
+                'hits': self.hits,
+                'sql_fallbacks': self.fallbacks
+            }
@@ -0,0 +1,568 @@
+"""
+Database health inspection and scheduled maintenance
+Reports where the space goes (dbstat), free-list fragmentation, WAL size,
+planner statistics age and index advice for the statements the API actually
+ran, and runs ANALYZE, PRAGMA optimize, WAL checkpoints and incremental vacuum
+in quiet periods of a nightly window, recording timings before and after
+"""
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timedelta
+from database import (get_read_connection, read_transaction, run_write, current_db_path, statement_samples,
+                      set_query_deadline, clear_query_deadline, QueryTimeout, init_database, set_site,
+                      use_site, list_sites, DEFAULT_SITE)
+import partitions
+
+logger = logging.getLogger(__name__)
+
+# Local hours during which scheduled maintenance may run, as "start-end" (may wrap midnight)
+MAINTENANCE_WINDOW = os.environ.get('QMS_MAINTENANCE_WINDOW', '1-5')
+
+# Minutes between checks for a quiet moment inside the window
+CHECK_INTERVAL_MINUTES = float(os.environ.get('QMS_MAINTENANCE_CHECK_MINUTES', 10))
+
+# Requests per minute below which the server counts as quiet
+QUIET_REQUESTS_PER_MINUTE = float(os.environ.get('QMS_MAINTENANCE_QUIET_RPM', 30))
+
+# Hours between scheduled runs of each task
+TASK_INTERVAL_HOURS = {
+    'checkpoint': 1,
+    'optimize': 24,
+    'analyze': 7 * 24,
+    'incremental_vacuum': 24,
+}
+
+# Rows ANALYZE samples per index (PRAGMA analysis_limit); 0 analyzes everything
+ANALYSIS_LIMIT = int(os.environ.get('QMS_ANALYSIS_LIMIT', 1000))
+
+# Relative change in a table's row count after which its statistics count as stale;
+# tables smaller than STATS_MIN_ROWS are left to the planner's defaults
+STATS_DRIFT = 0.25
+STATS_MIN_ROWS = 500
+
+# Free pages returned to the file system per incremental vacuum, bounding the write lock
+VACUUM_PAGES = 2000
+
+# Full scans of tables smaller than this are not reported as missing indexes
+FULL_SCAN_MIN_ROWS = 500
+
+# Sampled statements timed before and after each task, their repetitions and time budget
+PROBE_STATEMENTS = 10
+PROBE_REPEAT = 3
+PROBE_BUDGET = 5.0
+
+AUTO_VACUUM_MODES = {0: 'none', 1: 'full', 2: 'incremental'}
+
+# Endpoints serving this module; their own statements are not index advice material
+MAINTENANCE_ENDPOINTS = ('get_maintenance_health', 'get_maintenance_runs', 'run_maintenance_tasks')
+
+_SQL_KEYWORDS = {'where', 'on', 'join', 'left', 'right', 'inner', 'outer', 'cross', 'group', 'order',
+                 'limit', 'union', 'using', 'natural', 'as', 'select', 'window', 'having'}
+
+
+# ===================================
+# Health Report
+# ===================================
+
+def file_stats(conn, path):
+    """Size, free-list and WAL figures of one database file"""
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    freelist = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    wal_path = path + '-wal'
+    return {
+        'path': path,
+        'file_bytes': page_size * page_count,
+        'page_size': page_size,
+        'page_count': page_count,
+        'freelist_pages': freelist,
+        'free_fraction': round(freelist / page_count, 4) if page_count else 0.0,
+        'auto_vacuum': AUTO_VACUUM_MODES.get(conn.execute('PRAGMA auto_vacuum').fetchone()[0]),
+        'wal_bytes': os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+    }
+
+
+def storage(conn):
+    """Pages, bytes and unused bytes of every table and index, largest first"""
+    return [dict(row) for row in conn.execute('''
+        SELECT d.name, COALESCE(m.type, 'table') AS type, COALESCE(m.tbl_name, d.name) AS table_name,
+               d.pageno AS pages, d.pgsize AS bytes, d.unused AS unused_bytes
+        FROM dbstat('main', 1) d
+        LEFT JOIN sqlite_master m ON m.name = d.name
+        ORDER BY d.pgsize DESC, d.name
+    ''')]
+
+
+def _user_tables(conn):
+    return [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+    )]
+
+
+def statistics(conn):
+    """
+    Age of the planner statistics and tables whose row count drifted by more
+    than STATS_DRIFT since they were gathered (or that never were)
+    """
+    estimates = {}
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+        for table, stat in conn.execute('SELECT tbl, stat FROM sqlite_stat1'):
+            estimates[table] = max(estimates.get(table, 0), int(stat.split()[0]))
+    analyzed_at = conn.execute('''
+        SELECT MAX(started_at) FROM maintenance_runs
+        WHERE task IN ('analyze', 'optimize') AND status = 'ok'
+    ''').fetchone()[0]
+
+    tables = []
+    for table in _user_tables(conn):
+        rows = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+        estimated = estimates.get(table)
+        drift = None if estimated is None else round(abs(rows - estimated) / max(estimated, 1), 3)
+        tables.append({'table': table, 'rows': rows, 'estimated_rows': estimated, 'drift': drift})
+
+    age = None
+    if analyzed_at:
+        age = (datetime.utcnow() - datetime.fromisoformat(analyzed_at)).total_seconds() / 3600
+    return {
+        'analyzed_at': analyzed_at,
+        'age_hours': round(age, 1) if age is not None else None,
+        'stale_tables': [t['table'] for t in tables
+                         if t['rows'] >= STATS_MIN_ROWS and (t['drift'] is None or t['drift'] > STATS_DRIFT)],
+        'tables': tables
+    }
+
+
+def _shape(sql):
+    """Statement text with literals replaced, so repeated runs of one query compare equal"""
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\?(?:\s*,\s*\?)+', '?', sql)
+    return ' '.join(sql.split())
+
+
+def sampled_statements():
+    """Distinct read statements recently run by requests: shape -> (example SQL, endpoints)"""
+    statements = {}
+    for endpoint, samples in statement_samples().items():
+        if endpoint in MAINTENANCE_ENDPOINTS:
+            continue
+        for sql in samples:
+            if not re.match(r'\s*(SELECT|WITH)\b', sql, re.IGNORECASE):
+                continue
+            shape = _shape(sql)
+            if shape not in statements:
+                statements[shape] = (sql, set())
+            statements[shape][1].add(endpoint)
+    return statements
+
+
+def _aliases(sql, tables):
+    """Map each table name or alias in FROM/JOIN clauses to its table"""
+    aliases = {}
+    for table, alias in re.findall(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', sql, re.IGNORECASE):
+        if table not in tables:
+            continue
+        aliases[table] = table
+        if alias and alias.lower() not in _SQL_KEYWORDS:
+            aliases[alias] = table
+    return aliases
+
+
+def _candidate_columns(conn, sql, table, aliases):
+    """Columns of table compared in the statement, equality comparisons first"""
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')}
+    equality, ranges = [], []
+    for qualifier, column, op in re.findall(
+        r'\b(?:(\w+)\.)?(\w+)\s*(=|!=|<>|<=|>=|<|>|\bIN\b|\bLIKE\b|\bBETWEEN\b)', sql, re.IGNORECASE
+    ):
+        if column not in columns or (qualifier and aliases.get(qualifier) != table) or op in ('!=', '<>'):
+            continue
+        target = equality if op.upper() in ('=', 'IN') else ranges
+        if column not in equality and column not in ranges:
+            target.append(column)
+    return equality + ranges
+
+
+def index_advice(conn, sizes):
+    """
+    Indexes no sampled statement used and full scans that an index could avoid
+
+    Used indexes come from the OpenRead instructions of each statement's
+    program, full scans from its query plan. Only reads made by requests are
+    sampled, so an index reported unused may still serve writes or triggers.
+    """
+    names_by_root = {row[0]: (row[1], row[2]) for row in conn.execute(
+        "SELECT rootpage, name, type FROM sqlite_master WHERE rootpage > 0"
+    )}
+    tables = set(_user_tables(conn))
+    row_counts = {}
+    used = set()
+    missing = []
+    analyzed = 0
+    for shape, (sql, endpoints) in sampled_statements().items():
+        # Samples are traced with the request's values expanded in, so they run as recorded
+        try:
+            program = conn.execute(f'EXPLAIN {sql}').fetchall()
+            plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}')]
+        except sqlite3.Error:
+            continue
+        analyzed += 1
+        for row in program:
+            if row[1] == 'OpenRead' and row[4] == 0 and names_by_root.get(row[3], (None, ''))[1] == 'index':
+                used.add(names_by_root[row[3]][0])
+
+        aliases = _aliases(sql, tables)
+        for detail in plan:
+            scanned = re.fullmatch(r'SCAN (\w+)', detail)
+            if not scanned or scanned.group(1) not in aliases:
+                continue
+            table = aliases[scanned.group(1)]
+            if table not in row_counts:
+                row_counts[table] = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+            columns = _candidate_columns(conn, sql, table, aliases)
+            if row_counts[table] < FULL_SCAN_MIN_ROWS or not columns:
+                continue
+            missing.append({
+                'table': table,
+                'rows': row_counts[table],
+                'endpoints': sorted(endpoints),
+                'statement': shape,
+                'plan': plan,
+                'candidate_columns': columns,
+                'suggestion': f"CREATE INDEX idx_{table}_{'_'.join(columns[:3])} "
+                              f"ON {table} ({', '.join(columns[:3])})"
+            })
+
+    bytes_by_name = {s['name']: s['bytes'] for s in sizes}
+    unused = [{'index': name, 'table': table, 'bytes': bytes_by_name.get(name, 0)}
+              for name, table in conn.execute('''
+                  SELECT name, tbl_name FROM sqlite_master
+                  WHERE type = 'index' AND name NOT LIKE 'sqlite_autoindex_%'
+                  ORDER BY tbl_name, name
+              ''') if name not in used]
+    return {
+        'statements_analyzed': analyzed,
+        'used_indexes': sorted(used),
+        'unused_indexes': unused if analyzed else [],
+        'missing_indexes': missing
+    }
+
+
+def list_runs(limit=50, task=None):
+    """Recent maintenance runs, newest first"""
+    query = 'SELECT * FROM maintenance_runs'
+    params = []
+    if task:
+        query += ' WHERE task = ?'
+        params.append(task)
+    query += ' ORDER BY id DESC LIMIT ?'
+    params.append(limit)
+    with get_read_connection() as conn:
+        return [dict(row, details=json.loads(row['details'] or '{}')) for row in conn.execute(query, params)]
+
+
+def health_report():
+    """Everything the inspector knows about the current site's database, in one snapshot"""
+    db_path = os.path.abspath(current_db_path())
+    with get_read_connection() as conn:
+        with read_transaction(conn):
+            sizes = storage(conn)
+            report = {
+                'generated_at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+                'database': file_stats(conn, db_path),
+                'storage': sizes,
+                'statistics': statistics(conn),
+                'indexes': index_advice(conn, sizes),
+                'due_tasks': due_tasks(conn)
+            }
+            months = partitions.list_months(conn)
+    report['partitions'] = {}
+    for month in months:
+        path = partitions.partition_path(month)
+        if os.path.exists(path):
+            with get_read_connection(path) as partition:
+                report['partitions'][month] = file_stats(partition, path)
+    report['recent_runs'] = list_runs(20)
+    return report
+
+
+# ===================================
+# Maintenance Tasks
+# ===================================
+
+def _snapshot():
+    """File figures that maintenance tasks change, for before/after comparison"""
+    db_path = os.path.abspath(current_db_path())
+    with get_read_connection() as conn:
+        stats = file_stats(conn, db_path)
+        stat_rows = 0
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+            stat_rows = conn.execute('SELECT COUNT(*) FROM sqlite_stat1').fetchone()[0]
+        months = partitions.list_months(conn)
+    wal_paths = [partitions.partition_path(m) + '-wal' for m in months]
+    return {
+        'page_count': stats['page_count'],
+        'freelist_pages': stats['freelist_pages'],
+        'wal_bytes': stats['wal_bytes'],
+        'partition_wal_bytes': sum(os.path.getsize(p) for p in wal_paths if os.path.exists(p)),
+        'stat1_rows': stat_rows
+    }
+
+
+def _probe(statements):
+    """
+    Best-of-PROBE_REPEAT milliseconds of each sampled statement (None if it failed or ran out of time)
+    The statements are re-run with the literal values of the requests they were sampled from
+    """
+    timings = {}
+    token = set_query_deadline(PROBE_BUDGET)
+    try:
+        for shape, sql in statements:
+            best = None
+            try:
+                with get_read_connection() as conn:
+                    for _ in range(PROBE_REPEAT):
+                        started = time.perf_counter()
+                        conn.execute(sql).fetchall()
+                        elapsed = (time.perf_counter() - started) * 1000
+                        best = elapsed if best is None else min(best, elapsed)
+            except (sqlite3.Error, QueryTimeout):
+                best = None
+            timings[shape] = round(best, 3) if best is not None else None
+    finally:
+        clear_query_deadline(token)
+    return timings
+
+
+def _analyze():
+    def analyze(conn):
+        conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+        conn.execute('ANALYZE')
+    run_write(analyze)
+    return {}
+
+
+def _optimize():
+    def optimize(conn):
+        conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+        conn.execute('PRAGMA optimize').fetchall()
+    run_write(optimize)
+    return {}
+
+
+def _checkpoint():
+    """Checkpoint and truncate the WAL of the main file and of every partition"""
+    with get_read_connection() as conn:
+        paths = [os.path.abspath(current_db_path())] + [
+            partitions.partition_path(m) for m in partitions.list_months(conn)
+        ]
+    results = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        conn = sqlite3.connect(path, timeout=1, isolation_level=None)
+        try:
+            busy, log_frames, checkpointed = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        finally:
+            conn.close()
+        results[os.path.basename(path)] = {'busy': bool(busy), 'log_frames': log_frames,
+                                           'checkpointed_frames': checkpointed}
+    return {'files': results}
+
+
+def _incremental_vacuum():
+    with get_read_connection() as conn:
+        mode = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    if AUTO_VACUUM_MODES.get(mode) != 'incremental':
+        return {'status': 'skipped',
+                'reason': f'auto_vacuum is {AUTO_VACUUM_MODES.get(mode)}; run maintenance.py '
+                          '--enable-incremental-vacuum once to convert the database'}
+    if not free:
+        return {'status': 'skipped', 'reason': 'no free pages'}
+    pages = min(free, VACUUM_PAGES)
+    run_write(lambda conn: conn.execute(f'PRAGMA incremental_vacuum({pages})').fetchall())
+    return {'pages_requested': pages}
+
+
+TASKS = {
+    'checkpoint': _checkpoint,
+    'optimize': _optimize,
+    'analyze': _analyze,
+    'incremental_vacuum': _incremental_vacuum,
+}
+
+
+def run_task(task, statements=()):
+    """
+    Run one maintenance task and record it in maintenance_runs
+    File figures and the timings of the given (shape, sql) statements are
+    taken before and after the task.
+    """
+    if task not in TASKS:
+        raise ValueError(f"Unknown maintenance task: {task}")
+    started_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    before = {**_snapshot(), 'query_ms': _probe(statements)}
+    started = time.perf_counter()
+    try:
+        details = TASKS[task]()
+        status = details.pop('status', 'ok')
+    except Exception as e:
+        details, status = {'error': str(e)}, 'failed'
+    duration_ms = round((time.perf_counter() - started) * 1000, 2)
+    if status == 'ok':
+        details['before'] = before
+        details['after'] = {**_snapshot(), 'query_ms': _probe(statements)}
+
+    run_write(lambda conn: conn.execute('''
+        INSERT INTO maintenance_runs (task, status, started_at, duration_ms, details)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (task, status, started_at, duration_ms, json.dumps(details))))
+    return {'task': task, 'status': status, 'started_at': started_at, 'duration_ms': duration_ms,
+            'details': details}
+
+
+def run_maintenance(tasks=None):
+    """Run the given tasks (default: all) in order, timing a sample of real statements around each"""
+    tasks = list(tasks or TASKS)
+    unknown = [t for t in tasks if t not in TASKS]
+    if unknown:
+        raise ValueError(f"Unknown maintenance tasks: {', '.join(unknown)}")
+    statements = [(shape, sql) for shape, (sql, _) in sampled_statements().items()][:PROBE_STATEMENTS]
+    return [run_task(task, statements) for task in tasks]
+
+
+def enable_incremental_vacuum():
+    """
+    Switch the database to auto_vacuum=INCREMENTAL, which needs a full VACUUM
+    The VACUUM rewrites the whole file and blocks writers while it runs, so
+    this is a one-off step for a maintenance window rather than a scheduled task.
+    """
+    conn = sqlite3.connect(current_db_path(), timeout=30, isolation_level=None)
+    try:
+        started = time.perf_counter()
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        return {'auto_vacuum': AUTO_VACUUM_MODES[conn.execute('PRAGMA auto_vacuum').fetchone()[0]],
+                'duration_ms': round((time.perf_counter() - started) * 1000, 2)}
+    finally:
+        conn.close()
+
+
+# ===================================
+# Scheduling
+# ===================================
+
+def in_window(now, window=None):
+    """Whether a local time falls in a "start-end" hour window (end exclusive, may wrap midnight)"""
+    start, end = (int(hour) for hour in (window or MAINTENANCE_WINDOW).split('-'))
+    if start <= end:
+        return start <= now.hour < end
+    return now.hour >= start or now.hour < end
+
+
+def due_tasks(conn):
+    """Tasks whose interval has passed since they last ran, plus analyze when statistics are stale"""
+    last_runs = dict(conn.execute('''
+        SELECT task, MAX(started_at) FROM maintenance_runs WHERE status != 'failed' GROUP BY task
+    '''))
+    now = datetime.utcnow()
+    due = [task for task, hours in TASK_INTERVAL_HOURS.items()
+           if task not in last_runs
+           or now - datetime.fromisoformat(last_runs[task]) >= timedelta(hours=hours)]
+    if 'analyze' not in due and statistics(conn)['stale_tables']:
+        due.append('analyze')
+    return [task for task in TASKS if task in due]
+
+
+def run_due_maintenance():
+    """Run the current site's due tasks; returns their results"""
+    with get_read_connection() as conn:
+        tasks = due_tasks(conn)
+    return run_maintenance(tasks) if tasks else []
+
+
+def start_maintenance_thread(activity=None, interval_minutes=CHECK_INTERVAL_MINUTES):
+    """
+    Run every site's due maintenance tasks on a daemon thread, only inside
+    the maintenance window and while the server is quiet: nothing in progress
+    and fewer than QUIET_REQUESTS_PER_MINUTE requests since the last check.
+    activity() returns (requests in progress, requests admitted so far), as
+    AdmissionController.activity does.
+    """
+    stop = threading.Event()
+
+    def loop():
+        last_admitted = None
+        while not stop.wait(interval_minutes * 60):
+            try:
+                busy, admitted = activity() if activity else (0, 0)
+            except Exception:
+                logger.exception('Reading server activity for maintenance failed')
+                continue
+            rate = None if last_admitted is None else (admitted - last_admitted) / interval_minutes
+            last_admitted = admitted
+            if busy or rate is None or rate >= QUIET_REQUESTS_PER_MINUTE or not in_window(datetime.now()):
+                continue
+            for site in list_sites():
+                try:
+                    with use_site(site):
+                        for result in run_due_maintenance():
+                            logger.info('Maintenance of site %s: %s %s in %s ms', site, result['task'],
+                                        result['status'], result['duration_ms'])
+                except Exception:
+                    logger.exception('Scheduled maintenance of site %s failed', site)
+
+    threading.Thread(target=loop, name='qms-maintenance', daemon=True).start()
+    return stop
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Inspect database health and run maintenance')
+    parser.add_argument('--run', nargs='*', metavar='TASK', choices=sorted(TASKS),
+                        help='Run maintenance tasks now (default: all)')
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help='Convert the database to auto_vacuum=INCREMENTAL (full VACUUM)')
+    parser.add_argument('--site', default=DEFAULT_SITE, help='Site whose database to use')
+    args = parser.parse_args()
+
+    set_site(args.site)
+    init_database()
+    if args.enable_incremental_vacuum:
+        result = enable_incremental_vacuum()
+        print(f"auto_vacuum is now {result['auto_vacuum']} ({result['duration_ms']} ms)")
+    elif args.run is not None:
+        for result in run_maintenance(args.run or None):
+            print(f"{result['task']:20} {result['status']:8} {result['duration_ms']:>10} ms")
+            if result['status'] != 'ok':
+                print(f"    {result['details'].get('reason') or result['details'].get('error')}")
+    else:
+        report = health_report()
+        db = report['database']
+        print(f"{db['path']}: {db['file_bytes']} bytes, {db['freelist_pages']} free pages "
+              f"({db['free_fraction']:.1%}), WAL {db['wal_bytes']} bytes, auto_vacuum {db['auto_vacuum']}")
+        print("\nLargest tables and indexes:")
+        for entry in report['storage'][:15]:
+            print(f"  {entry['name']:40} {entry['type']:6} {entry['bytes']:>12} bytes "
+                  f"{entry['unused_bytes']:>10} unused")
+        stats = report['statistics']
+        print(f"\nStatistics gathered: {stats['analyzed_at'] or 'never recorded'}; "
+              f"stale: {', '.join(stats['stale_tables']) or 'none'}")
+        indexes = report['indexes']
+        print(f"\nIndex advice from {indexes['statements_analyzed']} sampled statements "
+              f"(the server samples statements as requests run; a fresh process has none)")
+        for entry in indexes['missing_indexes']:
+            print(f"  full scan of {entry['table']} ({entry['rows']} rows) for "
+                  f"{', '.join(entry['endpoints'])}: {entry['suggestion']}")
+        for entry in indexes['unused_indexes']:
+            print(f"  unused: {entry['index']} on {entry['table']} ({entry['bytes']} bytes)")
+        for month, part in report['partitions'].items():
+            print(f"Partition {month}: {part['file_bytes']} bytes, WAL {part['wal_bytes']} bytes")
+        print(f"\nDue tasks: {', '.join(report['due_tasks']) or 'none'}")
@@ -0,0 +1,437 @@
+"""
+Monthly partitions for monitoring readings
+Each month's readings live in their own SQLite file, attached to the writer
+connection when a reading for that month arrives. Time-range reads consult the
+monitoring_partitions catalog and never open months outside the range, and an
+expired month is dropped by deleting its file instead of its rows. Readings
+recorded before partitioning stay in the main monitoring table, which is read
+as the oldest source.
+"""
+import os
+import re
+from datetime import datetime
+from database import (get_read_connection, run_write, current_db_path, close_read_pool, init_database,
+                      record_removal, set_site, DEFAULT_SITE)
+
+# Ids are allocated from a separate range per month, so they stay unique across
+# partitions and the month of a reading follows from its id
+MONTH_ID_SPAN = 10 ** 9
+
+MONTH_PATTERN = re.compile(r'^\d{4}-(0[1-9]|1[0-2])$')
+
+MONITORING_COLUMNS = ('location', 'parameter_type', 'parameter_name', 'value', 'unit', 'min_limit',
+                      'max_limit', 'status', 'alert_level', 'recorded_at', 'recorded_by')
+
+# Same columns as the main monitoring table; users live in the main file, so no foreign key
+PARTITION_SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS {schema}.monitoring (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        location TEXT NOT NULL,
+        parameter_type TEXT NOT NULL,
+        parameter_name TEXT NOT NULL,
+        value REAL NOT NULL,
+        unit TEXT,
+        min_limit REAL,
+        max_limit REAL,
+        status TEXT NOT NULL,
+        alert_level TEXT,
+        recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        recorded_by INTEGER
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS {schema}.idx_monitoring_recorded_at ON monitoring (recorded_at)',
+    '''CREATE INDEX IF NOT EXISTS {schema}.idx_monitoring_type_recorded_at
+       ON monitoring (parameter_type, recorded_at)''',
+    'CREATE INDEX IF NOT EXISTS {schema}.idx_monitoring_status ON monitoring (status)',
+)
+
+
+# ===================================
+# Months, Files and Ids
+# ===================================
+
+def month_of(timestamp):
+    """
+    Partition month (YYYY-MM) of a recorded_at timestamp, or of a month given
+    as YYYY-MM. The whole value must parse, not just its month prefix.
+    """
+    text = str(timestamp)
+    month = text[:7]
+    if MONTH_PATTERN.match(month) and (text == month or (text[7] == '-' and _is_timestamp(text))):
+        return month
+    raise ValueError(f'Invalid timestamp: {timestamp!r}')
+
+
+def _is_timestamp(text):
+    try:
+        datetime.fromisoformat(text)
+    except ValueError:
+        return False
+    return True
+
+
+def check_range(start=None, end=None):
+    """Raise ValueError unless the given bounds are timestamps readings can be routed by"""
+    for bound in (start, end):
+        if bound:
+            month_of(bound)
+
+
+def next_month(month):
+    year, mon = int(month[:4]), int(month[5:])
+    return f'{year + mon // 12:04d}-{mon % 12 + 1:02d}'
+
+
+def first_id(month):
+    return (int(month[:4]) * 12 + int(month[5:]) - 1) * MONTH_ID_SPAN + 1
+
+
+def month_of_id(reading_id):
+    """Partition month a reading id was allocated from, or None for the main table"""
+    index = (reading_id - 1) // MONTH_ID_SPAN
+    if index <= 0:
+        return None
+    return f'{index // 12:04d}-{index % 12 + 1:02d}'
+
+
+def schema_name(month):
+    """Alias of a month's partition on the writer connection"""
+    return 'monitoring_' + month.replace('-', '_')
+
+
+def partition_dir(db_path=None):
+    """Directory of the partition files belonging to a database file (default: the current site's)"""
+    return os.path.splitext(os.path.abspath(db_path or current_db_path()))[0] + '_monitoring'
+
+
+def partition_path(month, db_path=None):
+    return os.path.join(partition_dir(db_path), f'{month}.db')
+
+
+def partition_files(db_path=None):
+    """Months that have a partition file on disk, cataloged or not"""
+    directory = partition_dir(db_path)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name[:-3] for name in os.listdir(directory)
+                  if name.endswith('.db') and MONTH_PATTERN.match(name[:-3]))
+
+
+def list_months(conn, start=None, end=None):
+    """Cataloged months overlapping the timestamps [start, end], oldest first"""
+    query = 'SELECT month FROM monitoring_partitions WHERE 1=1'
+    params = []
+    if start:
+        query += ' AND month >= ?'
+        params.append(month_of(start))
+    if end:
+        query += ' AND month <= ?'
+        params.append(month_of(end))
+    return [row[0] for row in conn.execute(query + ' ORDER BY month', params)]
+
+
+# ===================================
+# Writes
+# ===================================
+
+def _ensure_partition(conn, month):
+    """Create an attached month's table, seed its ids, catalog it and count its readings (idempotent)"""
+    schema = schema_name(month)
+    ready = conn.execute(f'''
+        SELECT EXISTS (SELECT 1 FROM monitoring_partitions WHERE month = ? AND counted)
+           AND EXISTS (SELECT 1 FROM {schema}.sqlite_master WHERE name = 'monitoring')
+    ''', (month,)).fetchone()[0]
+    if not ready:
+        for statement in PARTITION_SCHEMA:
+            conn.execute(statement.format(schema=schema))
+        conn.execute(f'''
+            INSERT INTO {schema}.sqlite_sequence (name, seq)
+            SELECT 'monitoring', ?
+            WHERE NOT EXISTS (SELECT 1 FROM {schema}.sqlite_sequence WHERE name = 'monitoring')
+        ''', (first_id(month) - 1,))
+        conn.execute('INSERT OR IGNORE INTO monitoring_partitions (month) VALUES (?)', (month,))
+        _count_month(conn, month)
+    return schema
+
+
+def _count_month(conn, month):
+    """Recount an attached month's readings per status into the catalog"""
+    conn.execute('DELETE FROM monitoring_partition_counts WHERE month = ?', (month,))
+    conn.execute(f'''
+        INSERT INTO monitoring_partition_counts (month, status, readings)
+        SELECT ?, status, COUNT(*) FROM {schema_name(month)}.monitoring GROUP BY status
+    ''', (month,))
+    conn.execute('UPDATE monitoring_partitions SET counted = 1 WHERE month = ?', (month,))
+
+
+def insert_reading(conn, reading):
+    """Writer job: add a reading to its month's partition, its counts and the change log"""
+    month = month_of(reading['recorded_at'])
+    schema = _ensure_partition(conn, month)
+    cursor = conn.execute(f'''
+        INSERT INTO {schema}.monitoring ({', '.join(MONITORING_COLUMNS)})
+        VALUES ({', '.join('?' * len(MONITORING_COLUMNS))})
+    ''', [reading.get(column) for column in MONITORING_COLUMNS])
+    reading_id = cursor.lastrowid
+    conn.execute('''
+        INSERT INTO monitoring_partition_counts (month, status, readings) VALUES (?, ?, 1)
+        ON CONFLICT (month, status) DO UPDATE SET readings = readings + 1
+    ''', (month, reading.get('status')))
+    # Triggers cannot reach across files, so the change log entry is written here
+    conn.execute("INSERT INTO change_log (entity_type, entity_id, op) VALUES ('monitoring', ?, 'upsert')",
+                 (reading_id,))
+    return dict(conn.execute(f'SELECT * FROM {schema}.monitoring WHERE id = ?', (reading_id,)).fetchone())
+
+
+def record_reading(reading):
+    """
+    Store a reading (a dict of MONITORING_COLUMNS, recorded_at defaulting to
+    now) in its month's partition and return the stored row
+    """
+    reading = dict(reading)
+    if not reading.get('recorded_at'):
+        reading['recorded_at'] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    month = month_of(reading['recorded_at'])
+    os.makedirs(partition_dir(), exist_ok=True)
+    return run_write(insert_reading, reading, attach=[(schema_name(month), partition_path(month))])
+
+
+def record_readings(readings):
+    """Store many readings (as for record_reading) in one write job; returns the stored rows"""
+    readings = [dict(reading) for reading in readings]
+    now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    for reading in readings:
+        reading['recorded_at'] = reading.get('recorded_at') or now
+    months = sorted({month_of(reading['recorded_at']) for reading in readings})
+    os.makedirs(partition_dir(), exist_ok=True)
+    return run_write(lambda conn: [insert_reading(conn, reading) for reading in readings],
+                     attach=[(schema_name(month), partition_path(month)) for month in months])
+
+
+def remove_files(month, db_path=None):
+    """Delete a month's partition file; it must no longer be cataloged"""
+    path = partition_path(month, db_path)
+    close_read_pool(path)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def discard(months, db_path=None):
+    """Detach uncataloged months from the writer and delete their files"""
+    if months:
+        run_write(lambda conn: None, detach=[schema_name(month) for month in months])
+    for month in months:
+        remove_files(month, db_path)
+
+
+def uncatalog(month, on_drop=None):
+    """
+    Take a month out of the catalog and detach it from the writer, after which
+    no reader opens it. on_drop(conn) runs in the same write transaction, e.g.
+    to record where the month's rows were archived. The removal is counted so
+    caches of readings (the live buffer, report output) notice it.
+    """
+    def forget(conn):
+        if on_drop:
+            on_drop(conn)
+        conn.execute('DELETE FROM monitoring_partitions WHERE month = ?', (month,))
+        conn.execute('DELETE FROM monitoring_partition_counts WHERE month = ?', (month,))
+        record_removal(conn, 'monitoring')
+
+    run_write(forget, detach=[schema_name(month)])
+
+
+def drop_partition(month):
+    """Drop a month and its readings by deleting its file"""
+    uncatalog(month)
+    remove_files(month)
+
+
+def count_partitions():
+    """
+    Count the readings of cataloged months that predate the per-status counts
+    (one write job per month); returns the months counted
+    """
+    with get_read_connection() as conn:
+        months = [row[0] for row in conn.execute('SELECT month FROM monitoring_partitions WHERE NOT counted')]
+    months = [month for month in months if os.path.exists(partition_path(month))]
+    for month in months:
+        run_write(_count_month, month, attach=[(schema_name(month), partition_path(month))])
+    return months
+
+
+def remove_orphans(before_month):
+    """Delete uncataloged partition files older than before_month (left by an interrupted drop)"""
+    with get_read_connection() as conn:
+        cataloged = set(list_months(conn))
+    orphans = [m for m in partition_files() if m < before_month and m not in cataloged]
+    discard(orphans)
+    return orphans
+
+
+# ===================================
+# Reads
+# ===================================
+
+def each_source(conn, start=None, end=None, descending=True):
+    """
+    Yield (month, connection) for each partition overlapping [start, end], and
+    (None, conn) for the main table if it does, newest first unless descending
+    is False
+    The main table is placed by the month of its newest reading (back-dated
+    readings can put partitions before it). Partition connections come from
+    the read pool and are released once the caller moves on.
+    """
+    order = [(m, m) for m in list_months(conn, start, end) if os.path.exists(partition_path(m))]
+    newest = conn.execute('SELECT MAX(recorded_at) FROM monitoring').fetchone()[0]
+    oldest = conn.execute('SELECT MIN(recorded_at) FROM monitoring').fetchone()[0]
+    if newest and not (start and newest < start) and not (end and oldest > end):
+        order.append((month_of(newest), None))
+    order.sort(key=lambda entry: (entry[0], entry[1] is not None), reverse=descending)
+    for _, month in order:
+        if month is None:
+            yield None, conn
+            continue
+        with get_read_connection(partition_path(month)) as partition:
+            yield month, partition
+
+
+def _conditions(start=None, end=None, filters=None, before=None):
+    """WHERE clause over recorded_at (start <= t <= end, t < before) and equality filters"""
+    clauses, params = [], []
+    bounds = (('recorded_at >= ?', start), ('recorded_at <= ?', end), ('recorded_at < ?', before))
+    for clause, value in bounds:
+        if value:
+            clauses.append(clause)
+            params.append(value)
+    for name, value in (filters or {}).items():
+        if name not in MONITORING_COLUMNS:
+            raise ValueError(f'Unknown filter column: {name}')
+        clauses.append(f'{name} = ?')
+        params.append(value)
+    return (f"WHERE {' AND '.join(clauses)}" if clauses else ''), params
+
+
+def query_readings(conn, start=None, end=None, filters=None, limit=None, before=None):
+    """
+    Readings newest first across the partitions and the main table
+    Months outside the range are never opened, and once `limit` readings
+    newer than everything a remaining source can hold are found, the older
+    sources are not queried either.
+    """
+    where, params = _conditions(start, end, filters, before)
+    upper = min((bound for bound in (end, before) if bound), default=None)
+    sort_key = lambda r: (r['recorded_at'] or '', r['id'])
+    results = []
+    for month, source in each_source(conn, start, upper):
+        if limit and len(results) >= limit:
+            results.sort(key=sort_key, reverse=True)
+            newest = (f'{next_month(month)}-01' if month else
+                      source.execute('SELECT MAX(recorded_at) FROM monitoring').fetchone()[0])
+            if results[limit - 1]['recorded_at'] > (newest or ''):
+                break
+        query = f'SELECT * FROM monitoring {where} ORDER BY recorded_at DESC, id DESC'
+        query_params = list(params)
+        if limit:
+            query += ' LIMIT ?'
+            query_params.append(limit)
+        results.extend(dict(row) for row in source.execute(query, query_params))
+    results.sort(key=sort_key, reverse=True)
+    return results[:limit] if limit else results
+
+
+def iter_readings(conn, start=None, end=None, filters=None):
+    """Readings oldest first across the main table and the partitions, one source at a time"""
+    where, params = _conditions(start, end, filters)
+    for _, source in each_source(conn, start, end, descending=False):
+        for row in source.execute(f'SELECT * FROM monitoring {where} ORDER BY recorded_at, id', params):
+            yield dict(row)
+
+
+def count_readings(conn, status=None):
+    """
+    Number of readings (of one status) in the main table and every partition
+    Partitions are counted from the catalog; only a month whose counts predate
+    the catalog's (see count_partitions) is opened.
+    """
+    where, params = ('WHERE status = ?', [status]) if status is not None else ('', [])
+    total = conn.execute(f'SELECT COUNT(*) FROM monitoring {where}', params).fetchone()[0]
+    months = conn.execute(f'''
+        SELECT p.month, p.counted, COALESCE(SUM(c.readings), 0) FROM monitoring_partitions p
+        LEFT JOIN monitoring_partition_counts c
+               ON c.month = p.month{' AND c.status = ?' if status is not None else ''}
+        GROUP BY p.month
+    ''', params).fetchall()
+    for month, counted, readings in months:
+        path = partition_path(month)
+        if not os.path.exists(path):
+            continue
+        if counted:
+            total += readings
+            continue
+        with get_read_connection(path) as partition:
+            total += partition.execute(f'SELECT COUNT(*) FROM monitoring {where}', params).fetchone()[0]
+    return total
+
+
+def readings_by_id(conn, ids):
+    """
+    Look up readings by id, only in the months their ids were allocated from
+    Returns the found rows by id and the ids that are allocated beyond their
+    partition's sequence, i.e. not committed there yet.
+    """
+    by_month = {}
+    for reading_id in ids:
+        by_month.setdefault(month_of_id(reading_id), []).append(reading_id)
+    cataloged = set(list_months(conn))
+
+    found, pending = {}, []
+    for month, month_ids in by_month.items():
+        if month is None:
+            found.update(_select_ids(conn, month_ids))
+            continue
+        if month not in cataloged:
+            continue
+        if not os.path.exists(partition_path(month)):
+            pending.extend(month_ids)
+            continue
+        with get_read_connection(partition_path(month)) as partition:
+            found.update(_select_ids(partition, month_ids))
+            row = partition.execute("SELECT seq FROM sqlite_sequence WHERE name = 'monitoring'").fetchone()
+        allocated = row[0] if row else first_id(month) - 1
+        pending.extend(i for i in month_ids if i not in found and i > allocated)
+    return found, pending
+
+
+def _select_ids(source, ids):
+    found = {}
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        for row in source.execute(
+            f"SELECT * FROM monitoring WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+        ):
+            found[row['id']] = dict(row)
+    return found
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Monthly monitoring partitions')
+    parser.add_argument('--drop', metavar='YYYY-MM', help='Drop a month (its readings are deleted)')
+    parser.add_argument('--site', default=DEFAULT_SITE, help='Site whose partitions to use')
+    args = parser.parse_args()
+
+    set_site(args.site)
+    init_database()
+    if args.drop:
+        drop_partition(month_of(args.drop))
+        print(f"Dropped {args.drop}")
+    with get_read_connection() as conn:
+        for month in list_months(conn):
+            path = partition_path(month)
+            with get_read_connection(path) as partition:
+                count = partition.execute('SELECT COUNT(*) FROM monitoring').fetchone()[0]
+            print(f"{month}  {count:>8} readings {os.path.getsize(path):>12} bytes  {path}")
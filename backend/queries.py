@@ -0,0 +1,155 @@
+"""
+List query compiler for the deviation and CAPA endpoints
+Turns request arguments into parameterized SQL using a whitelist of
+columns, filters and sort keys, so only known identifiers reach the SQL text
+"""
+from datetime import date
+
+
+class QueryError(ValueError):
+    """Raised when a list query uses an unknown field, filter or sort key"""
+
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise QueryError(f'Expected an integer, got {value!r}')
+
+
+def _as_date(value):
+    try:
+        return date.fromisoformat(value).isoformat()
+    except (TypeError, ValueError):
+        raise QueryError(f'Expected a YYYY-MM-DD date, got {value!r}')
+
+
+class ListQuerySpec:
+    """
+    Whitelist for one list endpoint
+
+    filters maps a request argument to (column, operator, converter).
+    Equality filters accept repeated arguments (?status=Open&status=Closed),
+    which compile to IN (...).
+    """
+
+    def __init__(self, table, columns, filters, default_sort, max_limit=1000):
+        self.table = table
+        self.columns = tuple(columns)
+        self.filters = filters
+        self.default_sort = default_sort
+        self.max_limit = max_limit
+
+    def _fields(self, raw):
+        if not raw:
+            return list(self.columns)
+        fields = [f.strip() for f in raw.split(',') if f.strip()]
+        unknown = [f for f in fields if f not in self.columns]
+        if unknown:
+            raise QueryError(f"Unknown fields: {', '.join(unknown)}")
+        # Always return the primary key so clients can identify rows
+        if 'id' not in fields:
+            fields.insert(0, 'id')
+        return fields
+
+    def _order_by(self, raw):
+        terms = []
+        for key in (raw or self.default_sort).split(','):
+            key = key.strip()
+            if not key:
+                continue
+            direction = 'DESC' if key.startswith('-') else 'ASC'
+            column = key.lstrip('+-')
+            if column not in self.columns:
+                raise QueryError(f'Unknown sort column: {column}')
+            terms.append(f'{column} {direction}')
+        # Tie-break on id so paging is stable
+        terms.append('id DESC' if terms and terms[0].endswith('DESC') else 'id ASC')
+        return ', '.join(terms)
+
+    def compile(self, args):
+        """
+        Compile request arguments into (sql, params)
+
+        args is a mapping of argument name to a list of values (a werkzeug
+        MultiDict or a plain dict of lists). Unrecognised arguments are
+        ignored so existing clients keep working.
+        """
+        getlist = args.getlist if hasattr(args, 'getlist') else (lambda k: args.get(k) or [])
+        first = lambda k: (getlist(k) or [None])[0]
+
+        fields = self._fields(first('fields'))
+        where = []
+        params = []
+        for name, (column, operator, convert) in self.filters.items():
+            values = [v for v in getlist(name) if v != '']
+            if not values:
+                continue
+            values = [convert(v) for v in values]
+            if operator == '=' and len(values) > 1:
+                where.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+            else:
+                where.append(f'{column} {operator} ?')
+                params.append(values[0])
+
+        sql = f"SELECT {', '.join(fields)} FROM {self.table}"
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY ' + self._order_by(first('sort'))
+
+        limit = first('limit')
+        offset = first('offset')
+        if limit is not None or offset is not None:
+            limit = _as_int(limit) if limit is not None else self.max_limit
+            if limit < 0 or limit > self.max_limit:
+                raise QueryError(f'limit must be between 0 and {self.max_limit}')
+            sql += ' LIMIT ? OFFSET ?'
+            params.extend([limit, _as_int(offset) if offset is not None else 0])
+        return sql, params
+
+
+DEVIATION_QUERY = ListQuerySpec(
+    table='deviations',
+    columns=(
+        'id', 'deviation_number', 'title', 'description', 'category', 'severity',
+        'occurrence', 'detection', 'rpn', 'status', 'department', 'product_batch',
+        'detected_date', 'created_at', 'updated_at', 'created_by'
+    ),
+    filters={
+        'status': ('status', '=', str),
+        'category': ('category', '=', str),
+        'department': ('department', '=', str),
+        'product_batch': ('product_batch', '=', str),
+        'rpn_min': ('rpn', '>=', _as_int),
+        'rpn_max': ('rpn', '<=', _as_int),
+        'detected_from': ('detected_date', '>=', _as_date),
+        'detected_to': ('detected_date', '<=', _as_date),
+        'created_from': ('date(created_at)', '>=', _as_date),
+        'created_to': ('date(created_at)', '<=', _as_date)
+    },
+    default_sort='-created_at'
+)
+
+CAPA_QUERY = ListQuerySpec(
+    table='capa',
+    columns=(
+        'id', 'capa_number', 'deviation_id', 'type', 'title', 'description',
+        'root_cause', 'action_plan', 'responsible_person', 'target_date',
+        'completion_date', 'status', 'effectiveness', 'verification_date',
+        'created_at', 'updated_at', 'created_by'
+    ),
+    filters={
+        'status': ('status', '=', str),
+        'type': ('type', '=', str),
+        'responsible_person': ('responsible_person', '=', str),
+        'deviation_id': ('deviation_id', '=', _as_int),
+        'target_from': ('target_date', '>=', _as_date),
+        'target_to': ('target_date', '<=', _as_date),
+        'completed_from': ('completion_date', '>=', _as_date),
+        'completed_to': ('completion_date', '<=', _as_date),
+        'created_from': ('date(created_at)', '>=', _as_date),
+        'created_to': ('date(created_at)', '<=', _as_date)
+    },
+    default_sort='-created_at'
+)
@@ -0,0 +1,429 @@
+"""
+Report generation with memoized results
+Report output is cached under a canonical hash of the report type and its
+normalized parameters, and reused while its source tables are unchanged
+"""
+import os
+import json
+import hashlib
+import threading
+from datetime import date, timedelta
+from database import get_read_connection, read_transaction, run_write, get_writer, current_site, removal_count
+from singleflight import SingleFlight
+from analytics import build_lifecycle
+import partitions
+
+# Upper bound on the cached output kept in report_cache; least recently used goes first
+MAX_CACHE_BYTES = int(os.environ.get('QMS_REPORT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# Parameters that only affect presentation, not the report data
+PRESENTATION_KEYS = ('format',)
+
+# Report types measuring ages up to the end of the period: an open-ended period
+# ends today, so cached output is rebuilt when the day rolls over
+DATED_REPORT_TYPES = ('Lifecycle',)
+
+# Report form departments and the deviation departments they cover
+DEPARTMENTS = {
+    'production': ('Production', 'Packaging'),
+    'qc': ('Quality Control', 'QC Lab'),
+    'qa': ('Quality Assurance',),
+    'warehouse': ('Warehouse',),
+    'engineering': ('Engineering',),
+    'rd': ('R&D',)
+}
+
+
+class ReportError(ValueError):
+    """Raised for parameters that cannot be normalized"""
+
+
+# ===================================
+# Parameter Normalization
+# ===================================
+
+def decode_parameters(raw):
+    """
+    Decode stored or submitted parameters into a dict
+    Older clients sent JSON strings that were encoded again on insert; every
+    layer of string encoding is unwrapped.
+    """
+    value = raw if raw is not None else {}
+    for _ in range(3):
+        if not isinstance(value, str):
+            break
+        try:
+            value = json.loads(value) if value.strip() else {}
+        except ValueError as e:
+            raise ReportError(f'parameters are not valid JSON: {e}') from e
+    if not isinstance(value, dict):
+        raise ReportError('parameters must be a JSON object')
+    return value
+
+
+def _month_start(day):
+    return day.replace(day=1)
+
+
+def _quarter_start(day):
+    return day.replace(month=(day.month - 1) // 3 * 3 + 1, day=1)
+
+
+def resolve_period(period, start_date=None, end_date=None, today=None):
+    """Turn a relative period into an inclusive (start, end) pair of ISO dates"""
+    today = today or date.today()
+    if period in ('current-month', 'monthly'):
+        start, end = _month_start(today), today
+    elif period == 'last-month':
+        end = _month_start(today) - timedelta(days=1)
+        start = _month_start(end)
+    elif period == 'quarter':
+        start, end = _quarter_start(today), today
+    elif period == 'last-quarter':
+        end = _quarter_start(today) - timedelta(days=1)
+        start = _quarter_start(end)
+    elif period == 'ytd':
+        start, end = today.replace(month=1, day=1), today
+    elif period == 'last-year':
+        start, end = date(today.year - 1, 1, 1), date(today.year - 1, 12, 31)
+    elif period == 'custom' or (start_date or end_date):
+        try:
+            start = date.fromisoformat(start_date) if start_date else None
+            end = date.fromisoformat(end_date) if end_date else None
+        except ValueError:
+            raise ReportError('startDate and endDate must be YYYY-MM-DD')
+        if start and end and start > end:
+            raise ReportError('startDate is after endDate')
+    elif period in (None, '', 'all'):
+        start = end = None
+    else:
+        raise ReportError(f'Unknown period: {period}')
+    return (start.isoformat() if start else None, end.isoformat() if end else None)
+
+
+def normalize_parameters(report_type, parameters, today=None):
+    """
+    Canonical form of the parameters that determine a report's data
+
+    Relative periods are resolved to concrete dates (so 'current-month'
+    stops matching when the month rolls over), presentation-only keys are
+    dropped, and so are filters the report type does not use.
+    """
+    spec = _report_spec(report_type)
+    start, end = resolve_period(parameters.get('period'), parameters.get('startDate'),
+                                parameters.get('endDate'), today)
+    if report_type in DATED_REPORT_TYPES and end is None:
+        end = (today or date.today()).isoformat()
+    normalized = {'start_date': start, 'end_date': end}
+    department = str(parameters.get('department') or 'all').strip().lower()
+    if spec['uses_department'] and department != 'all':
+        if department not in DEPARTMENTS:
+            raise ReportError(f'Unknown department: {department}')
+        normalized['department'] = department
+    for key, value in parameters.items():
+        if key in ('period', 'startDate', 'endDate', 'department') or key in PRESENTATION_KEYS:
+            continue
+        if value not in (None, ''):
+            normalized[key] = value
+    return {k: v for k, v in normalized.items() if v is not None}
+
+
+def cache_key(report_type, normalized):
+    canonical = json.dumps({'report_type': report_type, 'parameters': normalized},
+                           sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+# ===================================
+# Report Builders
+# ===================================
+
+def _range(column, params):
+    clauses = []
+    values = []
+    if params.get('start_date'):
+        clauses.append(f'{column} >= ?')
+        values.append(params['start_date'])
+    if params.get('end_date'):
+        clauses.append(f'{column} < ?')
+        values.append((date.fromisoformat(params['end_date']) + timedelta(days=1)).isoformat())
+    return clauses, values
+
+
+def _where(clauses):
+    return f"WHERE {' AND '.join(clauses)}" if clauses else ''
+
+
+def _department(column, params):
+    if 'department' not in params:
+        return [], []
+    names = DEPARTMENTS[params['department']]
+    return [f"{column} IN ({', '.join('?' * len(names))})"], list(names)
+
+
+def _grouped(conn, table, column, where, values):
+    return {row[0] or 'Unspecified': row[1] for row in conn.execute(
+        f'SELECT {column}, COUNT(*) FROM {table} {where} GROUP BY {column} ORDER BY {column}', values
+    )}
+
+
+def build_deviation_summary(conn, params):
+    clauses, values = _range('detected_date', params)
+    dept_clauses, dept_values = _department('department', params)
+    where = _where(clauses + dept_clauses)
+    values = values + dept_values
+    total, avg_rpn, critical = conn.execute(f'''
+        SELECT COUNT(*), ROUND(AVG(rpn), 1), SUM(CASE WHEN rpn >= 200 THEN 1 ELSE 0 END)
+        FROM deviations {where}
+    ''', values).fetchone()
+    return {
+        'total': total,
+        'average_rpn': avg_rpn,
+        'critical': critical or 0,
+        'by_status': _grouped(conn, 'deviations', 'status', where, values),
+        'by_category': _grouped(conn, 'deviations', 'category', where, values),
+        'by_severity': _grouped(conn, 'deviations', 'severity', where, values),
+        'by_department': _grouped(conn, 'deviations', 'department', where, values)
+    }
+
+
+def build_capa_status(conn, params):
+    clauses, values = _range('c.created_at', params)
+    dept_clauses, dept_values = _department('d.department', params)
+    where = _where(clauses + dept_clauses)
+    values = values + dept_values
+    source = 'capa c LEFT JOIN deviations d ON c.deviation_id = d.id'
+    total, overdue, closed_on_time, closed = conn.execute(f'''
+        SELECT COUNT(*),
+               SUM(CASE WHEN c.status NOT IN ('Effective', 'Closed')
+                         AND c.target_date < date('now') THEN 1 ELSE 0 END),
+               SUM(CASE WHEN c.completion_date IS NOT NULL
+                         AND c.completion_date <= c.target_date THEN 1 ELSE 0 END),
+               SUM(CASE WHEN c.completion_date IS NOT NULL THEN 1 ELSE 0 END)
+        FROM {source} {where}
+    ''', values).fetchone()
+    return {
+        'total': total,
+        'overdue': overdue or 0,
+        'on_time_rate': round(100.0 * closed_on_time / closed, 1) if closed else None,
+        'by_status': _grouped(conn, source, 'c.status', where, values),
+        'by_type': _grouped(conn, source, 'c.type', where, values)
+    }
+
+
+def build_batch_production(conn, params):
+    clauses, values = _range('start_date', params)
+    where = _where(clauses)
+    total, quantity = conn.execute(
+        f'SELECT COUNT(*), SUM(quantity) FROM batches {where}', values
+    ).fetchone()
+    return {
+        'total_batches': total,
+        'total_quantity': quantity or 0,
+        'by_status': _grouped(conn, 'batches', 'status', where, values),
+        'by_product': _grouped(conn, 'batches', 'product_name', where, values)
+    }
+
+
+def build_environmental_monitoring(conn, params):
+    clauses, values = _range('recorded_at', params)
+    where = _where(clauses)
+    readings, out_of_spec = 0, 0
+    grouped = {'by_status': {}, 'by_location': {}, 'by_parameter': {}}
+    # Monitoring is split into monthly partitions; only months in the period are read
+    for _, source in partitions.each_source(conn, params.get('start_date'), params.get('end_date')):
+        count, flagged = source.execute(f'''
+            SELECT COUNT(*),
+                   SUM(CASE WHEN (min_limit IS NOT NULL AND value < min_limit)
+                              OR (max_limit IS NOT NULL AND value > max_limit) THEN 1 ELSE 0 END)
+            FROM monitoring {where}
+        ''', values).fetchone()
+        readings += count
+        out_of_spec += flagged or 0
+        for key, column in (('by_status', 'status'), ('by_location', 'location'),
+                            ('by_parameter', 'parameter_name')):
+            for name, n in _grouped(source, 'monitoring', column, where, values).items():
+                grouped[key][name] = grouped[key].get(name, 0) + n
+    return {
+        'readings': readings,
+        'out_of_spec': out_of_spec,
+        **{key: dict(sorted(counts.items())) for key, counts in grouped.items()}
+    }
+
+
+def build_audit_findings(conn, params):
+    clauses, values = _range('timestamp', params)
+    where = _where(clauses)
+    return {
+        'events': conn.execute(f'SELECT COUNT(*) FROM audit_logs {where}', values).fetchone()[0],
+        'by_action': _grouped(conn, 'audit_logs', 'action', where, values),
+        'by_entity_type': _grouped(conn, 'audit_logs', 'entity_type', where, values)
+    }
+
+
+def build_quality_metrics(conn, params):
+    return {
+        'deviations': build_deviation_summary(conn, params),
+        'capa': build_capa_status(conn, params),
+        'batches': build_batch_production(conn, params),
+        'monitoring': build_environmental_monitoring(conn, params)
+    }
+
+
+def build_unsupported(conn, params):
+    return {'note': 'No source data is recorded for this report type'}
+
+
+# report_type: (builder, source tables, uses department filter)
+REPORT_TYPES = {
+    'Deviation Summary': (build_deviation_summary, ('deviations',), True),
+    'Deviation': (build_deviation_summary, ('deviations',), True),
+    'CAPA Status': (build_capa_status, ('capa', 'deviations'), True),
+    'Batch Production': (build_batch_production, ('batches',), False),
+    'Production': (build_batch_production, ('batches',), False),
+    'Environmental Monitoring': (build_environmental_monitoring, ('monitoring',), False),
+    'Audit Findings': (build_audit_findings, ('audit_logs',), False),
+    'Audit': (build_audit_findings, ('audit_logs',), False),
+    'Quality Metrics': (build_quality_metrics, ('deviations', 'capa', 'batches', 'monitoring'), True),
+    'Quality': (build_quality_metrics, ('deviations', 'capa', 'batches', 'monitoring'), True),
+    'Lifecycle': (build_lifecycle, ('deviations', 'capa'), False),
+}
+
+
+def _report_spec(report_type):
+    builder, sources, uses_department = REPORT_TYPES.get(report_type, (build_unsupported, (), False))
+    return {'builder': builder, 'sources': sources, 'uses_department': uses_department}
+
+
+# ===================================
+# Cache
+# ===================================
+
+_builds = SingleFlight()
+stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name, amount=1):
+    """Add to a cache counter; requests update them from many threads"""
+    with _stats_lock:
+        stats[name] += amount
+
+
+def data_version(conn, sources):
+    """
+    Version of the source tables: their newest change_log sequence numbers
+    audit_logs is append-only and not in the change log, so its newest id is used.
+    Archival and dropped monitoring months remove rows without logging them,
+    so each table's removal count is part of its version as well.
+    """
+    parts = []
+    for table in sources:
+        if table == 'audit_logs':
+            value = conn.execute('SELECT MAX(id) FROM audit_logs').fetchone()[0]
+        else:
+            value = conn.execute(
+                'SELECT MAX(seq) FROM change_log WHERE entity_type = ?', (table,)
+            ).fetchone()[0]
+        parts.append(f'{table}:{value or 0}.{removal_count(conn, table)}')
+    return ','.join(parts)
+
+
+def _build(report_type, normalized):
+    spec = _report_spec(report_type)
+    with get_read_connection() as conn:
+        # One read transaction so the output matches the version it is stored under
+        with read_transaction(conn):
+            version = data_version(conn, spec['sources'])
+            output = spec['builder'](conn, normalized)
+    return version, output
+
+
+def _store(key, report_type, normalized, version, output):
+    payload = json.dumps(output, separators=(',', ':'))
+
+    def store(conn):
+        cursor = conn.cursor()
+        # Entries of this type built from older data can never be hit again
+        cursor.execute('''
+            DELETE FROM report_cache WHERE report_type = ? AND data_version != ?
+        ''', (report_type, version))
+        cursor.execute('''
+            INSERT OR REPLACE INTO report_cache
+            (cache_key, report_type, parameters, data_version, output, byte_size)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (key, report_type, json.dumps(normalized, sort_keys=True), version, payload, len(payload)))
+
+        total = cursor.execute('SELECT COALESCE(SUM(byte_size), 0) FROM report_cache').fetchone()[0]
+        evicted = 0
+        if total > MAX_CACHE_BYTES:
+            victims = []
+            for row in cursor.execute('''
+                SELECT cache_key, byte_size FROM report_cache
+                WHERE cache_key != ?
+                ORDER BY last_used_at, created_at
+            ''', (key,)).fetchall():
+                if total <= MAX_CACHE_BYTES:
+                    break
+                victims.append((row[0],))
+                total -= row[1]
+            cursor.executemany('DELETE FROM report_cache WHERE cache_key = ?', victims)
+            evicted = len(victims)
+        return evicted
+
+    _count('evictions', run_write(store))
+
+
+def _touch(key):
+    def touch(conn):
+        conn.execute('''
+            UPDATE report_cache SET last_used_at = CURRENT_TIMESTAMP, hits = hits + 1
+            WHERE cache_key = ?
+        ''', (key,))
+    # Fire and forget; recency only steers eviction
+    get_writer().submit(touch)
+
+
+def get_report(report_type, parameters):
+    """
+    Return (output, info) for a report, reusing cached output when possible
+
+    info carries the cache key, data version and whether the output came
+    from the cache. Concurrent requests for the same uncached report share
+    a single build.
+    """
+    normalized = normalize_parameters(report_type, decode_parameters(parameters))
+    key = cache_key(report_type, normalized)
+    sources = _report_spec(report_type)['sources']
+
+    with get_read_connection() as conn:
+        version = data_version(conn, sources)
+        row = conn.execute('''
+            SELECT output, data_version, created_at FROM report_cache WHERE cache_key = ?
+        ''', (key,)).fetchone()
+    if row is not None and row['data_version'] == version:
+        _count('hits')
+        _touch(key)
+        return json.loads(row['output']), {
+            'cache_key': key, 'cached': True, 'data_version': version,
+            'built_at': row['created_at'], 'parameters': normalized
+        }
+
+    _count('misses')
+    version, output = _builds.do(f'{current_site()}:{key}@{version}', lambda: _build(report_type, normalized))
+    _store(key, report_type, normalized, version, output)
+    return output, {
+        'cache_key': key, 'cached': False, 'data_version': version,
+        'built_at': None, 'parameters': normalized
+    }
+
+
+def cache_metrics():
+    """Entry count, stored bytes and hit/miss/eviction counters"""
+    with get_read_connection() as conn:
+        entries, size = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(byte_size), 0) FROM report_cache'
+        ).fetchone()
+    with _stats_lock:
+        counters = dict(stats)
+    return dict(counters, entries=entries, bytes=size, max_bytes=MAX_CACHE_BYTES)
@@ -0,0 +1,137 @@
+"""
+Request coalescing (single-flight) for identical concurrent reads
+The first caller for a key runs the query; callers arriving while it is in
+flight wait for and share its result instead of running it again
+"""
+import os
+import threading
+import time
+
+# Seconds a follower waits for the in-flight call before running its own
+DEFAULT_MAX_WAIT = float(os.environ.get('QMS_SINGLEFLIGHT_MAX_WAIT', 5.0))
+
+# Keys tracked individually in the metrics; the rest are pooled under OTHER_KEY
+MAX_TRACKED_KEYS = 256
+OTHER_KEY = '__other__'
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Share one execution among concurrent callers of the same key
+
+    Followers wait up to max_wait seconds; if the leader has not finished by
+    then they run the function themselves rather than queueing indefinitely
+    behind a slow query. Errors raised by the leader are re-raised in every
+    follower that shared the call, except instances of private_errors: those
+    belong to the leader's own request (its deadline, its client going away),
+    so the followers start over and one of them takes over as leader.
+    """
+
+    def __init__(self, max_wait=DEFAULT_MAX_WAIT, private_errors=()):
+        self.max_wait = max_wait
+        self.private_errors = tuple(private_errors)
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {}
+
+    def _key_stats(self, key):
+        name = str(key)
+        if name not in self._stats and len(self._stats) >= MAX_TRACKED_KEYS:
+            name = OTHER_KEY
+        return self._stats.setdefault(name, {
+            'calls': 0,
+            'executions': 0,
+            'shared': 0,
+            'wait_timeouts': 0,
+            'takeovers': 0,
+            'errors': 0,
+            'max_waiters': 0,
+            'total_exec_ms': 0.0
+        })
+
+    def do(self, key, fn, max_wait=None):
+        """Run fn() once per concurrent group of callers with the same key"""
+        max_wait = self.max_wait if max_wait is None else max_wait
+        with self._lock:
+            stats = self._key_stats(key)
+            stats['calls'] += 1
+
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+                else:
+                    call.waiters += 1
+                    stats['max_waiters'] = max(stats['max_waiters'], call.waiters)
+
+            if leader:
+                return self._lead(key, call, fn, stats)
+
+            if not call.done.wait(max_wait):
+                with self._lock:
+                    stats['wait_timeouts'] += 1
+                return self._execute(fn, stats)
+
+            if not isinstance(call.error, self.private_errors):
+                break
+            # The leader's request failed for its own reasons: start over, as leader or follower
+            with self._lock:
+                stats['takeovers'] += 1
+
+        with self._lock:
+            stats['shared'] += 1
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _lead(self, key, call, fn, stats):
+        try:
+            call.result = self._execute(fn, stats)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def _execute(self, fn, stats):
+        started = time.perf_counter()
+        try:
+            return fn()
+        except Exception:
+            with self._lock:
+                stats['errors'] += 1
+            raise
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            with self._lock:
+                stats['executions'] += 1
+                stats['total_exec_ms'] += elapsed
+
+    def metrics(self):
+        """Per-key counters plus the number of calls currently in flight"""
+        with self._lock:
+            keys = {}
+            for name, stats in self._stats.items():
+                entry = dict(stats)
+                entry['total_exec_ms'] = round(entry['total_exec_ms'], 2)
+                entry['avg_exec_ms'] = round(stats['total_exec_ms'] / stats['executions'], 2) \
+                    if stats['executions'] else 0.0
+                keys[name] = entry
+            return {
+                'max_wait_seconds': self.max_wait,
+                'in_flight': len(self._calls),
+                'keys': keys
+            }
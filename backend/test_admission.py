@@ -0,0 +1,122 @@
+"""
+Tests for per-class admission control and load shedding
+"""
+import threading
+import time
+import pytest
+import api
+from admission import DEFAULT_CLASSES, AdmissionController, Overloaded
+
+# One slot each; 'queued' waits up to 0.5s in a queue of one, 'bulk' is never queued
+CLASSES = {'queued': (1, 1, 0.5, 2, False), 'bulk': (1, 0, 0.0, 30, True)}
+
+
+def rejection(controller, class_name):
+    with pytest.raises(Overloaded) as info:
+        controller.acquire(class_name)
+    return info.value.reason
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+# ===================================
+# Controller
+# ===================================
+
+def test_waiting_request_takes_the_slot_when_it_frees():
+    controller = AdmissionController(CLASSES, enabled=True)
+    first = controller.acquire('queued')
+    admitted = []
+    waiter = threading.Thread(target=lambda: admitted.append(controller.acquire('queued')))
+    waiter.start()
+    wait_until(lambda: controller.classes['queued'].waiting == 1)
+
+    assert rejection(controller, 'queued') == 'queue_full'
+    time.sleep(0.05)
+    first.release()
+    waiter.join()
+
+    assert admitted[0].queue_ms >= 50
+    metrics = controller.metrics()['classes']['queued']
+    assert (metrics['admitted'], metrics['queued'], metrics['in_flight']) == (2, 1, 1)
+    assert metrics['rejected'] == {'shed': 0, 'queue_full': 1, 'deadline': 0}
+
+
+def test_request_is_rejected_once_its_queue_deadline_passes():
+    controller = AdmissionController(CLASSES, enabled=True)
+    controller.acquire('queued')
+
+    started = time.monotonic()
+    assert rejection(controller, 'queued') == 'deadline'
+    assert time.monotonic() - started >= 0.5
+    assert controller.classes['queued'].waiting == 0
+
+
+def test_sheddable_class_is_rejected_while_others_wait():
+    controller = AdmissionController(CLASSES, enabled=True)
+    held = controller.acquire('queued')
+    waiter = threading.Thread(target=controller.acquire, args=('queued',))
+    waiter.start()
+    wait_until(lambda: controller.classes['queued'].waiting == 1)
+
+    # Its own slot is free, but capacity goes to the requests already waiting
+    assert rejection(controller, 'bulk') == 'shed'
+    held.release()
+    waiter.join()
+    bulk = controller.acquire('bulk')
+    assert rejection(controller, 'bulk') == 'queue_full'
+    bulk.release()
+
+
+def test_releasing_twice_frees_one_slot():
+    controller = AdmissionController(CLASSES, enabled=True)
+    ticket = controller.acquire('bulk')
+    ticket.release()
+    ticket.release()
+
+    controller.acquire('bulk')
+    assert rejection(controller, 'bulk') == 'queue_full'
+    assert controller.activity() == (1, 2)
+
+
+def test_disabled_controller_admits_everything():
+    controller = AdmissionController(CLASSES, enabled=False)
+    assert [controller.acquire('bulk') for _ in range(3)] == [None, None, None]
+
+
+# ===================================
+# API
+# ===================================
+
+@pytest.fixture
+def admission(client, monkeypatch):
+    controller = AdmissionController(dict(DEFAULT_CLASSES, low=(1, 0, 0.0, 30, True)), enabled=True)
+    monkeypatch.setattr(api, 'admission', controller)
+    return controller
+
+
+def test_exhausted_class_answers_503_and_leaves_other_classes_alone(client, admission):
+    held = admission.acquire('low')
+
+    response = client.get('/api/reports')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '30'
+    assert response.get_json()['reason'] == 'queue_full'
+    assert client.get('/api/health').status_code == 200
+
+    held.release()
+    assert client.get('/api/reports').status_code == 200
+
+
+def test_streamed_response_holds_its_slot_until_closed(client, admission):
+    response = client.get('/api/audit-logs/export', buffered=False)
+    assert response.status_code == 200
+    assert admission.classes['low'].in_flight == 1
+
+    response.close()
+    assert admission.classes['low'].in_flight == 0
@@ -0,0 +1,235 @@
+"""
+Tests for the asyncio server: request bodies, long-polls and server-sent events
+"""
+import json
+import asyncio
+import pytest
+import aio_server
+import changefeed
+from aio_server import ChangeWatcher
+from database import get_read_connection
+
+DEVIATION = {'deviation_number': 'DEV-AIO-001', 'title': 'Door left open', 'description': 'Cold room door',
+             'category': 'Equipment', 'severity': 2, 'occurrence': 2, 'detection': 2,
+             'detected_date': '2024-05-17'}
+
+
+@pytest.fixture
+def serve(client, monkeypatch):
+    """Runs scenario(port) against a server on an ephemeral port, with a fresh change watcher"""
+    def run(scenario):
+        async def main():
+            monkeypatch.setattr(aio_server, 'watcher', ChangeWatcher(interval=0.05))
+            server = await asyncio.start_server(aio_server.handle_connection, '127.0.0.1', 0,
+                                                limit=aio_server.MAX_HEADER_BYTES)
+            async with server:
+                return await asyncio.wait_for(scenario(server.sockets[0].getsockname()[1]), 20)
+        return asyncio.run(main())
+    return run
+
+
+async def fetch(port, method, target, headers=(), body=None, half_close=False):
+    """
+    Send one request on a new connection and read the response to its end;
+    a list body is sent chunked. Returns (status, headers, body).
+    """
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    lines = [f'{method} {target} HTTP/1.1', 'Host: localhost', 'Connection: close', *headers]
+    if isinstance(body, list):
+        lines.append('Transfer-Encoding: chunked')
+        payload = b''.join(b'%x\r\n%s\r\n' % (len(piece), piece) for piece in body) + b'0\r\n\r\n'
+    else:
+        payload = body or b''
+        if body is not None:
+            lines.append(f'Content-Length: {len(payload)}')
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + payload)
+    if half_close:
+        writer.write_eof()
+    await writer.drain()
+    status, response_headers = await read_response_head(reader)
+    data = await reader.read()
+    writer.close()
+    return status, response_headers, data
+
+
+async def read_response_head(reader):
+    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+    headers = dict(line.split(': ', 1) for line in head[1:] if line)
+    return int(head[0].split(' ')[1]), {name.lower(): value for name, value in headers.items()}
+
+
+async def create_deviation(port, number):
+    status, _, _ = await fetch(port, 'POST', '/api/deviations', ['Content-Type: application/json'],
+                               json.dumps(dict(DEVIATION, deviation_number=number)).encode())
+    assert status == 201
+
+
+def newest_seq():
+    with get_read_connection() as conn:
+        return changefeed.latest_seq(conn)
+
+
+# ===================================
+# Request Bodies
+# ===================================
+
+def test_chunked_body_reaches_the_handler(serve):
+    async def scenario(port):
+        body = json.dumps(DEVIATION).encode()
+        status, _, data = await fetch(port, 'POST', '/api/deviations', ['Content-Type: application/json'],
+                                      [body[:10], body[10:25], body[25:]])
+        assert status == 201
+        status, _, data = await fetch(port, 'GET', f"/api/deviations/{json.loads(data)['id']}")
+        return json.loads(data)
+
+    assert serve(scenario)['title'] == DEVIATION['title']
+
+
+@pytest.mark.parametrize('chunked', [False, True])
+def test_oversized_body_is_refused(serve, monkeypatch, chunked):
+    monkeypatch.setattr(aio_server, 'MAX_BODY_BYTES', 1024)
+
+    async def scenario(port):
+        body = b'x' * 2048
+        return await fetch(port, 'POST', '/api/deviations', ['Content-Type: application/json'],
+                           [body[:1000], body[1000:]] if chunked else body)
+
+    status, _, data = serve(scenario)
+    assert status == 413
+    assert json.loads(data) == {'error': 'Payload Too Large'}
+
+
+def test_oversized_upload_is_refused_before_100_continue(serve, monkeypatch):
+    monkeypatch.setattr(aio_server, 'MAX_BODY_BYTES', 1024)
+
+    async def scenario(port):
+        # No body is sent: the server must answer without waiting for it
+        return await fetch(port, 'POST', '/api/deviations',
+                           ['Content-Length: 2048', 'Expect: 100-continue'])
+
+    assert serve(scenario)[0] == 413
+
+
+def test_half_closed_client_is_not_disconnected(serve, monkeypatch):
+    seen = []
+
+    def recording_app(environ, start_response):
+        seen.append(environ['qms.is_disconnected']())
+        return app(environ, start_response)
+
+    app = aio_server.app
+    monkeypatch.setattr(aio_server, 'app', recording_app)
+
+    async def scenario(port):
+        return await fetch(port, 'GET', '/api/deviations?limit=1', half_close=True)
+
+    status, _, data = serve(scenario)
+    assert status == 200 and json.loads(data)
+    assert seen == [False]
+
+
+# ===================================
+# Long-Polls
+# ===================================
+
+def test_long_poll_answers_once_a_change_arrives(serve):
+    async def scenario(port):
+        since = newest_seq()
+        poll = asyncio.create_task(fetch(port, 'GET', f'/api/changes?since={since}&wait=10'))
+        await asyncio.sleep(0.2)
+        assert not poll.done()
+        await create_deviation(port, 'DEV-AIO-002')
+        status, _, data = await poll
+        return status, json.loads(data)
+
+    status, page = serve(scenario)
+    assert status == 200
+    assert [d['deviation_number'] for d in page['upserts']['deviations']] == ['DEV-AIO-002']
+
+
+def test_long_poll_ends_after_its_wait(serve):
+    async def scenario(port):
+        since = newest_seq()
+        status, _, data = await fetch(port, 'GET', f'/api/changes?since={since}&wait=0.2')
+        return status, json.loads(data)
+
+    status, page = serve(scenario)
+    assert status == 200
+    assert page['upserts'] == {}
+
+
+def test_long_poll_reports_an_unreadable_change_log(serve, monkeypatch):
+    def fail(site):
+        raise OSError('disk I/O error')
+
+    monkeypatch.setattr(ChangeWatcher, '_read_seqs', staticmethod(fail))
+
+    async def scenario(port):
+        return await fetch(port, 'GET', '/api/changes?since=1&wait=5')
+
+    assert serve(scenario)[0] == 503
+
+
+# ===================================
+# Server-Sent Events
+# ===================================
+
+async def read_event(reader):
+    """The next event's fields, skipping keep-alive comments"""
+    while True:
+        block = (await reader.readuntil(b'\n\n')).decode()
+        fields = dict(line.split(': ', 1) for line in block.strip().split('\n') if not line.startswith(':'))
+        if fields:
+            return fields
+
+
+def test_event_stream_announces_matching_changes(serve):
+    async def scenario(port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /api/events?entities=capa,deviations HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        status, headers = await read_response_head(reader)
+        opening = await read_event(reader)
+        await create_deviation(port, 'DEV-AIO-003')
+        change = await read_event(reader)
+        writer.close()
+        return status, headers, opening, change
+
+    status, headers, opening, change = serve(scenario)
+    assert status == 200
+    assert headers['content-type'] == 'text/event-stream'
+    assert change['event'] == 'change'
+    assert int(change['id']) > int(opening['id'])
+    assert json.loads(change['data'])['entities'] == ['deviations']
+
+
+def test_event_stream_tolerates_an_entity_type_missing_from_the_log(serve, monkeypatch):
+    # A database from before an entity type joined the feed reports no number for it
+    def read_seqs(site):
+        return {'deviations': 5}, 5
+
+    monkeypatch.setattr(ChangeWatcher, '_read_seqs', staticmethod(read_seqs))
+
+    async def scenario(port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /api/events?entities=capa,deviations&since=3 HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        await read_response_head(reader)
+        await read_event(reader)
+        change = await read_event(reader)
+        writer.close()
+        return change
+
+    assert json.loads(serve(scenario)['data'])['entities'] == ['deviations']
+
+
+def test_event_stream_reports_an_unreadable_change_log(serve, monkeypatch):
+    def fail(site):
+        raise OSError('disk I/O error')
+
+    monkeypatch.setattr(ChangeWatcher, '_read_seqs', staticmethod(fail))
+
+    async def scenario(port):
+        return await fetch(port, 'GET', '/api/events')
+
+    status, _, data = serve(scenario)
+    assert status == 503
+    assert aio_server.stats['event_streams'] == 0
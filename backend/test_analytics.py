@@ -0,0 +1,208 @@
+"""
+Tests for the risk cube, status history and the risk and lifecycle analytics built on them
+"""
+import pytest
+from werkzeug.datastructures import MultiDict
+import database
+from database import get_read_connection, run_write
+from analytics import lifecycle_metrics, query_risk_analytics, RISK_LEVELS
+from queries import QueryError
+
+
+def risk(**args):
+    with get_read_connection() as conn:
+        return query_risk_analytics(conn, MultiDict(args))
+
+
+def cube_matches_deviations():
+    with get_read_connection() as conn:
+        cube = conn.execute('''
+            SELECT category, department, month, severity, occurrence, detection, rpn, deviation_count
+            FROM risk_cube ORDER BY 1, 2, 3, 4, 5, 6, 7
+        ''').fetchall()
+        direct = conn.execute('''
+            SELECT category, COALESCE(department, ''), substr(detected_date, 1, 7),
+                   severity, occurrence, detection, rpn, COUNT(*)
+            FROM deviations GROUP BY 1, 2, 3, 4, 5, 6, 7 ORDER BY 1, 2, 3, 4, 5, 6, 7
+        ''').fetchall()
+    return [tuple(row) for row in cube] == [tuple(row) for row in direct]
+
+
+def deviation_rows(where='1 = 1', params=()):
+    with get_read_connection() as conn:
+        return [dict(row) for row in conn.execute(f'SELECT * FROM deviations WHERE {where}', params)]
+
+
+# ===================================
+# Risk Cube
+# ===================================
+
+def test_cube_follows_inserts_updates_and_deletes(qms_db):
+    assert cube_matches_deviations()
+
+    def change(conn):
+        conn.execute('''
+            INSERT INTO deviations (deviation_number, title, description, category, severity, occurrence,
+                                    detection, rpn, department, detected_date)
+            VALUES ('DEV-CUBE-1', 'Spill', 'Spill', 'Equipment', 9, 9, 9, 729, NULL, '2019-12-01')
+        ''')
+        conn.execute('UPDATE deviations SET severity = 1, rpn = occurrence * detection WHERE id = 1')
+        conn.execute("UPDATE deviations SET category = 'Process', detected_date = '2019-11-02' WHERE id = 2")
+        conn.execute('DELETE FROM deviations WHERE id = 3')
+
+    run_write(change)
+
+    assert cube_matches_deviations()
+
+
+# ===================================
+# Risk Analytics
+# ===================================
+
+def test_analytics_agree_with_the_deviations(qms_db):
+    rows = deviation_rows()
+    result = risk(bucket='100')
+
+    assert result['total'] == len(rows)
+    assert sum(map(sum, result['heatmap']['cells'])) == len(rows)
+    first = (rows[0]['occurrence'], rows[0]['severity'])
+    cell = result['heatmap']['cells'][first[0] - 1][first[1] - 1]
+    assert cell == len([r for r in rows if (r['occurrence'], r['severity']) == first])
+    assert sum(entry['count'] for entry in result['matrix']) == len(rows)
+    assert sum(entry['count'] for entry in result['rpn_histogram']) == len(rows)
+    assert all(entry['to'] - entry['from'] == 99 for entry in result['rpn_histogram'])
+    critical = RISK_LEVELS[0][1]
+    assert result['risk_levels']['Critical'] == len([r for r in rows if r['rpn'] >= critical])
+    assert sum(month['count'] for month in result['by_month']) == len(rows)
+
+
+def test_slice_limits_every_view(qms_db):
+    category = deviation_rows()[0]['category']
+    rows = deviation_rows('category = ? AND detected_date >= ?', (category, '2000-01-01'))
+
+    result = risk(category=category, x='detection', y='severity', **{'from': '2000-01'})
+
+    assert result['total'] == len(rows)
+    assert result['heatmap']['x'] == 'detection'
+    assert sum(map(sum, result['heatmap']['cells'])) == len(rows)
+    assert risk(category='No such category')['total'] == 0
+
+
+@pytest.mark.parametrize('args', [{'x': 'severity', 'y': 'severity'}, {'x': 'rpn'}, {'bucket': '0'},
+                                  {'from': '2024/01'}, {'min_severity': 'high'}])
+def test_bad_arguments_are_rejected(qms_db, args):
+    with pytest.raises(QueryError):
+        risk(**args)
+
+
+def test_risk_endpoint_reports_bad_arguments(client):
+    assert client.get('/api/analytics/risk?x=rpn').status_code == 400
+    assert client.get('/api/analytics/risk').get_json()['total'] == len(deviation_rows())
+
+
+# ===================================
+# Status History
+# ===================================
+
+def history(entity, entity_id):
+    with get_read_connection() as conn:
+        return [(row[0], row[1], row[2] is not None) for row in conn.execute('''
+            SELECT from_status, to_status, left_at FROM status_history
+            WHERE entity_type = ? AND entity_id = ? ORDER BY id
+        ''', (entity, entity_id))]
+
+
+def test_status_changes_close_the_interval_they_leave(qms_db):
+    deviation_id = run_write(lambda conn: conn.execute('''
+        INSERT INTO deviations (deviation_number, title, description, category, severity, occurrence,
+                                detection, rpn, detected_date)
+        VALUES ('DEV-HIST-1', 'Leak', 'Leak', 'Equipment', 2, 2, 2, 8, '2024-05-17')
+    ''').lastrowid)
+    for change in ("status = 'Under Investigation'", "title = 'Small leak'", "status = 'Closed'"):
+        run_write(lambda conn: conn.execute(f'UPDATE deviations SET {change} WHERE id = ?', (deviation_id,)))
+
+    assert history('deviation', deviation_id) == [
+        (None, 'Open', True), ('Open', 'Under Investigation', True), ('Under Investigation', 'Closed', False)
+    ]
+    run_write(lambda conn: conn.execute('DELETE FROM deviations WHERE id = ?', (deviation_id,)))
+    assert history('deviation', deviation_id) == []
+
+
+@pytest.mark.parametrize('table, entity', [('deviations', 'deviation'), ('capa', 'capa')])
+def test_backfill_ends_every_record_in_its_current_status(legacy_db, table, entity):
+    database.init_database()
+
+    with get_read_connection() as conn:
+        records = conn.execute(f'SELECT id, status FROM {table}').fetchall()
+        current = conn.execute('''
+            SELECT entity_id, to_status FROM status_history WHERE entity_type = ? AND left_at IS NULL
+        ''', (entity,)).fetchall()
+    assert sorted(map(tuple, current)) == sorted(map(tuple, records))
+
+
+# ===================================
+# Lifecycle Analytics
+# ===================================
+
+@pytest.fixture
+def lifecycles(db_path):
+    """
+    Deviation 1 closes after 10 days via an investigation, 2 after 20 days;
+    3 has been under investigation since February 2nd
+    """
+    database.init_database()
+    rows = [
+        (1, None, 'Open', '2024-01-01', '2024-01-03'),
+        (1, 'Open', 'Under Investigation', '2024-01-03', '2024-01-11'),
+        (1, 'Under Investigation', 'Closed', '2024-01-11', None),
+        (2, None, 'Open', '2024-01-01', '2024-01-21'),
+        (2, 'Open', 'Closed', '2024-01-21', None),
+        (3, None, 'Open', '2024-02-01', '2024-02-02'),
+        (3, 'Open', 'Under Investigation', '2024-02-02', None),
+    ]
+    run_write(lambda conn: conn.executemany('''
+        INSERT INTO status_history (entity_type, entity_id, from_status, to_status, changed_at, left_at)
+        VALUES ('deviation', ?, ?, ?, ?, ?)
+    ''', rows))
+    with get_read_connection() as conn:
+        return lifecycle_metrics(conn, 'deviation', '2024-01-01', '2024-04-01')
+
+
+def test_cycle_time_runs_from_opening_to_closure(lifecycles):
+    cycle_time = lifecycles['cycle_time']
+
+    assert [cycle_time[key] for key in ('count', 'average_days', 'median_days', 'p90_days', 'max_days')] == [
+        2, 15.0, 10.0, 20.0, 20.0
+    ]
+    assert [(month['month'], month['count']) for month in cycle_time['by_month']] == [('2024-01', 2)]
+
+
+def test_time_in_state_ranks_the_bottleneck(lifecycles):
+    states = {state['status']: state for state in lifecycles['states']}
+    investigation = states['Under Investigation']
+
+    assert lifecycles['bottleneck'] == 'Under Investigation'
+    assert (investigation['total_days'], investigation['average_days']) == (8 + 59, 8.0)
+    assert [investigation[key] for key in ('visits', 'completed_visits', 'open_now')] == [2, 1, 1]
+    assert (states['Open']['total_days'], states['Open']['rank']) == (2 + 20 + 1, 2)
+
+
+def test_aging_counts_records_open_at_the_cutoff(lifecycles):
+    aging = lifecycles['aging']
+
+    assert aging['open'] == 1
+    assert [bucket['label'] for bucket in aging['buckets'] if bucket['count']] == ['31-60 days']
+    assert aging['oldest'] == [{'id': 3, 'status': 'Under Investigation', 'age_days': 60.0,
+                                'in_status_days': 59.0}]
+
+
+def test_lifecycle_endpoint_is_cached_until_a_status_changes(client):
+    first = client.get('/api/analytics/lifecycle?entity=capa').get_json()
+    assert set(first) == {'period', 'capa', 'cached', 'data_version'}
+    assert client.get('/api/analytics/lifecycle?entity=capa').get_json()['cached'] is True
+
+    run_write(lambda conn: conn.execute('''
+        UPDATE capa SET status = CASE status WHEN 'Closed' THEN 'Open' ELSE 'Closed' END WHERE id = 1
+    '''))
+    assert client.get('/api/analytics/lifecycle?entity=capa').get_json()['cached'] is False
+    assert client.get('/api/analytics/lifecycle?entity=risk').status_code == 400
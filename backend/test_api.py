@@ -0,0 +1,171 @@
+"""
+Tests for the dashboard summary, batch endpoint, request validation, query budgets and startup of the API
+"""
+import threading
+import pytest
+import database
+
+
+def batch(client, requests, snapshot=False):
+    response = client.post('/api/batch', json={'requests': requests, 'snapshot': snapshot})
+    assert response.status_code == 200
+    return response.get_json()['responses']
+
+
+# ===================================
+# Dashboard Summary
+# ===================================
+
+def test_summary_matches_the_standalone_endpoints(client):
+    summary = client.get('/api/dashboard/summary').get_json()
+
+    assert set(summary['widgets']) == set(summary['timings_ms'])
+    for widget, path in (('kpis', '/api/dashboard/kpis'), ('deviation_stats', '/api/deviations/stats'),
+                         ('capa_stats', '/api/capa/stats'), ('trends', '/api/dashboard/trends')):
+        assert summary['widgets'][widget] == client.get(path).get_json()
+
+
+def test_summary_passes_list_arguments_to_its_list_widgets(client):
+    args = 'fields=status&status=Open'
+    summary = client.get(f'/api/dashboard/summary?widgets=deviations,capa&{args}').get_json()
+
+    assert set(summary['widgets']) == {'deviations', 'capa'}
+    assert summary['widgets']['deviations'] == client.get(f'/api/deviations?{args}').get_json()
+    assert all(set(row) == {'id', 'status'} and row['status'] == 'Open'
+               for widget in summary['widgets'].values() for row in widget)
+
+
+@pytest.mark.parametrize('query', ['widgets=kpis,weather', 'widgets=deviations&sort=password'])
+def test_summary_rejects_bad_widgets_and_arguments(client, query):
+    assert client.get(f'/api/dashboard/summary?{query}').status_code == 400
+
+
+# ===================================
+# Batch
+# ===================================
+
+@pytest.mark.parametrize('snapshot', [False, True])
+def test_batch_reads_see_earlier_writes(client, snapshot):
+    responses = batch(client, [
+        {'id': 'before', 'path': '/api/deviations/1'},
+        {'id': 'write', 'method': 'PUT', 'path': '/api/deviations/1', 'body': {'title': 'Batched title'}},
+        {'id': 'after', 'path': '/api/deviations/1'},
+    ], snapshot)
+
+    assert [r['id'] for r in responses] == ['before', 'write', 'after']
+    assert [r['status'] for r in responses] == [200, 200, 200]
+    assert responses[0]['body']['title'] != 'Batched title'
+    assert responses[2]['body']['title'] == 'Batched title'
+
+
+def test_snapshot_batch_keeps_shared_connection_on_one_thread(client, monkeypatch):
+    threads = set()
+    shared_read = database._shared_read
+
+    def recording(conn):
+        threads.add(threading.get_ident())
+        return shared_read(conn)
+
+    monkeypatch.setattr(database, '_shared_read', recording)
+    responses = batch(client, [{'id': i, 'path': '/api/dashboard/summary'} for i in range(3)], snapshot=True)
+
+    assert [r['status'] for r in responses] == [200, 200, 200]
+    assert responses[0]['body']['widgets'] == responses[2]['body']['widgets']
+    # Widgets that would run on the summary pool run inline on the snapshot's thread
+    assert len(threads) == 1
+
+
+def test_batch_rejects_unknown_method(client):
+    response = client.post('/api/batch', json={'requests': [{'method': 'PATCH', 'path': '/api/deviations'}]})
+    assert response.status_code == 400
+    assert response.get_json()['index'] == 0
+
+
+# ===================================
+# Request Validation
+# ===================================
+
+@pytest.mark.parametrize('before', ['garbage', '2024-13-99', '2024-13xyz', '2024-01garbage'])
+def test_invalid_monitoring_cursor_is_rejected(client, before):
+    response = client.get(f'/api/monitoring/process?before={before}')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+@pytest.mark.parametrize('path', ['/api/monitoring/history', '/api/monitoring/export'])
+def test_invalid_monitoring_range_is_rejected(client, path):
+    response = client.get(f'{path}?start=2024-01-01&end=2024-01garbage')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_malformed_report_parameters_are_rejected(client):
+    response = client.post('/api/reports/generate', json={
+        'report_type': 'Deviation Summary', 'title': 'Report', 'parameters': '{bad', 'generated_by': 1
+    })
+    assert response.status_code == 400
+    assert 'not valid JSON' in response.get_json()['error']
+
+
+def test_change_cursor_from_another_database_is_reset(client):
+    page = client.get('/api/changes?since=999999').get_json()
+    assert page['reset'] is True
+    assert page['latest_seq'] < 999999
+
+
+# ===================================
+# Query Budgets
+# ===================================
+
+@pytest.fixture
+def slow_deviations(client, monkeypatch):
+    """GET /api/deviations runs a query that takes minutes unless it is interrupted"""
+    import api
+
+    def slow(conn, args):
+        return conn.execute('''
+            WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 1000000000)
+            SELECT COUNT(*) FROM n
+        ''').fetchone()[0]
+
+    monkeypatch.setattr(api, 'query_deviations', slow)
+    monkeypatch.setitem(api.QUERY_BUDGETS, 'get_deviations', 0.05)
+
+
+def test_query_over_the_endpoint_budget_answers_504(client, slow_deviations):
+    response = client.get('/api/deviations')
+
+    assert response.status_code == 504
+    assert response.get_json()['budget_seconds'] == 0.05
+    assert client.get('/api/deviations/1').status_code == 200
+
+
+def test_query_of_a_disconnected_client_answers_499(client, slow_deviations, monkeypatch):
+    import api
+    monkeypatch.setitem(api.QUERY_BUDGETS, 'get_deviations', 60)
+
+    response = client.get('/api/deviations', environ_base={'qms.is_disconnected': lambda: True})
+
+    assert response.status_code == 499
+
+
+# ===================================
+# Startup
+# ===================================
+
+def test_services_start_once_and_mark_the_database_as_served(client, monkeypatch):
+    import api
+    started = []
+    monkeypatch.setattr(api, 'startup_report', {'import_ms': 0, 'sites': {}})
+    monkeypatch.setattr(api, 'start_deferred', lambda name, start: started.append(name))
+    monkeypatch.setattr(api.changefeed, 'start_compaction_thread', lambda: started.append('compaction'))
+
+    try:
+        api.start_services()
+        api.start_services()
+    finally:
+        api.capa_schedulers.get().stop()
+
+    assert started == ['compaction', 'backup', 'maintenance']
+    assert list(api.startup_report['sites']) == [database.DEFAULT_SITE]
+    assert database.server_running()
@@ -0,0 +1,127 @@
+"""
+Tests for archiving monitoring and audit rows into columnar segments
+"""
+import os
+import pytest
+import archive
+import partitions
+from database import get_read_connection, run_write
+
+
+@pytest.fixture
+def archive_dir(qms_db, tmp_path, monkeypatch):
+    path = str(tmp_path / 'archive')
+    monkeypatch.setattr(archive, 'ARCHIVE_DIR', path)
+    return path
+
+
+def add_audit_entries(timestamps):
+    def insert(conn):
+        conn.executemany('''
+            INSERT INTO audit_logs (user_id, action, entity_type, entity_id, timestamp)
+            VALUES (1, 'UPDATE', 'deviation', ?, ?)
+        ''', list(enumerate(timestamps, 1)))
+    run_write(insert)
+
+
+def audit_timestamps(**kwargs):
+    return [row['timestamp'] for row in archive.query_history('audit_logs', **kwargs)]
+
+
+def reading(recorded_at, name='Temperature'):
+    return {'location': 'Clean Room A', 'parameter_type': 'Environmental', 'parameter_name': name,
+            'value': 21.5, 'unit': 'C', 'min_limit': 20, 'max_limit': 24, 'status': 'Normal',
+            'alert_level': 'None', 'recorded_at': recorded_at, 'recorded_by': 1}
+
+
+# ===================================
+# Segment Files
+# ===================================
+
+def test_segment_round_trip(tmp_path):
+    path = str(tmp_path / 'audit.qseg')
+    rows = [(1, 'CREATE', '2020-01-01 00:00:00'), (2, 'UPDATE', '2020-01-02 00:00:00')]
+    header = archive.write_segment(path, 'audit_logs', ['id', 'action', 'timestamp'], rows, 'timestamp')
+
+    assert (header['row_count'], header['min_ts'], header['max_ts']) == (2, rows[0][2], rows[1][2])
+    assert os.stat(path).st_mode & 0o777 == 0o444
+    with archive.Segment(path) as segment:
+        assert segment.column('action') == ['CREATE', 'UPDATE']
+        assert segment.rows(start='2020-01-02') == [{'id': 2, 'action': 'UPDATE', 'timestamp': rows[1][2]}]
+        assert segment.rows(filters={'action': 'DELETE'}) == []
+
+
+def test_non_segment_file_is_rejected(tmp_path):
+    path = tmp_path / 'other.qseg'
+    path.write_bytes(b'not a segment')
+    with pytest.raises(ValueError, match='Not a QMS archive segment'):
+        archive.Segment(str(path))
+
+
+# ===================================
+# Archival
+# ===================================
+
+def test_old_audit_entries_move_into_a_segment(archive_dir):
+    add_audit_entries(['2020-01-01 08:00:00', '2020-02-01 08:00:00', '2099-01-01 08:00:00'])
+
+    result = archive.archive_table('audit_logs', horizon_days=365)
+
+    assert result['archived_rows'] == 2
+    assert len(result['segments']) == 1
+    with get_read_connection() as conn:
+        assert [row[0] for row in conn.execute('SELECT timestamp FROM audit_logs')] == ['2099-01-01 08:00:00']
+    segment = archive.list_segments('audit_logs')[0]
+    assert (segment['min_ts'], segment['max_ts'], segment['row_count']) == (
+        '2020-01-01 08:00:00', '2020-02-01 08:00:00', 2)
+    assert audit_timestamps() == ['2099-01-01 08:00:00', '2020-02-01 08:00:00', '2020-01-01 08:00:00']
+    assert archive.archive_table('audit_logs', horizon_days=365)['archived_rows'] == 0
+
+
+def test_history_skips_segments_outside_the_range(archive_dir, monkeypatch):
+    add_audit_entries(['2020-01-01 08:00:00', '2099-01-01 08:00:00'])
+    archive.archive_table('audit_logs', horizon_days=365)
+    opened = []
+    segment_class = archive.Segment
+    monkeypatch.setattr(archive, 'Segment', lambda path: opened.append(path) or segment_class(path))
+
+    assert audit_timestamps(start='2021-01-01') == ['2099-01-01 08:00:00']
+    assert opened == []
+    # A limit filled by live rows newer than every segment leaves the segments closed too
+    assert audit_timestamps(limit=1) == ['2099-01-01 08:00:00']
+    assert opened == []
+    assert audit_timestamps(end='2020-12-31') == ['2020-01-01 08:00:00']
+    assert len(opened) == 1
+
+
+def test_unknown_filter_column_is_rejected(archive_dir):
+    with pytest.raises(ValueError, match='Unknown filter column'):
+        archive.query_history('audit_logs', filters={'password': 'x'})
+    with pytest.raises(ValueError, match='not archivable'):
+        archive.query_history('users')
+
+
+def test_export_streams_archived_then_live_rows(archive_dir):
+    add_audit_entries(['2020-01-01 08:00:00', '2099-01-01 08:00:00'])
+    archive.archive_table('audit_logs', horizon_days=365)
+
+    lines = ''.join(archive.export_history_csv('audit_logs')).splitlines()
+
+    assert lines[0].startswith('id,user_id,action')
+    assert [line.split(',')[-1] for line in lines[1:]] == ['2020-01-01 08:00:00', '2099-01-01 08:00:00']
+
+
+def test_expired_monitoring_month_is_archived_and_its_file_dropped(archive_dir):
+    partitions.record_reading(reading('2020-03-05 10:00:00'))
+    partitions.record_reading(reading('2020-03-06 10:00:00', 'Humidity'))
+    path = partitions.partition_path('2020-03')
+    assert os.path.exists(path)
+
+    result = archive.archive_table('monitoring', horizon_days=365)
+
+    assert not os.path.exists(path)
+    with get_read_connection() as conn:
+        assert '2020-03' not in partitions.list_months(conn)
+    history = archive.query_history('monitoring', start='2020-03-01', end='2020-03-31')
+    assert [row['parameter_name'] for row in history] == ['Humidity', 'Temperature']
+    assert result['archived_rows'] == 2
@@ -0,0 +1,90 @@
+"""
+Tests for online backups: snapshots, verification and restore
+"""
+import gzip
+import os
+import sqlite3
+import pytest
+import backup
+import database
+import partitions
+from database import get_read_connection, run_write
+
+
+@pytest.fixture
+def backup_dir(tmp_path):
+    return str(tmp_path / 'backups')
+
+
+def deviation_count():
+    with get_read_connection() as conn:
+        return conn.execute('SELECT COUNT(*) FROM deviations').fetchone()[0]
+
+
+def record(recorded_at):
+    return partitions.record_reading({
+        'location': 'Clean Room A', 'parameter_type': 'Environmental', 'parameter_name': 'Temperature',
+        'value': 21.0, 'unit': 'C', 'status': 'Normal', 'recorded_at': recorded_at, 'recorded_by': 2
+    })
+
+
+def test_snapshot_is_verified_against_its_manifest(qms_db, backup_dir):
+    record('2020-03-04 10:00:00')
+
+    manifest = backup.create_backup(backup_dir)
+
+    assert manifest['table_counts']['deviations'] == deviation_count()
+    assert '2020-03' in manifest['partitions']
+    assert backup.verify_backup(manifest['file_name'], backup_dir) == {
+        'file_name': manifest['file_name'], 'ok': True, 'problems': []
+    }
+
+
+def test_damaged_snapshot_fails_verification(qms_db, backup_dir):
+    manifest = backup.create_backup(backup_dir)
+    path = os.path.join(backup_dir, manifest['file_name'])
+    with gzip.open(path, 'rb') as f:
+        data = bytearray(f.read())
+    data[-100] ^= 0xFF
+    with gzip.open(path, 'wb') as f:
+        f.write(bytes(data))
+
+    result = backup.verify_backup(manifest['file_name'], backup_dir)
+
+    assert not result['ok']
+    assert 'checksum mismatch' in result['problems']
+
+
+def test_backup_leaves_the_source_journal_mode_alone(db_path, backup_dir):
+    database.init_database()
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+
+    backup.create_backup(backup_dir)
+
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+
+
+def test_restore_brings_back_rows_and_partitions(qms_db, backup_dir):
+    before = deviation_count()
+    manifest = backup.create_backup(backup_dir)
+    run_write(lambda conn: conn.execute('DELETE FROM deviations WHERE id > 5'))
+    record('2020-03-04 10:00:00')
+
+    result = backup.restore_backup(manifest['file_name'], backup_dir)
+
+    assert result['restored'] == manifest['file_name']
+    assert deviation_count() == before
+    assert not os.path.exists(partitions.partition_path('2020-03'))
+    assert backup.verify_backup(result['pre_restore_backup'], backup_dir)['ok']
+
+
+def test_restore_is_refused_while_a_server_runs(qms_db, backup_dir):
+    manifest = backup.create_backup(backup_dir)
+    run_write(lambda conn: conn.execute('DELETE FROM deviations WHERE id > 5'))
+    assert database.hold_server_lock()
+
+    with pytest.raises(RuntimeError):
+        backup.restore_backup(manifest['file_name'], backup_dir)
+    assert deviation_count() == 5
@@ -0,0 +1,117 @@
+"""
+Tests for the hierarchical timer wheel and CAPA due-date escalations
+"""
+import random
+from datetime import datetime
+import pytest
+import database
+from database import get_read_connection, run_write
+from capa_scheduler import CapaScheduler, HierarchicalTimerWheel
+
+
+class Clock:
+    def __init__(self, when):
+        self.now = when.timestamp()
+
+    def __call__(self):
+        return self.now
+
+    def set(self, when):
+        self.now = when.timestamp()
+
+
+@pytest.fixture
+def capa_db(db_path):
+    database.init_database()
+    return db_path
+
+
+def create_capa(number, target_date, status='Open'):
+    return run_write(lambda conn: conn.execute('''
+        INSERT INTO capa (capa_number, type, title, description, action_plan, responsible_person,
+                          target_date, status)
+        VALUES (?, 'Corrective', ?, 'Test', 'Fix it', 'QA Lead', ?, ?)
+    ''', (number, f'CAPA {number}', target_date, status)).lastrowid)
+
+
+def numbers(entries):
+    return [entry['capa_number'] for entry in entries]
+
+
+def escalations():
+    with get_read_connection() as conn:
+        return [tuple(row) for row in conn.execute('''
+            SELECT c.capa_number, e.event FROM capa_escalations e JOIN capa c ON c.id = e.capa_id
+            ORDER BY c.capa_number, e.event
+        ''')]
+
+
+# ===================================
+# Timer Wheel
+# ===================================
+
+def test_wheel_fires_every_timer_on_its_tick_across_levels():
+    wheel = HierarchicalTimerWheel(start_tick=5, slots=4, levels=2)
+    rng = random.Random(3)
+    # Up to four times the span of both levels, so some timers start in the overflow list
+    expiries = [5 + rng.randint(1, 64) for _ in range(200)]
+    for index, expiry in enumerate(expiries):
+        assert not wheel.add(expiry, index)
+
+    fired = []
+    while wheel.current_tick < 5 + 64:
+        to_tick = wheel.current_tick + rng.randint(1, 7)
+        expired = wheel.advance(to_tick)
+        assert all(expiries[index] <= to_tick for index in expired)
+        assert [expiries[index] for index in expired] == sorted(expiries[index] for index in expired)
+        fired += expired
+        assert sorted(fired) == [i for i, expiry in enumerate(expiries) if expiry <= wheel.current_tick]
+
+
+def test_wheel_reports_timers_already_due():
+    wheel = HierarchicalTimerWheel(start_tick=100)
+    assert wheel.add(100, 'now') and wheel.add(40, 'past')
+    assert wheel.advance(200) == []
+
+
+# ===================================
+# CAPA Scheduler
+# ===================================
+
+def test_open_capa_are_due_soon_then_overdue_and_escalated_once(capa_db):
+    create_capa('CAPA-A', '2024-05-05')
+    create_capa('CAPA-B', '2024-04-20')
+    create_capa('CAPA-C', '2024-06-30')
+    create_capa('CAPA-D', '2024-04-01', status='Closed')
+    clock = Clock(datetime(2024, 5, 1, 12))
+    scheduler = CapaScheduler(clock=clock, tick_seconds=3600)
+
+    assert numbers(scheduler.overdue_list()) == ['CAPA-B']
+    assert numbers(scheduler.due_soon_list()) == ['CAPA-A']
+
+    clock.set(datetime(2024, 5, 6, 12))
+    assert numbers(scheduler.overdue_list()) == ['CAPA-B', 'CAPA-A']
+    assert scheduler.due_soon_list() == []
+    assert escalations() == [('CAPA-A', 'due_soon'), ('CAPA-A', 'overdue'), ('CAPA-B', 'overdue')]
+
+    # A restarted scheduler finds the same CAPA overdue but records nothing again
+    restarted = CapaScheduler(clock=clock, tick_seconds=3600)
+    assert numbers(restarted.overdue_list()) == ['CAPA-B', 'CAPA-A']
+    with get_read_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM audit_logs WHERE action = 'ESCALATE'").fetchone()[0] == 3
+
+
+def test_rescheduled_and_closed_capa_drop_their_timers(capa_db):
+    a = create_capa('CAPA-A', '2024-05-05')
+    b = create_capa('CAPA-B', '2024-04-20')
+    clock = Clock(datetime(2024, 5, 1, 12))
+    scheduler = CapaScheduler(clock=clock, tick_seconds=3600)
+    scheduler.load()
+
+    scheduler.track({'id': a, 'capa_number': 'CAPA-A', 'target_date': '2024-06-30', 'status': 'Open'})
+    scheduler.track({'id': b, 'capa_number': 'CAPA-B', 'target_date': '2024-04-20', 'status': 'Closed'})
+    clock.set(datetime(2024, 5, 6, 12))
+
+    assert scheduler.overdue_list() == []
+    assert scheduler.due_soon_list() == []
+    assert escalations() == [('CAPA-A', 'due_soon'), ('CAPA-B', 'overdue')]
@@ -0,0 +1,87 @@
+"""
+Tests for change feed paging, collapsing and resets
+"""
+from database import get_read_connection, run_write
+from changefeed import fetch_changes, latest_seq
+
+
+def changes(since, **kwargs):
+    with get_read_connection() as conn:
+        return fetch_changes(conn, since, **kwargs)
+
+
+def newest():
+    with get_read_connection() as conn:
+        return latest_seq(conn)
+
+
+def test_missing_cursor_asks_for_reset(qms_db):
+    page = changes(0)
+    assert page == {'reset': True, 'since': 0, 'latest_seq': newest()}
+
+
+def test_pages_cover_every_change_once(qms_db):
+    seen = []
+    since = 1
+    while True:
+        page = changes(since, limit=7)
+        assert not page['reset']
+        seen += [(t, record['id']) for t, records in page['upserts'].items() for record in records]
+        assert page['latest_seq'] > since or not page['has_more']
+        since = page['latest_seq']
+        if not page['has_more']:
+            break
+
+    assert since == newest()
+    assert len(seen) == len(set(seen))
+    with get_read_connection() as conn:
+        deviations = conn.execute('SELECT COUNT(*) FROM deviations').fetchone()[0]
+    assert len([entity for entity in seen if entity[0] == 'deviations']) == deviations
+    assert changes(since)['upserts'] == {}
+
+
+def test_repeated_updates_collapse_to_current_row(qms_db):
+    since = newest()
+    for title in ('first', 'second', 'third'):
+        run_write(lambda conn, title=title: conn.execute(
+            'UPDATE deviations SET title = ? WHERE id = 1', (title,)
+        ))
+
+    page = changes(since)
+
+    assert [record['title'] for record in page['upserts']['deviations']] == ['third']
+    assert page['latest_seq'] == newest()
+
+
+def test_deletes_become_tombstones(qms_db):
+    since = newest()
+    run_write(lambda conn: conn.execute('DELETE FROM capa WHERE id = 2'))
+
+    page = changes(since)
+
+    assert page['tombstones'] == {'capa': [2]}
+    assert page['upserts'] == {}
+
+
+def test_entity_filter(qms_db):
+    since = newest()
+    run_write(lambda conn: conn.execute("UPDATE deviations SET title = 'x' WHERE id = 1"))
+    run_write(lambda conn: conn.execute("UPDATE capa SET description = 'x' WHERE id = 1"))
+
+    page = changes(since, entity_types=['capa'])
+
+    assert list(page['upserts']) == ['capa']
+
+
+def test_cursor_behind_compaction_watermark_asks_for_reset(qms_db):
+    watermark = newest() - 1
+    run_write(lambda conn: conn.execute('UPDATE change_log_state SET compacted_through = ?', (watermark,)))
+
+    assert changes(watermark - 1)['reset'] is True
+    assert changes(watermark)['reset'] is False
+
+
+def test_cursor_ahead_of_log_asks_for_reset(qms_db):
+    page = changes(newest() + 1000)
+    assert page['reset'] is True
+    assert page['latest_seq'] == newest()
@@ -0,0 +1,230 @@
+"""
+Tests for the writer thread, schema migrations, read snapshots and query deadlines
+"""
+import sqlite3
+import threading
+import pytest
+import database
+from database import (DatabaseWriter, QueryCancelled, QueryTimeout, get_read_connection, init_database,
+                      read_snapshot, in_read_snapshot, run_write, set_query_deadline, clear_query_deadline,
+                      SCHEMA_VERSION)
+
+# Runs for minutes unless it is interrupted
+SLOW_QUERY = '''
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 1000000000)
+    SELECT COUNT(*) FROM n
+'''
+
+
+def count_rows(table):
+    with get_read_connection() as conn:
+        return conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+
+# ===================================
+# Writer Thread
+# ===================================
+
+@pytest.fixture
+def writer(db_path):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT UNIQUE)')
+    writer = DatabaseWriter(db_path)
+    yield writer
+    writer.stop()
+
+
+def insert(conn, name):
+    return conn.execute('INSERT INTO items (name) VALUES (?)', (name,)).lastrowid
+
+
+def test_write_commits_and_returns_result(writer, db_path):
+    assert writer.execute(insert, 'a') == 1
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT name FROM items').fetchall() == [('a',)]
+
+
+def test_failing_job_rolls_back_alone(writer, db_path):
+    release = threading.Event()
+    # Hold the writer so the next jobs are drained into one group commit
+    blocker = writer.submit(lambda conn: release.wait(5))
+
+    def insert_then_fail(conn):
+        insert(conn, 'b')
+        raise ValueError('rejected')
+
+    futures = [writer.submit(insert, 'a'), writer.submit(insert_then_fail), writer.submit(insert, 'c')]
+    release.set()
+    blocker.result()
+
+    assert futures[0].result() == 1
+    with pytest.raises(ValueError, match='rejected'):
+        futures[1].result()
+    assert futures[2].result() == 2
+    with sqlite3.connect(db_path) as conn:
+        assert [row[0] for row in conn.execute('SELECT name FROM items ORDER BY id')] == ['a', 'c']
+
+
+def test_constraint_error_reaches_caller(writer):
+    writer.execute(insert, 'a')
+    with pytest.raises(sqlite3.IntegrityError):
+        writer.execute(insert, 'a')
+    assert writer.execute(insert, 'b') == 2
+
+
+def test_connection_failure_is_reported_and_retried(writer, monkeypatch):
+    connect = writer._connect
+
+    def locked():
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(writer, '_connect', locked)
+    with pytest.raises(sqlite3.OperationalError, match='locked'):
+        writer.execute(insert, 'a')
+    monkeypatch.setattr(writer, '_connect', connect)
+    assert writer.execute(insert, 'a') == 1
+
+
+def test_jobs_keep_submission_order(writer, db_path):
+    futures = [writer.submit(insert, f'item-{i}') for i in range(200)]
+    assert [f.result() for f in futures] == list(range(1, 201))
+
+
+# ===================================
+# Migrations
+# ===================================
+
+def test_fresh_database_migrates_to_current_version(db_path):
+    result = init_database()
+    assert result['applied'] == list(range(1, SCHEMA_VERSION + 1))
+    with get_read_connection() as conn:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {'change_log', 'status_history', 'monitoring_partitions', 'maintenance_runs'} <= tables
+
+
+def test_legacy_database_is_adopted_without_data_loss(legacy_db):
+    with sqlite3.connect(legacy_db) as conn:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == 0
+        before = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                  for table in ('users', 'deviations', 'capa', 'monitoring', 'batches')}
+
+    result = init_database()
+
+    assert result['applied'] == list(range(1, SCHEMA_VERSION + 1))
+    assert {table: count_rows(table) for table in before} == before
+
+
+def test_database_at_an_older_version_gets_the_later_migrations(db_path):
+    with sqlite3.connect(db_path) as conn:
+        database.MIGRATIONS[0][2](conn.cursor())
+        conn.execute('PRAGMA user_version = 1')
+
+    result = init_database()
+
+    assert result['applied'] == list(range(2, SCHEMA_VERSION + 1))
+    with get_read_connection() as conn:
+        names = {row[0] for row in conn.execute('SELECT name FROM sqlite_master')}
+    assert {'archive_segments', 'trg_deviations_insert_change_log', 'risk_cube', 'maintenance_runs'} <= names
+
+
+def test_baseline_holds_only_the_original_tables(db_path):
+    with sqlite3.connect(db_path) as conn:
+        database.MIGRATIONS[0][2](conn.cursor())
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert tables - {'sqlite_sequence'} == {'users', 'deviations', 'capa', 'reports', 'monitoring',
+                                            'audit_logs', 'batches', 'documents'}
+
+
+def test_current_database_is_left_untouched(db_path):
+    init_database()
+    assert init_database() == {'version': SCHEMA_VERSION, 'applied': [], 'drift': False}
+
+
+def test_schema_drift_reapplies_migrations(db_path):
+    init_database()
+    run_write(lambda conn: conn.execute('DROP INDEX idx_maintenance_runs_task'))
+
+    result = init_database()
+
+    assert result['drift'] is True
+    with get_read_connection() as conn:
+        assert conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'idx_maintenance_runs_task'"
+        ).fetchone()
+
+
+def test_newer_schema_is_refused(db_path):
+    init_database()
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION + 1}')
+    with pytest.raises(RuntimeError, match='newer'):
+        init_database()
+
+
+# ===================================
+# Read Snapshots
+# ===================================
+
+def test_snapshot_reads_ignore_later_writes(qms_db):
+    with read_snapshot():
+        # The snapshot starts with its first read
+        before = count_rows('deviations')
+        run_write(lambda conn: conn.execute('DELETE FROM deviations WHERE id = 1'))
+        assert count_rows('deviations') == before
+    assert count_rows('deviations') == before - 1
+
+
+def test_snapshot_connection_stays_on_its_thread(qms_db):
+    seen = {}
+
+    def other_thread():
+        seen['in_snapshot'] = in_read_snapshot()
+        with get_read_connection() as conn:
+            seen['conn'] = conn
+
+    with read_snapshot() as shared:
+        assert in_read_snapshot()
+        with get_read_connection() as conn:
+            assert conn is shared
+        context = database.contextvars.copy_context()
+        thread = threading.Thread(target=context.run, args=(other_thread,))
+        thread.start()
+        thread.join()
+
+    assert seen['in_snapshot'] is False
+    assert seen['conn'] is not shared
+
+
+# ===================================
+# Query Deadlines
+# ===================================
+
+def run_with_deadline(seconds, sql, is_disconnected=None, snapshot=False):
+    token = set_query_deadline(seconds, is_disconnected, 'test')
+    try:
+        with read_snapshot() if snapshot else get_read_connection() as conn:
+            return conn.execute(sql).fetchone()[0]
+    finally:
+        clear_query_deadline(token)
+
+
+@pytest.mark.parametrize('snapshot', [False, True])
+def test_query_over_its_budget_is_aborted(qms_db, snapshot):
+    with pytest.raises(QueryTimeout) as info:
+        run_with_deadline(0.05, SLOW_QUERY, snapshot=snapshot)
+
+    assert not isinstance(info.value, QueryCancelled)
+    assert 0.05 <= info.value.elapsed < 5
+    assert 'WITH RECURSIVE' in info.value.sql and info.value.plan
+    # Later reads run normally, without the deadline
+    assert count_rows('deviations') > 0
+
+
+def test_query_of_a_disconnected_client_is_cancelled(qms_db):
+    with pytest.raises(QueryCancelled):
+        run_with_deadline(60, SLOW_QUERY, is_disconnected=lambda: True)
+
+
+def test_query_within_its_budget_completes(qms_db):
+    assert run_with_deadline(5, 'SELECT COUNT(*) FROM deviations', is_disconnected=lambda: False) > 0
@@ -0,0 +1,156 @@
+"""
+Tests for the content-addressed document store: chunking, ranges and garbage collection
+"""
+import io
+import os
+import random
+import pytest
+import database
+import document_store
+from database import run_write, use_site
+from document_store import RangeNotSatisfiable, add_revision, collect_garbage, parse_range
+
+CONTENT = random.Random(7).randbytes(3 * 1024 * 1024)
+
+
+@pytest.fixture
+def store(qms_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(document_store, 'STORE_DIR', str(tmp_path / 'document_store'))
+    return create_document()
+
+
+def create_document():
+    return run_write(lambda conn: conn.execute('''
+        INSERT INTO documents (document_number, title, document_type, version)
+        VALUES ('SOP-001', 'Cleaning', 'SOP', '1.0')
+    ''').lastrowid)
+
+
+def content(document_id, version=None):
+    with database.get_read_connection() as conn:
+        revision = document_store.get_revision(conn, document_id, version)
+    return b''.join(document_store.iter_content(revision))
+
+
+def chunk_files(root=None):
+    return sorted(name for name, _ in document_store._chunk_files(root or document_store.store_dir()))
+
+
+# ===================================
+# Chunking
+# ===================================
+
+def test_revision_reads_back_and_shares_chunks_after_an_insertion(store):
+    first = add_revision(store, '1.0', io.BytesIO(CONTENT))
+    second = add_revision(store, '2.0', io.BytesIO(b'Revised preamble. ' + CONTENT))
+
+    assert first['chunks'] > 1 and first['deduplicated_bytes'] == 0
+    assert second['new_chunks'] == 1
+    assert second['deduplicated_bytes'] > len(CONTENT) // 2
+    assert content(store, '1.0') == CONTENT
+    assert content(store) == b'Revised preamble. ' + CONTENT
+
+
+def test_existing_version_is_rejected_without_storing_chunks(store):
+    add_revision(store, '1.0', io.BytesIO(b'original'))
+    files = chunk_files()
+
+    with pytest.raises(document_store.DocumentError):
+        add_revision(store, '1.0', io.BytesIO(b'replacement'))
+    assert chunk_files() == files
+
+
+# ===================================
+# Ranges
+# ===================================
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-9', (0, 9)), ('bytes=90-', (90, 99)), ('bytes=-10', (90, 99)), ('bytes=5-500', (5, 99)),
+    (None, None), ('bytes=0-1,5-6', None), ('items=0-9', None), ('bytes=9-3', None), ('bytes=a-b', None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize('header', ['bytes=100-', 'bytes=-0'])
+def test_unsatisfiable_range(header):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, 100)
+
+
+def test_download_serves_ranges_and_etags(store, client):
+    upload = client.post(f'/api/documents/{store}/revisions?version=2.0&file_name=sop.pdf', data=CONTENT)
+    assert upload.status_code == 201
+    url = f'/api/documents/{store}/content'
+
+    whole = client.get(url)
+    assert whole.data == CONTENT
+    part = client.get(url, headers={'Range': 'bytes=1048570-1048580'})
+    assert part.status_code == 206
+    assert part.headers['Content-Range'] == f'bytes 1048570-1048580/{len(CONTENT)}'
+    assert part.data == CONTENT[1048570:1048581]
+    assert client.get(url, headers={'Range': f'bytes={len(CONTENT)}-'}).status_code == 416
+    assert client.get(url, headers={'If-None-Match': whole.headers['ETag']}).status_code == 304
+
+
+# ===================================
+# Garbage Collection
+# ===================================
+
+def test_unreferenced_chunks_are_collected(store):
+    document_store._write_chunk('0' * 64, b'orphan')
+    add_revision(store, '1.0', io.BytesIO(b'kept'))
+
+    assert collect_garbage(min_age_seconds=0) == (1, len(b'orphan'))
+    assert content(store) == b'kept'
+
+
+def test_chunks_of_an_upload_in_progress_are_kept(store):
+    class SlowUpload(io.BytesIO):
+        """Runs garbage collection once the first chunk has been stored"""
+        collected = None
+
+        def read(self, size=-1):
+            if self.collected is None and chunk_files():
+                self.collected = collect_garbage(min_age_seconds=0)
+            return super().read(size)
+
+    upload = SlowUpload(CONTENT)
+    add_revision(store, '1.0', upload)
+
+    assert upload.collected == (0, 0)
+    assert content(store) == CONTENT
+    assert os.listdir(os.path.join(document_store.store_dir(), 'pending')) == []
+
+
+def test_each_site_collects_only_its_own_store(store, monkeypatch):
+    monkeypatch.setattr(database, 'CONFIGURED_SITES', ['plant2'])
+    add_revision(store, '1.0', io.BytesIO(b'default site'))
+    with use_site('plant2'):
+        database.init_database()
+        document_id = create_document()
+        add_revision(document_id, '1.0', io.BytesIO(b'plant 2'))
+        assert collect_garbage(min_age_seconds=0) == (0, 0)
+        assert content(document_id) == b'plant 2'
+        plant2_files = chunk_files()
+
+    assert collect_garbage(min_age_seconds=0) == (0, 0)
+    assert content(store) == b'default site'
+    assert chunk_files() != plant2_files
+
+
+def test_chunks_in_the_shared_store_stay_readable_for_other_sites(store, monkeypatch):
+    monkeypatch.setattr(database, 'CONFIGURED_SITES', ['plant2'])
+    with use_site('plant2'):
+        database.init_database()
+        document_id = create_document()
+        # Stored before stores were per site: the chunk files live in the shared store
+        with monkeypatch.context() as legacy:
+            legacy.setattr(document_store, 'store_dir', lambda: document_store.STORE_DIR)
+            add_revision(document_id, '1.0', io.BytesIO(b'legacy'))
+        assert chunk_files() == []
+        assert content(document_id) == b'legacy'
+
+    assert collect_garbage(min_age_seconds=0) == (0, 0)
+    with use_site('plant2'):
+        assert content(document_id) == b'legacy'
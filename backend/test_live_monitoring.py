@@ -0,0 +1,160 @@
+"""
+Tests for the live monitoring ring buffer and the endpoints it serves
+"""
+import pytest
+import archive
+import database
+import partitions
+from database import get_read_connection
+from live_monitoring import LiveMonitoringBuffer, SensorRing, StringTable
+
+
+def reading(**overrides):
+    return dict({'location': 'Clean Room A', 'parameter_type': 'Environmental',
+                 'parameter_name': 'Temperature', 'value': 21.5, 'unit': 'C', 'min_limit': 20,
+                 'max_limit': 24, 'recorded_by': 2}, **overrides)
+
+
+def stored_readings():
+    with get_read_connection() as conn:
+        return partitions.count_readings(conn)
+
+
+# ===================================
+# Recording
+# ===================================
+
+def test_recorded_reading_is_served_from_the_buffer(client):
+    response = client.post('/api/monitoring/record', json=reading(value=25.0))
+    assert response.status_code == 201
+    assert response.get_json()['status'] == 'Out of Spec'
+
+    live = client.get('/api/monitoring/environmental?location=Clean Room A')
+    assert live.headers['X-QMS-Source'] == 'ring-buffer'
+    newest = live.get_json()[0]
+    assert (newest['id'], newest['value'], newest['recorded_by']) == (response.get_json()['id'], 25.0, 2)
+
+
+@pytest.mark.parametrize('bad', [{'recorded_by': 'operator-7'}, {'recorded_by': 2.5}, {'value': 'warm'}])
+def test_invalid_reading_is_rejected_before_it_is_stored(client, bad):
+    before = stored_readings()
+
+    response = client.post('/api/monitoring/record', json=reading(**bad))
+
+    assert response.status_code == 400
+    assert stored_readings() == before
+
+
+def test_numeric_strings_are_coerced(client):
+    response = client.post('/api/monitoring/record', json=reading(value='22.5', recorded_by='3'))
+    assert response.status_code == 201
+    newest = client.get('/api/monitoring/environmental').get_json()[0]
+    assert (newest['value'], newest['recorded_by']) == (22.5, 3)
+
+
+# ===================================
+# Removed Readings
+# ===================================
+
+def backdated_reading():
+    """A reading stored in March 2020 at its own location (the API stamps readings with the current time)"""
+    return partitions.record_reading(reading(location='Warehouse 9', status='Normal',
+                                             recorded_at='2020-03-04 10:00:00'))
+
+
+def live_ids(client):
+    return {row['id'] for row in client.get('/api/monitoring/environmental?location=Warehouse 9').get_json()}
+
+
+def test_buffer_drops_readings_of_a_dropped_month(client):
+    old = backdated_reading()
+    assert live_ids(client) == {old['id']}
+
+    partitions.drop_partition('2020-03')
+
+    assert live_ids(client) == set()
+
+
+def test_buffer_drops_archived_readings(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(archive, 'ARCHIVE_DIR', str(tmp_path / 'archive'))
+    old = backdated_reading()
+    new = client.post('/api/monitoring/record', json=reading(location='Warehouse 9')).get_json()
+    assert live_ids(client) == {old['id'], new['id']}
+
+    archive.archive_table('monitoring', horizon_days=30)
+
+    assert live_ids(client) == {new['id']}
+
+
+# ===================================
+# Ring Buffer
+# ===================================
+
+def ring_row(reading_id, minute, **overrides):
+    return dict(reading(id=reading_id, status='Normal', alert_level='None',
+                        recorded_at=f'2024-05-17 10:{minute:02d}:00'), **overrides)
+
+
+def ids(rows):
+    return [row['id'] for row in rows]
+
+
+@pytest.fixture
+def buffer(db_path):
+    database.init_database()
+    buffer = LiveMonitoringBuffer(depth=3, max_sensors=2)
+    buffer.warm()
+    return buffer
+
+
+def test_ring_keeps_the_newest_readings_and_round_trips_them():
+    ring = SensorRing(('Clean Room A', 'Environmental', 'Temperature'), 3, StringTable())
+    for n in range(1, 6):
+        ring.append(ring_row(n, n, min_limit=None, recorded_by=None))
+
+    assert ring.truncated
+    assert [ring.row(i)['id'] for i in ring.slots()] == [3, 4, 5]
+    assert ring.oldest_key() == ('2024-05-17 10:03:00', 3)
+    assert ring.row(ring.slots()[-1]) == ring_row(5, 5, min_limit=None, recorded_by=None)
+
+
+def test_truncated_sensor_falls_back_when_the_result_reaches_past_it(buffer):
+    for n in range(1, 6):
+        buffer.append(ring_row(n, n))
+
+    assert ids(buffer.latest('Environmental', limit=3)) == [5, 4, 3]
+    assert buffer.latest('Environmental', limit=4) is None
+    assert (buffer.hits, buffer.fallbacks) == (1, 1)
+
+
+def test_warm_marks_sensors_with_older_readings_in_the_database(db_path):
+    database.init_database()
+    partitions.record_readings([ring_row(None, n) for n in range(1, 6)])
+    buffer = LiveMonitoringBuffer(depth=3)
+
+    assert buffer.warm() == 3
+    assert [row['recorded_at'][-5:] for row in buffer.latest('Environmental', limit=2)] == ['05:00', '04:00']
+    assert buffer.latest('Environmental', limit=5) is None
+
+
+def test_least_recently_updated_sensor_is_evicted(buffer):
+    buffer.append(ring_row(1, 1, parameter_type='Water'))
+    buffer.append(ring_row(2, 2, parameter_type='Air'))
+    buffer.append(ring_row(3, 3, parameter_type='Water'))
+    buffer.append(ring_row(4, 4, parameter_type='Pressure'))
+
+    assert buffer.latest('Air') is None
+    assert ids(buffer.latest('Water')) == [3, 1]
+    assert buffer.metrics()['evicted_parameter_types'] == ['Air']
+    assert buffer.metrics()['sensors'] == 2
+
+
+def test_depth_can_be_overridden_per_parameter(db_path):
+    database.init_database()
+    buffer = LiveMonitoringBuffer(depth=2, depth_overrides={'Humidity': 4})
+    buffer.warm()
+    for n in range(1, 6):
+        buffer.append(ring_row(n, n, parameter_name='Humidity'))
+        buffer.append(ring_row(10 + n, n, parameter_name='Temperature'))
+
+    assert buffer.metrics()['readings'] == 4 + 2
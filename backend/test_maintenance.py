@@ -0,0 +1,100 @@
+"""
+Tests for the database health report, maintenance tasks and their scheduling
+"""
+import time
+from datetime import datetime
+import pytest
+import database
+import maintenance
+from database import get_read_connection, use_site
+
+
+def due():
+    with get_read_connection() as conn:
+        return maintenance.due_tasks(conn)
+
+
+# ===================================
+# Index Advice
+# ===================================
+
+def test_index_advice_reports_used_indexes_and_avoidable_scans(qms_db, monkeypatch):
+    monkeypatch.setattr(maintenance, 'FULL_SCAN_MIN_ROWS', 0)
+    monkeypatch.setattr(maintenance, 'statement_samples', lambda: {
+        'list_capa': ["SELECT * FROM capa WHERE status = 'Open'"],
+        'search_deviations': ["SELECT * FROM deviations WHERE title = 'Spill' AND category = 'Equipment'"],
+        'get_maintenance_health': ["SELECT * FROM users WHERE email = 'x'"],
+    })
+
+    with get_read_connection() as conn:
+        advice = maintenance.index_advice(conn, maintenance.storage(conn))
+
+    assert advice['statements_analyzed'] == 2
+    assert 'idx_capa_status' in advice['used_indexes']
+    assert 'idx_capa_status' not in [entry['index'] for entry in advice['unused_indexes']]
+    [scan] = [entry for entry in advice['missing_indexes'] if entry['table'] == 'deviations']
+    assert scan['endpoints'] == ['search_deviations']
+    assert scan['candidate_columns'][0] == 'title'
+
+
+def test_health_report_covers_the_database_and_its_partitions(qms_db):
+    report = maintenance.health_report()
+
+    assert report['database']['page_count'] > 0
+    assert report['partitions']
+    assert {entry['name'] for entry in report['storage']} >= {'deviations', 'capa'}
+
+
+# ===================================
+# Tasks
+# ===================================
+
+def test_tasks_are_recorded_and_no_longer_due(qms_db):
+    assert due() == list(maintenance.TASKS)
+
+    results = maintenance.run_maintenance()
+
+    assert [(r['task'], r['status']) for r in results] == [
+        ('checkpoint', 'ok'), ('optimize', 'ok'), ('analyze', 'ok'), ('incremental_vacuum', 'skipped')
+    ]
+    assert 'after' in results[2]['details']
+    assert due() == []
+    assert [run['task'] for run in maintenance.list_runs(task='analyze')] == ['analyze']
+
+
+def test_unknown_task_is_rejected(qms_db):
+    with pytest.raises(ValueError):
+        maintenance.run_maintenance(['defragment'])
+
+
+# ===================================
+# Scheduling
+# ===================================
+
+@pytest.mark.parametrize('window, hour, inside', [
+    ('1-5', 1, True), ('1-5', 5, False), ('22-3', 23, True), ('22-3', 2, True), ('22-3', 12, False)
+])
+def test_maintenance_window(window, hour, inside):
+    assert maintenance.in_window(datetime(2024, 5, 17, hour), window) is inside
+
+
+def test_scheduled_maintenance_covers_every_site(qms_db, monkeypatch):
+    monkeypatch.setattr(database, 'CONFIGURED_SITES', ['plant2'])
+    with use_site('plant2'):
+        database.init_database()
+    monkeypatch.setattr(maintenance, 'in_window', lambda now, window=None: True)
+
+    stop = maintenance.start_maintenance_thread(lambda: (0, 0), interval_minutes=0.001)
+    try:
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            with use_site('plant2'):
+                if maintenance.list_runs() and due() == []:
+                    break
+            time.sleep(0.05)
+    finally:
+        stop.set()
+
+    for site in database.list_sites():
+        with use_site(site):
+            assert {run['task'] for run in maintenance.list_runs()} == set(maintenance.TASKS)
@@ -0,0 +1,94 @@
+"""
+Tests for the monthly monitoring partitions
+"""
+import pytest
+import partitions
+from database import get_read_connection, run_write
+
+
+# ===================================
+# Months
+# ===================================
+
+@pytest.mark.parametrize('timestamp, month', [
+    ('2024-01', '2024-01'),
+    ('2024-01-31', '2024-01'),
+    ('2024-01-31 23:59:59', '2024-01'),
+    ('2024-12-01T08:00:00.250', '2024-12'),
+])
+def test_month_of_a_timestamp(timestamp, month):
+    assert partitions.month_of(timestamp) == month
+
+
+@pytest.mark.parametrize('timestamp', ['2024-13xyz', '2024-01garbage', '2024-01-32', '2024-02-01 25:00',
+                                       '20240201', '2024-00', '', None])
+def test_month_of_rejects_anything_but_a_whole_timestamp(timestamp):
+    with pytest.raises(ValueError):
+        partitions.month_of(timestamp)
+
+
+# ===================================
+# Counts
+# ===================================
+
+def record(recorded_at, status='Normal'):
+    return partitions.record_reading({
+        'location': 'Clean Room A', 'parameter_type': 'Environmental', 'parameter_name': 'Temperature',
+        'value': 21.0, 'unit': 'C', 'status': status, 'recorded_at': recorded_at, 'recorded_by': 2
+    })
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    """Paths count_readings opens a read connection for"""
+    paths = []
+    get_read_connection = partitions.get_read_connection
+
+    def spy(db_path=None):
+        paths.append(db_path)
+        return get_read_connection(db_path)
+    monkeypatch.setattr(partitions, 'get_read_connection', spy)
+    return paths
+
+
+def counts():
+    with get_read_connection() as conn:
+        return partitions.count_readings(conn), partitions.count_readings(conn, status='Out of Spec')
+
+
+def test_counts_come_from_the_catalog(qms_db, opened):
+    total, out_of_spec = counts()
+    record('2020-03-04 10:00:00', 'Out of Spec')
+    record('2020-03-05 10:00:00')
+    record('2020-04-01 00:00:00', 'Out of Spec')
+
+    assert counts() == (total + 3, out_of_spec + 2)
+    partitions.drop_partition('2020-03')
+    assert counts() == (total + 1, out_of_spec + 1)
+    assert opened == []
+
+
+def test_months_counted_before_the_catalog_are_opened_until_counted(qms_db, opened):
+    total, out_of_spec = counts()
+    record('2020-03-04 10:00:00', 'Out of Spec')
+
+    def uncount(conn):
+        # As migration 13 leaves a month cataloged before it
+        conn.execute("UPDATE monitoring_partitions SET counted = 0 WHERE month = '2020-03'")
+        conn.execute("DELETE FROM monitoring_partition_counts WHERE month = '2020-03'")
+    run_write(uncount)
+
+    assert counts() == (total + 1, out_of_spec + 1)
+    assert opened == [partitions.partition_path('2020-03')] * 2
+
+    assert partitions.count_partitions() == ['2020-03']
+    opened.clear()
+    assert counts() == (total + 1, out_of_spec + 1)
+    assert opened == []
+
+
+def test_sample_readings_are_seeded_into_partitions(qms_db):
+    with get_read_connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM monitoring').fetchone()[0] == 0
+        assert partitions.count_readings(conn) == 100
+        assert partitions.list_months(conn) != []
@@ -0,0 +1,76 @@
+"""
+Tests for the deviation and CAPA list query compiler
+"""
+import pytest
+from werkzeug.datastructures import MultiDict
+from database import get_read_connection
+from queries import DEVIATION_QUERY, CAPA_QUERY, QueryError
+
+
+def deviations(**args):
+    sql, params = DEVIATION_QUERY.compile(MultiDict(args))
+    with get_read_connection() as conn:
+        return [dict(row) for row in conn.execute(sql, params)]
+
+
+# ===================================
+# Compilation
+# ===================================
+
+def test_defaults_select_every_column_newest_first():
+    sql, params = DEVIATION_QUERY.compile({})
+    columns = ', '.join(DEVIATION_QUERY.columns)
+    assert sql == f'SELECT {columns} FROM deviations ORDER BY created_at DESC, id DESC'
+    assert params == []
+
+
+def test_values_are_bound_and_repeated_filters_become_in():
+    sql, params = CAPA_QUERY.compile(MultiDict([
+        ('fields', 'status,target_date'), ('status', 'Open'), ('status', 'Closed'),
+        ('target_from', '2024-01-01'), ('sort', 'target_date,-status'), ('limit', '10')
+    ]))
+    assert sql == ('SELECT id, status, target_date FROM capa '
+                   'WHERE status IN (?, ?) AND target_date >= ? '
+                   'ORDER BY target_date ASC, status DESC, id ASC LIMIT ? OFFSET ?')
+    assert params == ['Open', 'Closed', '2024-01-01', 10, 0]
+
+
+def test_unknown_arguments_are_ignored():
+    assert DEVIATION_QUERY.compile({'page': ['2']}) == DEVIATION_QUERY.compile({})
+
+
+@pytest.mark.parametrize('args, message', [
+    ({'fields': ['title,password']}, 'Unknown fields: password'),
+    ({'sort': ['-rpn;DROP TABLE deviations']}, 'Unknown sort column'),
+    ({'rpn_min': ['high']}, 'Expected an integer'),
+    ({'detected_from': ['yesterday']}, 'Expected a YYYY-MM-DD date'),
+    ({'limit': ['5000']}, 'limit must be between 0 and 1000'),
+])
+def test_bad_arguments_are_rejected(args, message):
+    with pytest.raises(QueryError, match=message):
+        DEVIATION_QUERY.compile(args)
+
+
+# ===================================
+# Results
+# ===================================
+
+def test_filters_and_sort_apply_in_sql(qms_db):
+    rows = deviations(rpn_min='100', sort='-rpn', fields='rpn')
+    assert all(row['rpn'] >= 100 for row in rows)
+    assert [row['rpn'] for row in rows] == sorted((row['rpn'] for row in rows), reverse=True)
+    assert all(set(row) == {'id', 'rpn'} for row in rows)
+
+
+def test_pages_are_stable_and_disjoint(qms_db):
+    everything = [row['id'] for row in deviations(sort='status', fields='status')]
+    pages = [[row['id'] for row in deviations(sort='status', fields='status', limit='10', offset=str(offset))]
+             for offset in range(0, len(everything), 10)]
+    assert [i for page in pages for i in page] == everything
+
+
+def test_list_endpoint_reports_bad_arguments(qms_db):
+    import api
+    client = api.app.test_client()
+    assert client.get('/api/capa?sort=-password').status_code == 400
+    assert client.get('/api/deviations?fields=id,title&status=Open').status_code == 200
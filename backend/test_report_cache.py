@@ -0,0 +1,73 @@
+"""
+Tests for report parameter normalization and the report output cache
+"""
+import json
+from datetime import date
+import pytest
+import partitions
+from report_cache import ReportError, get_report, normalize_parameters
+
+
+def backdated_reading(value):
+    return partitions.record_reading({
+        'location': 'Warehouse 9', 'parameter_type': 'Environmental', 'parameter_name': 'Humidity',
+        'value': value, 'unit': '%', 'min_limit': 30, 'max_limit': 60, 'status': 'Normal',
+        'recorded_at': '2020-03-04 10:00:00', 'recorded_by': 2
+    })
+
+
+# ===================================
+# Parameter Normalization
+# ===================================
+
+def test_relative_periods_resolve_to_dates():
+    today = date(2024, 5, 17)
+    assert normalize_parameters('Deviation Summary', {'period': 'last-month', 'format': 'pdf'}, today) == {
+        'start_date': '2024-04-01', 'end_date': '2024-04-30'
+    }
+    assert normalize_parameters('Batch Production', {'period': 'quarter', 'department': 'qc'}, today) == {
+        'start_date': '2024-04-01', 'end_date': '2024-05-17'
+    }
+
+
+@pytest.mark.parametrize('parameters', [{'period': 'fortnight'}, {'startDate': '2024-02-30'},
+                                        {'startDate': '2024-03-01', 'endDate': '2024-02-01'}])
+def test_invalid_periods_are_rejected(parameters):
+    with pytest.raises(ReportError):
+        normalize_parameters('Deviation Summary', parameters)
+
+
+# ===================================
+# Cache
+# ===================================
+
+def test_repeated_report_is_served_from_the_cache(qms_db):
+    output, info = get_report('Deviation Summary', {'period': 'all'})
+    cached, cached_info = get_report('Deviation Summary', '{"period": "all", "format": "csv"}')
+
+    assert (info['cached'], cached_info['cached']) == (False, True)
+    # Served as JSON either way; the cached copy has been through it already
+    assert cached == json.loads(json.dumps(output))
+    assert cached_info['cache_key'] == info['cache_key']
+
+
+def test_report_is_rebuilt_after_a_change(qms_db):
+    before, _ = get_report('Environmental Monitoring', {'period': 'custom', 'startDate': '2020-03-01'})
+    backdated_reading(45)
+
+    after, info = get_report('Environmental Monitoring', {'period': 'custom', 'startDate': '2020-03-01'})
+
+    assert not info['cached']
+    assert after['readings'] == before['readings'] + 1
+
+
+def test_report_is_rebuilt_after_readings_leave_unlogged(qms_db):
+    backdated_reading(45)
+    parameters = {'period': 'custom', 'startDate': '2020-03-01', 'endDate': '2020-03-31'}
+    assert get_report('Environmental Monitoring', parameters)[0]['readings'] == 1
+
+    partitions.drop_partition('2020-03')
+
+    output, info = get_report('Environmental Monitoring', parameters)
+    assert not info['cached']
+    assert output['readings'] == 0
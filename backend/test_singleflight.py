@@ -0,0 +1,121 @@
+"""
+Tests for single-flight request coalescing
+"""
+import sqlite3
+import threading
+import time
+import pytest
+from database import QueryCancelled, QueryTimeout
+from singleflight import SingleFlight
+
+KEY = 'main:kpis'
+
+
+@pytest.fixture
+def flight():
+    return SingleFlight(max_wait=5, private_errors=(QueryTimeout,))
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'condition not reached'
+        time.sleep(0.005)
+
+
+def waiters(flight):
+    call = flight._calls.get(KEY)
+    return call.waiters if call else 0
+
+
+def start(fn):
+    """Run fn on a thread; returns (thread, outcome) where outcome gets 'result' or 'error'"""
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = fn()
+        except Exception as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, outcome
+
+
+def blocking(release, result=None, error=None, executions=None):
+    def fn():
+        if executions is not None:
+            executions.append(threading.get_ident())
+        release.wait(5)
+        if error is not None:
+            raise error
+        return result
+    return fn
+
+
+def test_follower_shares_the_leaders_result(flight):
+    release = threading.Event()
+    leader, led = start(lambda: flight.do(KEY, blocking(release, 'leader')))
+    wait_until(lambda: KEY in flight._calls)
+    follower, followed = start(lambda: flight.do(KEY, lambda: 'follower'))
+    wait_until(lambda: waiters(flight) == 1)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert led == {'result': 'leader'}
+    assert followed == {'result': 'leader'}
+    assert flight.metrics()['keys'][KEY]['executions'] == 1
+
+
+def test_query_errors_are_shared(flight):
+    release = threading.Event()
+    error = sqlite3.OperationalError('no such table: capa')
+    leader, led = start(lambda: flight.do(KEY, blocking(release, error=error)))
+    wait_until(lambda: KEY in flight._calls)
+    follower, followed = start(lambda: flight.do(KEY, lambda: 'follower'))
+    wait_until(lambda: waiters(flight) == 1)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert led['error'] is error
+    assert followed['error'] is error
+
+
+def test_cancelled_leader_does_not_fail_its_follower(flight):
+    release = threading.Event()
+    cancelled = QueryCancelled('Client disconnected')
+    leader, led = start(lambda: flight.do(KEY, blocking(release, error=cancelled)))
+    wait_until(lambda: KEY in flight._calls)
+    follower, followed = start(lambda: flight.do(KEY, lambda: 'follower'))
+    wait_until(lambda: waiters(flight) == 1)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert isinstance(led['error'], QueryCancelled)
+    assert followed == {'result': 'follower'}
+    assert flight.metrics()['keys'][KEY]['takeovers'] == 1
+
+
+def test_one_follower_takes_over_a_timed_out_leader(flight):
+    release_leader, release_takeover = threading.Event(), threading.Event()
+    executions = []
+    leader, led = start(lambda: flight.do(KEY, blocking(release_leader, error=QueryTimeout('over budget'))))
+    wait_until(lambda: KEY in flight._calls)
+    followers = [start(lambda: flight.do(KEY, blocking(release_takeover, 'follower', executions=executions)))
+                 for _ in range(2)]
+    wait_until(lambda: waiters(flight) == 2)
+    release_leader.set()
+    # One follower re-runs the read as the new leader, the other waits for it
+    wait_until(lambda: len(executions) == 1 and waiters(flight) == 1)
+    release_takeover.set()
+    leader.join()
+    for thread, _ in followers:
+        thread.join()
+
+    assert isinstance(led['error'], QueryTimeout)
+    assert [outcome for _, outcome in followers] == [{'result': 'follower'}] * 2
+    assert len(executions) == 1
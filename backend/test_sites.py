@@ -0,0 +1,123 @@
+"""
+Tests for per-site request routing and cross-site statistics
+"""
+import os
+import sqlite3
+import pytest
+import api
+import database
+import init_db
+from database import (SiteLocal, UnknownSite, get_read_connection, list_sites, run_write, site_db_path,
+                      use_site)
+
+
+@pytest.fixture
+def plant2(client, monkeypatch):
+    """A second site with its own sample data"""
+    monkeypatch.setattr(database, 'CONFIGURED_SITES', ['plant2'])
+    with use_site('plant2'):
+        database.init_database()
+        init_db.seed_sample_data()
+    return 'plant2'
+
+
+def deviation_count(site):
+    with use_site(site), get_read_connection() as conn:
+        return conn.execute('SELECT COUNT(*) FROM deviations').fetchone()[0]
+
+
+# ===================================
+# Sites
+# ===================================
+
+def test_sites_come_from_configuration_and_the_sites_directory(db_path, monkeypatch):
+    monkeypatch.setattr(database, 'CONFIGURED_SITES', ['plant2', 'bad name'])
+    os.makedirs(database.SITES_DIR)
+    for name in ('plant3.db', 'plant2.db', 'notes.txt'):
+        open(os.path.join(database.SITES_DIR, name), 'w').close()
+
+    assert list_sites() == [database.DEFAULT_SITE, 'plant2', 'plant3']
+    assert site_db_path('plant3') == os.path.join(database.SITES_DIR, 'plant3.db')
+    with pytest.raises(UnknownSite):
+        site_db_path('bad name')
+
+
+def test_site_local_keeps_one_instance_per_site(db_path, monkeypatch):
+    monkeypatch.setattr(database, 'CONFIGURED_SITES', ['plant2'])
+    instances = SiteLocal(object)
+
+    default = instances.get()
+    with use_site('plant2'):
+        assert instances.get() is not default
+        assert instances.get() is instances.get()
+    assert instances.get() is default
+
+
+# ===================================
+# Routing
+# ===================================
+
+def test_requests_reach_the_named_site_only(client, plant2):
+    before = deviation_count(database.DEFAULT_SITE)
+    response = client.post('/api/deviations?site=plant2', json={
+        'deviation_number': 'DEV-P2-001', 'title': 'Plant 2 only', 'description': 'Routing',
+        'category': 'Process', 'severity': 2, 'occurrence': 2, 'detection': 2, 'detected_date': '2024-05-17'
+    })
+    assert response.status_code == 201
+    deviation_id = response.get_json()['id']
+
+    by_header = client.get(f'/api/deviations/{deviation_id}', headers={'X-QMS-Site': plant2})
+    assert by_header.get_json()['title'] == 'Plant 2 only'
+    assert deviation_count(database.DEFAULT_SITE) == before
+
+
+def test_unknown_site_is_refused(client):
+    response = client.get('/api/deviations?site=nowhere')
+    assert response.status_code == 404
+    assert response.get_json()['sites'] == [database.DEFAULT_SITE]
+
+
+def test_streamed_export_reads_the_requested_site(client, plant2):
+    with use_site(plant2):
+        run_write(lambda conn: conn.execute('''
+            INSERT INTO audit_logs (user_id, action, entity_type, entity_id, changes)
+            VALUES (1, 'SITE-CHECK', 'deviation', 1, '{}')
+        '''))
+
+    assert b'SITE-CHECK' in client.get(f'/api/audit-logs/export?site={plant2}').data
+    assert b'SITE-CHECK' not in client.get('/api/audit-logs/export').data
+
+
+# ===================================
+# Fan-Out
+# ===================================
+
+def test_global_stats_add_up_every_site(client, plant2):
+    result = client.get('/api/global/deviations/stats').get_json()
+
+    assert result['sites'] == [database.DEFAULT_SITE, plant2]
+    assert result['by_site'][plant2]['total'] == deviation_count(plant2)
+    assert result['merged']['total'] == deviation_count(database.DEFAULT_SITE) + deviation_count(plant2)
+    assert sum(result['merged']['by_status'].values()) == result['merged']['total']
+    assert result['errors'] == {}
+
+
+def test_failing_site_is_reported_and_left_out(client, plant2, monkeypatch):
+    query = api.query_deviation_stats
+
+    def failing_on_plant2(conn):
+        if database.current_site() == plant2:
+            raise sqlite3.OperationalError('disk I/O error')
+        return query(conn)
+
+    monkeypatch.setattr(api, 'query_deviation_stats', failing_on_plant2)
+    result = client.get('/api/global/deviations/stats').get_json()
+
+    assert result['errors'] == {plant2: 'disk I/O error'}
+    assert result['merged']['total'] == deviation_count(database.DEFAULT_SITE)
+
+
+def test_fan_out_to_an_unknown_site_is_refused(client, plant2):
+    assert client.get(f'/api/global/deviations/stats?sites={plant2},nowhere').status_code == 404
+    result = client.get(f'/api/global/dashboard/kpis?sites={plant2}').get_json()
+    assert result['sites'] == [plant2]
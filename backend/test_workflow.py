@@ -0,0 +1,99 @@
+"""
+Tests for update statements and bulk status transitions of deviations and CAPA
+"""
+import pytest
+from database import get_read_connection, run_write
+from workflow import WorkflowError, build_update
+
+
+def set_status(table, ids, status):
+    """The sample data's statuses are random, so tests set the ones they start from"""
+    run_write(lambda conn: conn.executemany(f'UPDATE {table} SET status = ? WHERE id = ?',
+                                            [(status, record_id) for record_id in ids]))
+    return ids
+
+
+def statuses(table, ids):
+    placeholders = ', '.join('?' * len(ids))
+    with get_read_connection() as conn:
+        rows = conn.execute(f'SELECT id, status FROM {table} WHERE id IN ({placeholders})', ids)
+        return dict(rows.fetchall())
+
+
+def transition_audits(entity):
+    with get_read_connection() as conn:
+        return conn.execute('''
+            SELECT COUNT(*) FROM audit_logs WHERE action = 'TRANSITION' AND entity_type = ?
+        ''', (entity,)).fetchone()[0]
+
+
+# ===================================
+# Update Statements
+# ===================================
+
+def test_same_columns_build_the_same_statement():
+    first, params = build_update('deviation', 7, {'title': 'Spill', 'severity': 3, 'updated_by': 2})
+    second, _ = build_update('deviation', 9, {'severity': 1, 'title': 'Leak'})
+
+    assert first is second
+    assert params[:2] == [3, 'Spill'] and params[-1] == 7
+
+
+@pytest.mark.parametrize('data', [{'rpn': 8, 'secret': 1}, {'updated_by': 2}, {}])
+def test_update_without_valid_columns_is_rejected(data):
+    with pytest.raises(WorkflowError):
+        build_update('deviation', 1, data)
+
+
+# ===================================
+# Bulk Transitions
+# ===================================
+
+def test_bulk_transition_moves_every_record_and_audits_it(client):
+    ids = set_status('deviations', [1, 2, 3], 'Open')
+    response = client.post('/api/deviations/transition', json={
+        'ids': ids + ids[:1], 'to_status': 'Under Investigation', 'comment': 'Triage'
+    })
+
+    assert response.status_code == 200
+    assert response.get_json()['updated'] == len(ids)
+    assert set(statuses('deviations', ids).values()) == {'Under Investigation'}
+    assert transition_audits('deviation') == len(ids)
+
+
+def test_one_disallowed_transition_rejects_the_whole_batch(client):
+    open_ids = set_status('deviations', [1, 2, 3], 'Open')
+    [closed_id] = set_status('deviations', [4], 'Closed')
+
+    response = client.post('/api/deviations/transition', json={
+        'ids': open_ids + [closed_id, 999999], 'to_status': 'Under Investigation'
+    })
+
+    assert response.status_code == 409
+    assert response.get_json()['rejected'] == [
+        {'id': closed_id, 'error': 'cannot move from Closed to Under Investigation'},
+        {'id': 999999, 'error': 'not found'}
+    ]
+    assert set(statuses('deviations', open_ids).values()) == {'Open'}
+    assert transition_audits('deviation') == 0
+
+
+@pytest.mark.parametrize('body', [
+    {'ids': [1]}, {'ids': 1, 'to_status': 'Closed'}, {'ids': ['one'], 'to_status': 'Closed'},
+    {'ids': [], 'to_status': 'Closed'}, {'ids': [1], 'to_status': 'Archived'}
+])
+def test_malformed_transition_is_rejected(client, body):
+    assert client.post('/api/deviations/transition', json=body).status_code == 400
+
+
+def test_capa_transition_updates_the_overdue_index(client):
+    [capa_id] = set_status('capa', [1], 'Pending Verification')
+    run_write(lambda conn: conn.execute("UPDATE capa SET target_date = '2020-01-31' WHERE id = 1"))
+    overdue = lambda: [entry['id'] for entry in client.get('/api/capa/overdue').get_json()]
+    assert capa_id in overdue()
+
+    response = client.post('/api/capa/transition', json={'ids': [capa_id], 'to_status': 'Effective'})
+
+    assert response.status_code == 200
+    assert statuses('capa', [capa_id]) == {capa_id: 'Effective'}
+    assert capa_id not in overdue()
@@ -0,0 +1,135 @@
+"""
+Status workflow and update statements for deviations and CAPA
+Defines the allowed status transitions, builds UPDATE statements from a
+whitelist of columns and applies bulk transitions in one transaction
+"""
+import json
+from datetime import datetime
+from functools import lru_cache
+
+
+class WorkflowError(ValueError):
+    """Raised for unknown columns, unknown records or disallowed transitions"""
+
+    def __init__(self, message, details=None):
+        super().__init__(message)
+        self.details = details or []
+
+
+# Allowed status transitions per entity (from status -> reachable statuses)
+TRANSITIONS = {
+    'deviation': {
+        'Open': ('Under Investigation', 'Closed'),
+        'Under Investigation': ('CAPA Required', 'Closed'),
+        'CAPA Required': ('Under Investigation', 'Closed'),
+        'Closed': ('Open',)
+    },
+    'capa': {
+        'Open': ('In Progress',),
+        'In Progress': ('Pending Verification',),
+        'Pending Verification': ('Effective', 'In Progress'),
+        'Effective': ('Closed',),
+        'Closed': ()
+    }
+}
+
+ENTITY_TABLES = {
+    'deviation': 'deviations',
+    'capa': 'capa'
+}
+
+# Columns a client may set through an update
+UPDATABLE_COLUMNS = {
+    'deviation': frozenset((
+        'deviation_number', 'title', 'description', 'category', 'severity',
+        'occurrence', 'detection', 'rpn', 'status', 'department', 'product_batch',
+        'detected_date'
+    )),
+    'capa': frozenset((
+        'capa_number', 'deviation_id', 'type', 'title', 'description', 'root_cause',
+        'action_plan', 'responsible_person', 'target_date', 'completion_date', 'status',
+        'effectiveness', 'verification_date'
+    ))
+}
+
+# Request keys that describe the update rather than a column
+META_KEYS = frozenset(('id', 'created_at', 'created_by', 'updated_at', 'updated_by'))
+
+# Matches sqlite3's per-connection statement cache on the writer
+STATEMENT_CACHE_SIZE = 256
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def update_statement(table, columns):
+    """
+    UPDATE statement for a sorted tuple of columns
+
+    Identical column sets always produce the identical SQL string, so
+    sqlite3's statement cache reuses the prepared statement instead of
+    re-parsing it for every request.
+    """
+    assignments = ', '.join(f'{column} = ?' for column in columns)
+    return f'UPDATE {table} SET {assignments}, updated_at = ? WHERE id = ?'
+
+
+def build_update(entity, record_id, data):
+    """Return (sql, params) for a single-record update from request JSON"""
+    allowed = UPDATABLE_COLUMNS[entity]
+    unknown = sorted(k for k in data if k not in allowed and k not in META_KEYS)
+    if unknown:
+        raise WorkflowError(f"Unknown fields: {', '.join(unknown)}")
+    columns = tuple(sorted(k for k in data if k in allowed))
+    if not columns:
+        raise WorkflowError('No updatable fields supplied')
+    params = [data[column] for column in columns] + [datetime.now(), record_id]
+    return update_statement(ENTITY_TABLES[entity], columns), params
+
+
+def bulk_transition(conn, entity, ids, to_status, user_id=1, comment=None):
+    """
+    Move every record in ids to to_status, or none of them
+
+    Runs inside the caller's write transaction: all records are loaded and
+    validated first, then updated with one executemany and audited with
+    another. Any missing record or disallowed transition raises
+    WorkflowError before anything is written.
+    """
+    transitions = TRANSITIONS[entity]
+    table = ENTITY_TABLES[entity]
+    if to_status not in transitions:
+        raise WorkflowError(f'Unknown status: {to_status}')
+    ids = list(dict.fromkeys(int(i) for i in ids))
+    if not ids:
+        raise WorkflowError('No ids supplied')
+
+    cursor = conn.cursor()
+    current = {}
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        cursor.execute(
+            f"SELECT id, status FROM {table} WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+        )
+        current.update((row[0], row[1]) for row in cursor.fetchall())
+
+    problems = []
+    for record_id in ids:
+        status = current.get(record_id)
+        if status is None:
+            problems.append({'id': record_id, 'error': 'not found'})
+        elif to_status not in transitions.get(status, ()):
+            problems.append({'id': record_id, 'error': f'cannot move from {status} to {to_status}'})
+    if problems:
+        raise WorkflowError('Transition rejected', problems)
+
+    now = datetime.now()
+    cursor.executemany(update_statement(table, ('status',)),
+                       [(to_status, now, record_id) for record_id in ids])
+    cursor.executemany('''
+        INSERT INTO audit_logs (user_id, action, entity_type, entity_id, changes)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [
+        (user_id, 'TRANSITION', entity, record_id,
+         json.dumps({'from': current[record_id], 'to': to_status, 'comment': comment}))
+        for record_id in ids
+    ])
+    return [{'id': record_id, 'from': current[record_id], 'to': to_status} for record_id in ids]
@@ -0,0 +1,7 @@
+"""
+WSGI entry point for production servers, e.g. gunicorn --bind 0.0.0.0:5001 wsgi:app
+Databases and background threads are started on import, once per worker process
+"""
+from api import app, start_services
+
+start_services()
@@ -7,7 +7,8 @@ echo Pharmaceutical QMS - Backend Server Startup
 echo ============================================================
 echo.
 
-REM Check if database exists
+REM Seed demo data only for a brand-new install; the server itself applies
+REM pending schema migrations on start (PRAGMA user_version)
 if not exist "backend\qms_database.db" (
     echo Database not found. Initializing database...
     cd backend
@@ -16,10 +17,15 @@ if not exist "backend\qms_database.db" (
     echo.
 )
 
-echo Starting API server on http://localhost:5000
+echo Starting API server on http://localhost:5001
 echo Press Ctrl+C to stop the server
 echo ============================================================
 echo.
 
 cd backend
-python api.py
+REM QMS_SERVER=aio selects the asyncio server (long-poll and SSE change routes)
+if "%QMS_SERVER%"=="aio" (
+    python aio_server.py
+) else (
+    python api.py
+)
@@ -7,7 +7,8 @@ echo "Pharmaceutical QMS - Backend Server Startup"
 echo "============================================================"
 echo ""
 
-# Check if database exists
+# Seed demo data only for a brand-new install; the server itself applies
+# pending schema migrations on start (PRAGMA user_version)
 if [ ! -f "backend/qms_database.db" ]; then
     echo "Database not found. Initializing database..."
     cd backend
@@ -16,10 +17,15 @@ if [ ! -f "backend/qms_database.db" ]; then
     echo ""
 fi
 
-echo "Starting API server on http://localhost:5000"
+echo "Starting API server on http://localhost:5001"
 echo "Press Ctrl+C to stop the server"
 echo "============================================================"
 echo ""
 
 cd backend
-python3 api.py
+# QMS_SERVER=aio selects the asyncio server (long-poll and SSE change routes)
+if [ "$QMS_SERVER" = "aio" ]; then
+    python3 aio_server.py
+else
+    python3 api.py
+fi